@@ -9,5 +9,6 @@ setup(name='swalign',
       author_email='marcus@breese.com',
       url='http://github.com/mbreese/swalign/',
       packages=['swalign'],
+      package_data={'swalign': ['data/*']},
       scripts=['bin/swalign']
      )
@@ -4,7 +4,18 @@
 
 ####################################################################################################
 
+import array
+import heapq
+import itertools
 import sys
+import threading
+import time
+
+from .removed import ScoringMatrix, fasta_gen, seq_gen, extract_region, revcomp
+from .matrices import load_scoring_matrix
+from .sequence import EncodedSequence, upper as _upper
+from .stats import AlignmentStats, matrix_nbytes
+from .workspace import Workspace, MAX_BYTES
 
 ####################################################################################################
 
@@ -35,6 +46,17 @@ NucleotideScoringMatrix = IdentityScoringMatrix
 
 ####################################################################################################
 
+# operations stored on 2 bits by Matrix
+_OPERATIONS = 'midx'
+_OPERATION_CODES = dict((op, i) for i, op in enumerate(_OPERATIONS))
+
+# alignment modes: 'local' (Smith-Waterman), 'global' (end to end, Needleman-Wunsch), 'semiglobal'
+# (the whole query against a region of the reference) and 'overlap' (the ends of the sequences are
+# free, e.g. the suffix of one and the prefix of the other)
+MODES = ('local', 'global', 'semiglobal', 'overlap')
+
+####################################################################################################
+
 class MatrixCell(object):
 
     ##############################################
@@ -57,151 +79,300 @@ class MatrixCell(object):
 
 class Matrix(object):
 
+    ''' Matrix of cells stored in packed arrays: scores, run lengths and operations on 2 bits.
+
+    :meth:`get` returns a new :class:`MatrixCell` and :meth:`set` copies the fields of a cell.
+    A cell which was never set has the operation ' ', it is stored as a run length of -1.  The
+    arrays are taken from *workspace*, if given.
+    '''
+
     ##############################################
 
-    def __init__(self, number_of_rows, number_of_cols):
+    def __init__(self, number_of_rows, number_of_cols, workspace=None):
 
         self.number_of_rows = number_of_rows
         self.number_of_cols = number_of_cols
-        self._values = [[MatrixCell() for c in xrange(number_of_cols)]
+        number_of_cells = number_of_rows * number_of_cols
+        if workspace is None:
+            self._scores = array.array('l', [0]) * number_of_cells
+            self._run_lengths = array.array('i', [-1]) * number_of_cells
+            self._operations = array.array('B', [0]) * ((number_of_cells +3) // 4)
+        else:
+            self._scores = workspace.array('matrix scores', 'l', number_of_cells)
+            self._run_lengths = workspace.array('matrix run lengths', 'i', number_of_cells, 0xff)
+            self._operations = workspace.array('matrix operations', 'B',
+                                               (number_of_cells +3) // 4)
+
+    ##############################################
+
+    @property
+    def nbytes(self):
+        return (len(self._scores) * self._scores.itemsize +
+                len(self._run_lengths) * self._run_lengths.itemsize +
+                len(self._operations))
+
+    ##############################################
+
+    def get(self, row, col):
+
+        index = row * self.number_of_cols + col
+        run_length = self._run_lengths[index]
+        if run_length < 0:
+            op = ' '
+            run_length = 0
+        else:
+            op = _OPERATIONS[(self._operations[index >> 2] >> ((index & 3) << 1)) & 3]
+        return MatrixCell(self._scores[index], op, run_length)
+
+    ##############################################
+
+    def set(self, row, col, value):
+
+        index = row * self.number_of_cols + col
+
+        score = value.score
+        if isinstance(score, float) and self._scores.typecode != 'd':
+            self._scores = array.array('d', self._scores)
+        self._scores[index] = score
+
+        if value.op == ' ':
+            self._run_lengths[index] = -1
+        else:
+            self._run_lengths[index] = value.run_length
+            shift = (index & 3) << 1
+            byte = index >> 2
+            self._operations[byte] = ((self._operations[byte] & ~(3 << shift)) |
+                                      (_OPERATION_CODES[value.op] << shift))
+
+    ##############################################
+
+    def ends(self, min_score=None):
+
+        ''' Yield the end cells of the local alignments as ``(score, row, col)`` tuples by
+        decreasing order: the cells scoring more than 0, and at least *min_score*, which are not
+        extended by a match on their diagonal scoring more.
+
+        The cells are found by a single pass over the arrays keeping the best ones in a heap, the
+        pass is done again keeping four times more cells when they are all consumed.
+        '''
+
+        number_of_ends = 256
+        skip = 0
+        while True:
+            ends = heapq.nlargest(number_of_ends, self._ends(min_score))
+            for end in ends[skip:]:
+                yield end
+            if len(ends) < number_of_ends:
+                return
+            skip = number_of_ends
+            number_of_ends *= 4
+
+    ##############################################
+
+    def _ends(self, min_score):
+
+        scores = self._scores
+        run_lengths = self._run_lengths
+        operations = self._operations
+        number_of_rows = self.number_of_rows
+        number_of_cols = self.number_of_cols
+        match = _OPERATION_CODES['m']
+        if min_score is None:
+            min_score = 0
+
+        for row in xrange(1, number_of_rows):
+            start = row * number_of_cols
+            last_row = row == number_of_rows -1
+            for col in xrange(1, number_of_cols):
+                index = start + col
+                score = scores[index]
+                if score <= 0 or score < min_score:
+                    continue
+                if not last_row and col < number_of_cols -1:
+                    successor = index + number_of_cols +1
+                    if (scores[successor] > score and run_lengths[successor] >= 0 and
+                        (operations[successor >> 2] >> ((successor & 3) << 1)) & 3 == match):
+                        continue
+                yield score, row, col
+
+####################################################################################################
+
+class BandedMatrix(object):
+
+    ''' Matrix storing only the cells of the diagonals ``diagonal +/- band_width``, the diagonal of
+    a cell being ``col - row``.  Borders outside the band are returned as borders, other cells
+    outside the band as null cells.
+    '''
+
+    ##############################################
+
+    def __init__(self, number_of_rows, number_of_cols, diagonal, band_width):
+
+        self.number_of_rows = number_of_rows
+        self.number_of_cols = number_of_cols
+        self.diagonal = diagonal
+        self.band_width = band_width
+        self._values = [[MatrixCell() for c in xrange(*self.band(r))]
                         for r in xrange(number_of_rows)]
 
     ##############################################
 
+    def band(self, row):
+
+        ''' Return the range of the columns of *row* in the band '''
+
+        lo = max(0, row + self.diagonal - self.band_width)
+        hi = min(self.number_of_cols, row + self.diagonal + self.band_width +1)
+        return lo, max(lo, hi)
+
+    ##############################################
+
+    def is_full(self):
+        # all the interior cells are in the band
+        return (self.diagonal - self.band_width <= 2 - self.number_of_rows
+                and self.diagonal + self.band_width >= self.number_of_cols -2)
+
+    ##############################################
+
+    def is_on_edge(self, row, col):
+
+        ''' Test if a neighbour of the cell is an interior cell outside the band '''
+
+        offset = col - row - self.diagonal
+        return ((offset == -self.band_width and col > 1) or
+                (offset == self.band_width and row > 1))
+
+    ##############################################
+
     def get(self, row, col):
-        return self._values[row][col]
+
+        lo, hi = self.band(row)
+        if lo <= col < hi:
+            return self._values[row][col - lo]
+        elif row == 0:
+            return MatrixCell(0, 'd', 0)
+        elif col == 0:
+            return MatrixCell(0, 'i', 0)
+        else:
+            return MatrixCell(0, 'x', 0)
 
     ##############################################
 
     def set(self, row, col, value):
-        self._values[row][col].set(value)
+
+        lo, hi = self.band(row)
+        assert lo <= col < hi
+        self._values[row][col - lo].set(value)
 
 ####################################################################################################
 
-class LocalAlignment(object):
+def _is_start(mode, row, col):
+
+    if mode == 'global':
+        return not row and not col
+    elif mode == 'semiglobal':
+        return not row
+    elif mode == 'overlap':
+        return not row or not col
+    return False
+
+####################################################################################################
+
+def _border_scores(aligner, length, free):
+
+    ''' Return the scores of a border of *length* cells, after the corner: a gap, unless it is
+    *free*.
+    '''
+
+    if free:
+        return [0] * (length +1)
+    return [0] + [aligner.gap_penalty + (i -1) * aligner.gap_extension_penalty
+                  for i in xrange(1, length +1)]
+
+####################################################################################################
+
+class Engine(object):
+
+    ''' Base class of the engines computing the matrix of a :class:`LocalAlignment`.
+
+    :meth:`fill` returns the matrix, with at least a ``get`` method returning a
+    :class:`MatrixCell`, and the position of the maximum, :meth:`score` only the maximum and its
+    position.  :meth:`backtrack` returns the start of the alignment, its operations and its path.
+    '''
+
+    # alignment modes supported by the engine
+    modes = ('local',)
 
     ##############################################
 
-    def __init__(self, scoring_matrix,
-                 gap_penalty=-1, gap_extension_penalty=-1, gap_extension_decay=0.0,
-                 prefer_gap_runs=True,
-                 verbose=False, wildcard=None):
+    def __init__(self, aligner):
 
-        self.scoring_matrix = scoring_matrix
-        self.gap_penalty = gap_penalty
-        self.gap_extension_penalty = gap_extension_penalty
-        self.gap_extension_decay = gap_extension_decay
-        self.verbose = verbose
-        self.prefer_gap_runs = prefer_gap_runs
-        self.wildcard = wildcard
+        self._aligner = aligner
+        self._reference = None
 
     ##############################################
 
-    def align(self, ref, query, ref_name='ref', query_name='query', rc=False):
+    def reference(self, ref):
 
-        orig_ref = ref
-        orig_query = query
+        ''' Return the state precomputed by :meth:`prepare_reference` for *ref*.  The state is kept
+        in *ref* if it is an :class:`EncodedSequence`, else the state of the last reference is
+        kept, aligning many queries against the same reference computes it once.
+        '''
 
-        ref = ref.upper()
-        query = query.upper()
+        aligner = self._aligner
+        key = (aligner.scoring_matrix, aligner.wildcard)
+        if isinstance(ref, EncodedSequence):
+            return ref.state((self.__class__, 'reference') + key,
+                             lambda: self.prepare_reference(ref))
+        cached = self._reference
+        if cached is None or cached[1] != key or (cached[0] is not ref and cached[0] != ref):
+            cached = self._reference = (ref, key, self.prepare_reference(ref))
+        return cached[2]
 
-        matrix = Matrix(len(query) +1, len(ref) +1)
-        for row in xrange(1, matrix.number_of_rows):
-            matrix.set(row, 0, MatrixCell(0, 'i', 0))
-        for col in xrange(1, matrix.number_of_cols):
-            matrix.set(0, col, MatrixCell(0, 'd', 0))
+    ##############################################
 
-        max_value = 0
-        max_row = 0
-        max_col = 0
+    def prepare_reference(self, ref):
+        return None
 
-        # calculate matrix
-        for row in xrange(1, matrix.number_of_rows):
-            for col in xrange(1, matrix.number_of_cols):
+    ##############################################
 
-                left = matrix.get(row, col -1) # Deletion
-                up = matrix.get(row -1, col) # Insertion
-                previous = matrix.get(row -1, col -1) # Match/Mismatch
+    def fill(self, ref, query, mode='local'):
+        raise NotImplementedError
 
-                # Match/Mismatch
-                mm_value = previous.score + self.scoring_matrix.score(query[row -1], ref[col -1], self.wildcard)
+    ##############################################
 
-                ins_run = 0
-                del_run = 0
+    def score(self, ref, query, mode='local'):
+        raise NotImplementedError
 
-                if up.op == 'i':
-                    ins_run = up.run_length
-                    if up.score == 0:
-                        # no penalty to start the alignment
-                        ins_value = 0
-                    else:
-                        # if not self.gap_extension_decay:
-                        ins_value = up.score + self.gap_extension_penalty
-                        # else:
-                        #     ins_value = (up.score +
-                        #                  min(0, self.gap_extension_penalty + ins_run * self.gap_extension_decay))
-                else:
-                    ins_value = up.score + self.gap_penalty
+    ##############################################
 
-                if left.op == 'd':
-                    del_run = left.run_length
-                    if left.score == 0:
-                        # no penalty to start the alignment
-                        del_value = 0
-                    else:
-                        # if not self.gap_extension_decay:
-                        del_value = left.score + self.gap_extension_penalty
-                        # else:
-                        #     del_value = (left.score +
-                        #                  min(0, self.gap_extension_penalty + del_run * self.gap_extension_decay))
+    def fill_scores(self, ref, query):
 
-                else:
-                    del_value = left.score + self.gap_penalty
-                    
-                cell_value = max(mm_value, del_value, ins_value, 0)
-
-                if not self.prefer_gap_runs:
-                    # clear run length
-                    ins_run = 0
-                    del_run = 0
-
-                if del_run and cell_value == del_value:
-                    cell = MatrixCell(cell_value, 'd', del_run +1)
-                elif ins_run and cell_value == ins_value:
-                    cell = MatrixCell(cell_value, 'i', ins_run +1)
-                elif cell_value == mm_value:
-                    cell = MatrixCell(cell_value, 'm', 0)
-                # prefer_gap_runs
-                elif cell_value == del_value:
-                    cell = MatrixCell(cell_value, 'd', 1)
-                elif cell_value == ins_value:
-                    cell = MatrixCell(cell_value, 'i', 1)
-                else:
-                    # ???
-                    cell = MatrixCell(0, 'x', 0)
+        ''' Like :meth:`fill`, the matrix keeping the score of each cell '''
 
-                if cell.score >= max_value:
-                    max_value = cell.score
-                    max_row = row
-                    max_col = col
+        return self.fill(ref, query)
 
-                matrix.set(row, col, cell)
+    ##############################################
 
-        # backtrack
+    def backtrack(self, matrix, max_row, max_col, mode='local', stop=None):
+
+        # backtrack, a local alignment starts after a null cell, the other ones on the borders, None
+        # is returned if the path reaches a cell of *stop*
         row = max_row
         col = max_col
-        value = max_value
 
         op = ''
         aln = []
 
         path = []
-        while True:
+        while not _is_start(mode, row, col):
             item = matrix.get(row, col)
 
-            if item.score <= 0:
+            if mode == 'local' and item.score <= 0:
                 break
 
+            if stop is not None and (row, col) in stop:
+                return None
             path.append((row, col))
             aln.append(item.op)
 
@@ -217,6 +388,818 @@ class LocalAlignment(object):
 
         aln.reverse()
 
+        return row, col, aln, path
+
+####################################################################################################
+
+class ReferenceScores(object):
+
+    ''' Scores of a query residue against each residue of a reference, as a list, built on demand
+    for each query residue.
+    '''
+
+    ##############################################
+
+    def __init__(self, scoring_matrix, ref, wildcard=None):
+
+        self.scoring_matrix = scoring_matrix
+        self.ref = ref
+        self.wildcard = wildcard
+        self._residues = set(ref)
+        self._rows = {}
+
+    ##############################################
+
+    def __getitem__(self, residue):
+
+        row = self._rows.get(residue)
+        if row is None:
+            scores = dict((base, self.scoring_matrix.score(residue, base, self.wildcard))
+                          for base in self._residues)
+            row = self._rows[residue] = map(scores.__getitem__, self.ref)
+        return row
+
+####################################################################################################
+
+_EMPTY_CELL = MatrixCell()
+_DELETION_BORDER = MatrixCell(0, 'd', 0)
+_INSERTION_BORDER = MatrixCell(0, 'i', 0)
+
+# approximate size of a MatrixCell, its attribute dict and its slot in a list
+_CELL_BYTES = 352
+
+def _cells(number_of_cells):
+    return [MatrixCell() for i in xrange(number_of_cells)]
+
+####################################################################################################
+
+class PythonEngine(Engine):
+
+    ''' Reference engine: fill a :class:`Matrix` of :class:`MatrixCell` one cell at a time '''
+
+    modes = MODES
+
+    ##############################################
+
+    def prepare_reference(self, ref):
+        return ReferenceScores(self._aligner.scoring_matrix, ref, self._aligner.wildcard)
+
+    ##############################################
+
+    def _cell(self, left, up, previous, score, cell=None, local=True):
+
+        # the fields of *cell* are set if given, else a new cell is returned, scores are only
+        # floored to 0 in a local alignment
+
+        aligner = self._aligner
+
+        # Match/Mismatch
+        mm_value = previous.score + score
+
+        ins_run = 0
+        del_run = 0
+
+        if up.op == 'i':
+            ins_run = up.run_length
+            if up.score == 0 and local:
+                # no penalty to start the alignment
+                ins_value = 0
+            else:
+                # if not self.gap_extension_decay:
+                ins_value = up.score + aligner.gap_extension_penalty
+                # else:
+                #     ins_value = (up.score +
+                #                  min(0, self.gap_extension_penalty +
+                #                         ins_run * self.gap_extension_decay))
+        else:
+            ins_value = up.score + aligner.gap_penalty
+
+        if left.op == 'd':
+            del_run = left.run_length
+            if left.score == 0 and local:
+                # no penalty to start the alignment
+                del_value = 0
+            else:
+                # if not self.gap_extension_decay:
+                del_value = left.score + aligner.gap_extension_penalty
+                # else:
+                #     del_value = (left.score +
+                #                  min(0, self.gap_extension_penalty +
+                #                         del_run * self.gap_extension_decay))
+
+        else:
+            del_value = left.score + aligner.gap_penalty
+                    
+        if local:
+            cell_value = max(mm_value, del_value, ins_value, 0)
+        else:
+            cell_value = max(mm_value, del_value, ins_value)
+
+        if not aligner.prefer_gap_runs:
+            # clear run length
+            ins_run = 0
+            del_run = 0
+
+        if del_run and cell_value == del_value:
+            op, run_length = 'd', del_run +1
+        elif ins_run and cell_value == ins_value:
+            op, run_length = 'i', ins_run +1
+        elif cell_value == mm_value:
+            op, run_length = 'm', 0
+        # prefer_gap_runs
+        elif cell_value == del_value:
+            op, run_length = 'd', 1
+        elif cell_value == ins_value:
+            op, run_length = 'i', 1
+        else:
+            # ???
+            cell_value, op, run_length = 0, 'x', 0
+
+        if cell is None:
+            return MatrixCell(cell_value, op, run_length)
+        cell.score = cell_value
+        cell.op = op
+        cell.run_length = run_length
+        return cell
+
+    ##############################################
+
+    def fill(self, ref, query, mode='local'):
+
+        matrix = Matrix(len(query) +1, len(ref) +1, self._aligner.workspace)
+        max_value, max_row, max_col = self._fill(ref, query, matrix, mode)
+
+        return matrix, max_value, max_row, max_col
+
+    ##############################################
+
+    def fill_banded(self, ref, query, diagonal, band_width):
+
+        matrix = BandedMatrix(len(query) +1, len(ref) +1, diagonal, band_width)
+        for row in xrange(1, matrix.number_of_rows):
+            lo, hi = matrix.band(row)
+            if lo == 0 < hi:
+                matrix.set(row, 0, MatrixCell(0, 'i', 0))
+        for col in xrange(max(1, matrix.band(0)[0]), matrix.band(0)[1]):
+            matrix.set(0, col, MatrixCell(0, 'd', 0))
+
+        max_value = 0
+        max_row = 0
+        max_col = 0
+
+        ref_scores = self.reference(ref)
+        for row in xrange(1, matrix.number_of_rows):
+            lo, hi = matrix.band(row)
+            scores = ref_scores[query[row -1]]
+            for col in xrange(max(1, lo), hi):
+
+                cell = self._cell(matrix.get(row, col -1), # Deletion
+                                  matrix.get(row -1, col), # Insertion
+                                  matrix.get(row -1, col -1), # Match/Mismatch
+                                  scores[col -1])
+
+                if cell.score >= max_value:
+                    max_value = cell.score
+                    max_row = row
+                    max_col = col
+
+                matrix.set(row, col, cell)
+
+        return matrix, max_value, max_row, max_col
+
+    ##############################################
+
+    def fill_xdrop(self, ref, query, x_drop, z_drop=None):
+
+        ''' Fill a :class:`Matrix` row by row, computing in each row only the columns reachable
+        from the cells of the previous row whose score is at least the best score minus *x_drop*,
+        the cells not computed being null.  The fill stops when no cell is left, or with *z_drop*,
+        when the best score of a row drops by more than ``z_drop + |gap_extension_penalty| * d``
+        below the best score, *d* being the distance between their diagonals.
+
+        Return the matrix, the maximum and its position, the number of cells computed and whether
+        the fill stopped before the last row.
+        '''
+
+        aligner = self._aligner
+        number_of_cols = len(ref) +1
+        matrix = Matrix(len(query) +1, number_of_cols, aligner.workspace)
+
+        null_cell = MatrixCell(0, 'x', 0)
+        previous_row = [MatrixCell()] + [MatrixCell(0, 'd', 0) for col in xrange(len(ref))]
+        for col in xrange(1, number_of_cols):
+            matrix.set(0, col, previous_row[col])
+
+        max_value = 0
+        max_row = 0
+        max_col = 0
+
+        lo = 1
+        hi = len(ref)
+        number_of_cells = 0
+        stopped = False
+
+        # nothing to compute against an empty reference
+        number_of_rows = len(query) +1 if ref else 1
+
+        ref_scores = self.reference(ref)
+        for row in xrange(1, number_of_rows):
+            scores = ref_scores[query[row -1]]
+            current_row = [MatrixCell(0, 'i', 0)] + [null_cell] * len(ref)
+            matrix.set(row, 0, current_row[0])
+
+            first_live = None
+            last_live = None
+            row_max_value = None
+            row_max_col = 0
+            for col in xrange(lo, number_of_cols):
+
+                cell = self._cell(current_row[col -1], # Deletion
+                                  previous_row[col], # Insertion
+                                  previous_row[col -1], # Match/Mismatch
+                                  scores[col -1])
+                number_of_cells += 1
+
+                if cell.score >= max_value:
+                    max_value = cell.score
+                    max_row = row
+                    max_col = col
+                if row_max_value is None or cell.score >= row_max_value:
+                    row_max_value = cell.score
+                    row_max_col = col
+
+                matrix.set(row, col, cell)
+                current_row[col] = cell
+
+                # past the columns reachable from the previous row, only go on while the cells
+                # are live
+                if cell.score >= max_value - x_drop:
+                    if first_live is None:
+                        first_live = col
+                    last_live = col
+                elif col >= hi:
+                    break
+
+            previous_row = current_row
+
+            if first_live is None:
+                stopped = row < len(query)
+                break
+            if z_drop is not None and (max_value - row_max_value >
+                                       z_drop + abs(aligner.gap_extension_penalty) *
+                                       abs((row - max_row) - (row_max_col - max_col))):
+                stopped = row < len(query)
+                break
+
+            lo = first_live
+            hi = last_live +1
+
+        return matrix, max_value, max_row, max_col, number_of_cells, stopped
+
+    ##############################################
+
+    def score(self, ref, query, mode='local'):
+        return self._fill(ref, query, mode=mode)
+
+    ##############################################
+
+    def _fill(self, ref, query, matrix=None, mode='local'):
+
+        # the cells of the previous and the current rows are kept to compute the next ones, they
+        # are stored in the matrix if given
+        #
+        # skipping the start of the reference is free unless the alignment is global, skipping the
+        # start of the query is free in local and overlap alignments; the other alignments don't
+        # start after a null cell and end on the last row or column
+
+        number_of_cols = len(ref) +1
+        workspace = self._aligner.workspace
+        if workspace is None:
+            previous_row = _cells(number_of_cols)
+            current_row = _cells(number_of_cols)
+        else:
+            previous_row = workspace.buffer('previous row', number_of_cols, _cells, _CELL_BYTES)
+            current_row = workspace.buffer('current row', number_of_cols, _cells, _CELL_BYTES)
+
+        local = mode == 'local'
+        row_border = _border_scores(self._aligner, len(ref), mode != 'global')
+        col_border = _border_scores(self._aligner, len(query), mode in ('local', 'overlap'))
+
+        previous_row[0].set(_EMPTY_CELL)
+        for col in xrange(1, number_of_cols):
+            cell = previous_row[col]
+            cell.set(_DELETION_BORDER)
+            if row_border[col]:
+                cell.score = row_border[col]
+                cell.run_length = col
+            if matrix is not None:
+                matrix.set(0, col, cell)
+
+        max_value = 0
+        max_row = 0
+        max_col = 0
+        # overlap: the scores of the last column
+        last_col = [previous_row[number_of_cols -1].score]
+
+        # calculate matrix
+        ref_scores = self.reference(ref)
+        for row in xrange(1, len(query) +1):
+            scores = ref_scores[query[row -1]]
+            current_row[0].set(_INSERTION_BORDER)
+            if col_border[row]:
+                current_row[0].score = col_border[row]
+                current_row[0].run_length = row
+            if matrix is not None:
+                matrix.set(row, 0, current_row[0])
+            for col in xrange(1, number_of_cols):
+
+                cell = self._cell(current_row[col -1], # Deletion
+                                  previous_row[col], # Insertion
+                                  previous_row[col -1], # Match/Mismatch
+                                  scores[col -1],
+                                  current_row[col],
+                                  local)
+
+                if local and cell.score >= max_value:
+                    max_value = cell.score
+                    max_row = row
+                    max_col = col
+
+                if matrix is not None:
+                    matrix.set(row, col, cell)
+
+            previous_row, current_row = current_row, previous_row
+            if mode == 'overlap':
+                last_col.append(previous_row[number_of_cols -1].score)
+
+        if local:
+            return max_value, max_row, max_col
+
+        # previous_row is the last row
+        last_row = len(query)
+        if mode == 'global':
+            return previous_row[number_of_cols -1].score, last_row, number_of_cols -1
+
+        # the last cell in row-major order reaching the maximum
+        cells = [(previous_row[col].score, last_row, col) for col in xrange(number_of_cols)]
+        if mode == 'overlap':
+            cells = [(score, row, number_of_cols -1)
+                     for row, score in enumerate(last_col[:-1])] + cells
+        max_value, max_row, max_col = cells[0]
+        for value, row, col in cells:
+            if value >= max_value:
+                max_value, max_row, max_col = value, row, col
+
+        return max_value, max_row, max_col
+
+####################################################################################################
+
+def _engine_class(name):
+
+    if name == 'python':
+        return PythonEngine
+    elif name == 'numpy':
+        from .numpy_engine import NumpyEngine
+        return NumpyEngine
+    elif name == 'profile':
+        from .profile_engine import ProfileEngine
+        return ProfileEngine
+    elif name == 'gotoh':
+        from .gotoh_engine import GotohEngine
+        return GotohEngine
+    elif name == 'bitparallel':
+        from .bitparallel import BitParallelEngine
+        return BitParallelEngine
+    else:
+        raise ValueError("Unknown alignment engine '%s'" % name)
+
+####################################################################################################
+
+class LocalAlignment(object):
+
+    ##############################################
+
+    def __init__(self, scoring_matrix,
+                 gap_penalty=-1, gap_extension_penalty=-1, gap_extension_decay=0.0,
+                 prefer_gap_runs=True,
+                 verbose=False, wildcard=None,
+                 engine='python', stats=None, workspace_bytes=MAX_BYTES,
+                 mode='local', globalalign=False, bit_parallel=True):
+
+        # engine is 'python' (reference implementation), 'numpy' (vectorised by anti-diagonals),
+        # 'profile' (vectorised by columns using a query profile) or 'gotoh' (true affine gaps with
+        # gap_extension_decay support), all but 'python' require NumPy
+        # bit_parallel: the 'python' engine switches to the 'bitparallel' one, computing the same
+        # alignments a column at a time, when match is 1, mismatch -1 and both gap penalties -1
+        # stats is an AlignmentStats collecting timings and counters, None to disable them
+        # workspace_bytes caps the buffers kept between alignments by each thread, 0 keeps none
+        # mode is the default alignment mode, one of MODES, globalalign is the same as
+        # mode='global'
+
+        self.scoring_matrix = scoring_matrix
+        self.gap_penalty = gap_penalty
+        self.gap_extension_penalty = gap_extension_penalty
+        self.gap_extension_decay = gap_extension_decay
+        self.verbose = verbose
+        self.prefer_gap_runs = prefer_gap_runs
+        self.wildcard = wildcard
+        self.engine = engine
+        if engine == 'python' and bit_parallel:
+            self._engine = _engine_class('bitparallel')(self)
+        else:
+            self._engine = _engine_class(engine)(self)
+        self.stats = stats
+        self.mode = 'global' if globalalign else mode
+        self._check_mode(self.mode)
+        self.workspace_bytes = workspace_bytes
+        self._local = threading.local()
+
+    ##############################################
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    ##############################################
+
+    @property
+    def workspace(self):
+
+        ''' :class:`Workspace` of the current thread, None if *workspace_bytes* is 0.  The
+        matrices returned by the engines use its buffers and are only valid until the next
+        alignment in the same thread.
+        '''
+
+        if not self.workspace_bytes:
+            return None
+        workspace = getattr(self._local, 'workspace', None)
+        if workspace is None:
+            workspace = self._local.workspace = Workspace(self.workspace_bytes)
+        return workspace
+
+    ##############################################
+
+    def release_workspace(self):
+
+        ''' Release the buffers kept by the workspace of the current thread '''
+
+        workspace = getattr(self._local, 'workspace', None)
+        if workspace is not None:
+            workspace.release()
+
+    ##############################################
+
+    def _check_mode(self, mode):
+
+        if mode is None:
+            return self.mode
+        if mode not in MODES:
+            raise ValueError("Unknown alignment mode '%s'" % mode)
+        if mode not in self._engine.modes:
+            raise ValueError("The '%s' engine doesn't support the '%s' mode" % (self.engine, mode))
+        return mode
+
+    ##############################################
+
+    def score_only(self, ref, query, mode=None):
+
+        ''' Return the best alignment score of *query* against *ref* as a tuple
+        ``(max_value, max_row, max_col)``, without traceback.
+
+        Only two rows of the matrix are kept, the memory is thus O(len(ref)).  *max_row* and
+        *max_col* are the end positions of the alignment in *query* and *ref*, since the
+        alignment only depends on the sequences before them, calling :meth:`align` with
+        ``ref[:max_col]`` and ``query[:max_row]`` gives the same alignment for a lower cost.
+        '''
+
+        mode = self._check_mode(mode)
+        if self.stats is None:
+            return self._engine.score(_upper(ref), _upper(query), mode)
+
+        start = time.time()
+        value = self._engine.score(_upper(ref), _upper(query), mode)
+        self.stats.add('fill', time.time() - start)
+        self.stats.cells += len(ref) * len(query)
+        return value
+
+    ##############################################
+
+    def align(self, ref, query, ref_name='ref', query_name='query', rc=False, mode=None):
+
+        ''' Align *query* against *ref* in *mode*, one of :data:`MODES`, the mode of the aligner
+        by default.  The alignments other than local ones are computed by the same fill, without
+        flooring the scores to 0, with gap penalties on the borders which can't be skipped freely
+        and ending on the last row (or column).
+        '''
+
+        mode = self._check_mode(mode)
+
+        orig_ref = ref
+        orig_query = query
+
+        ref = _upper(ref)
+        query = _upper(query)
+
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+
+        matrix, max_value, max_row, max_col = self._engine.fill(ref, query, mode)
+        if stats is not None:
+            filled = time.time()
+
+        row, col, aln, path = self._backtrack(self._engine, ref, query, matrix,
+                                             max_value, max_row, max_col, mode)
+        if stats is not None:
+            backtracked = time.time()
+
+        cigar = _reduce_cigar(aln)
+
+        alignment = Alignment(orig_query, orig_ref, row, col, cigar, max_value,
+                              ref_name, query_name, rc, self.wildcard)
+        if stats is not None:
+            self._record(start, filled, backtracked, len(ref) * len(query), matrix,
+                         query_name, ref_name)
+
+        return alignment
+
+    ##############################################
+
+    def align_many(self, ref, queries, ref_name='ref', rc=False, mode=None):
+
+        ''' Align each query of *queries* against *ref* and yield the alignments, in order.
+
+        *queries* is an iterable of sequences, or of ``(name, seq)`` or ``(name, seq, comments)``
+        tuples like the generators returned by :func:`fasta_gen`.  The reference is upper-cased
+        and encoded once, and the engine keeps what it precomputes for it (the score of each
+        query residue against the reference for the Python engine, the encoded reference and the
+        score table for the NumPy ones) for all the queries.
+        '''
+
+        # the engines keep their states in the upper-case EncodedSequence, the same object for each
+        # query
+        if not isinstance(ref, EncodedSequence):
+            ref = EncodedSequence(ref)
+
+        for item in queries:
+            if isinstance(item, tuple):
+                query_name, query = item[:2]
+            else:
+                query_name, query = 'query', item
+            yield self.align(ref, query, ref_name, query_name, rc, mode)
+
+    ##############################################
+
+    def align_banded(self, ref, query, diagonal, band_width,
+                     ref_name='ref', query_name='query', rc=False):
+
+        ''' Align *query* to *ref* computing only the cells of the diagonals ``diagonal +/-
+        band_width``, the diagonal of a cell being the position in *ref* minus the position in
+        *query*.  Time and memory are O(len(query) * band_width).
+
+        Cells outside the band are considered as null.  The band is widened twice, until the band
+        covers the whole matrix, when the alignment touches an edge of the band or when an
+        alignment using cells outside the band could score more, i.e. when the score of an edge
+        cell, or 0 for an alignment starting outside the band, plus the best score still reachable
+        from it is greater than the best score in the band.  The score is thus the one of
+        :meth:`align`, equal scores can give another alignment.  The band only saves work when the
+        best alignment lies in it and scores well, e.g. on the diagonal of a seed hit or of a known
+        region.  The banded matrix is always computed by the Python engine.
+        '''
+
+        orig_ref = ref
+        orig_query = query
+
+        ref = _upper(ref)
+        query = _upper(query)
+
+        engine = PythonEngine(self)
+        while True:
+            matrix, max_value, max_row, max_col = engine.fill_banded(ref, query,
+                                                                     diagonal, band_width)
+            row, col, aln, path = self._backtrack(engine, ref, query, matrix,
+                                                 max_value, max_row, max_col)
+            if matrix.is_full():
+                break
+            if (not [cell for cell in path if matrix.is_on_edge(*cell)] and
+                self._out_of_band_bound(engine.reference(ref), query, matrix) <= max_value):
+                break
+            band_width = 2 * band_width or 1
+
+        cigar = _reduce_cigar(aln)
+
+        return Alignment(orig_query, orig_ref, row, col, cigar, max_value,
+                         ref_name, query_name, rc, self.wildcard)
+
+    ##############################################
+
+    def _out_of_band_bound(self, ref_scores, query, matrix):
+
+        ''' Return an upper bound of the score of the local alignments using a cell outside the
+        band of *matrix*: the best score of an edge cell plus a gap to leave the band, or 0 for an
+        alignment starting outside the band, plus the best score reachable from there.
+        '''
+
+        number_of_rows = matrix.number_of_rows
+        number_of_cols = matrix.number_of_cols
+
+        # best score of a query residue, and sum of them from a row to the end
+        best = {}
+        suffix = [0] * number_of_rows
+        for row in xrange(number_of_rows -1, 0, -1):
+            residue = query[row -1]
+            if residue not in best:
+                best[residue] = max([0] + ref_scores[residue])
+            suffix[row -1] = suffix[row] + best[residue]
+        max_score = max([0] + best.values())
+
+        def reachable(row, col):
+            # best score of an alignment starting after the cell (row, col)
+            return min(suffix[row],
+                       max_score * min(number_of_rows -1 - row, number_of_cols -1 - col))
+
+        gap = max(self.gap_penalty, self.gap_extension_penalty)
+        low = matrix.diagonal - matrix.band_width
+        high = matrix.diagonal + matrix.band_width
+
+        # alignments starting below or above the band, the best ones start at col 1 or row 1
+        bound = 0
+        row = max(1, 2 - low)
+        if row < number_of_rows and number_of_cols > 1:
+            bound = max(bound, reachable(row -1, 0))
+        col = max(1, 2 + high)
+        if col < number_of_cols and number_of_rows > 1:
+            bound = max(bound, reachable(0, col -1))
+
+        # alignments leaving the band by a deletion on its high edge or an insertion on its low one
+        for row in xrange(1, number_of_rows):
+            col = row + high
+            if 1 <= col < number_of_cols -1:
+                score = matrix.get(row, col).score
+                if score > 0:
+                    bound = max(bound, score + gap + reachable(row, col +1))
+            col = row + low
+            if 1 <= col < number_of_cols and row < number_of_rows -1:
+                score = matrix.get(row, col).score
+                if score > 0:
+                    bound = max(bound, score + gap + reachable(row +1, col))
+
+        return bound
+
+    ##############################################
+
+    def align_xdrop(self, ref, query, x_drop, z_drop=None,
+                    ref_name='ref', query_name='query', rc=False):
+
+        ''' Align *query* to *ref* with X-drop (and optionally BWA-style Z-drop) pruning: the
+        cells of a row are only computed around the cells of the previous row whose score is at
+        least the best score so far minus *x_drop*, and the rows are no longer computed when none
+        is left, or when the best score of a row drops by more than *z_drop* (plus the gap
+        extension penalty for each diagonal away from the best cell).  The cells not computed are
+        null.
+
+        The result is the one of :meth:`align` when the best alignment never drops below the
+        thresholds.  ``early_termination`` and ``cells_skipped`` are set in the
+        :class:`Alignment`.  The matrix is always computed by the Python engine.
+        '''
+
+        orig_ref = ref
+        orig_query = query
+
+        ref = _upper(ref)
+        query = _upper(query)
+
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+
+        engine = PythonEngine(self)
+        matrix, max_value, max_row, max_col, number_of_cells, stopped = engine.fill_xdrop(
+            ref, query, x_drop, z_drop)
+        if stats is not None:
+            filled = time.time()
+
+        row, col, aln, path = self._backtrack(engine, ref, query, matrix,
+                                             max_value, max_row, max_col)
+        if stats is not None:
+            backtracked = time.time()
+
+        alignment = Alignment(orig_query, orig_ref, row, col, _reduce_cigar(aln), max_value,
+                              ref_name, query_name, rc, self.wildcard)
+        alignment.early_termination = stopped
+        alignment.cells_skipped = len(ref) * len(query) - number_of_cells
+        if stats is not None:
+            self._record(start, filled, backtracked, number_of_cells, matrix,
+                         query_name, ref_name)
+
+        return alignment
+
+    ##############################################
+
+    def align_top(self, ref, query, number_of_hits=10, min_score=None,
+                  ref_name='ref', query_name='query', rc=False):
+
+        ''' Return up to *number_of_hits* non-overlapping local alignments of *query* against
+        *ref*, by decreasing score, from a single fill of the matrix.
+
+        Like Waterman-Eggert, two alignments overlap when their paths share a cell, i.e. they
+        align the same base of *query* to the same base of *ref*.  The end cells scoring at least
+        *min_score* (any positive score by default) and not extended by a match on their diagonal
+        are backtracked from the best one, the alignments crossing the path of an alignment already
+        found being discarded.  Unlike Waterman-Eggert, the matrix is not recomputed once a path is
+        removed, an alignment crossing a better one is not shortened but dropped.  The first
+        alignment is the one of :meth:`align`.
+        '''
+
+        orig_ref = ref
+        orig_query = query
+
+        ref = _upper(ref)
+        query = _upper(query)
+
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+
+        engine = self._engine
+        matrix = engine.fill_scores(ref, query)[0]
+        if stats is not None:
+            filled = time.time()
+
+        # like align, the last cell in row-major order wins ties
+        candidates = matrix.ends(min_score)
+
+        alignments = []
+        used = set()
+        for score, max_row, max_col in candidates:
+            if len(alignments) >= number_of_hits:
+                break
+            if (max_row, max_col) in used:
+                continue
+            # the backtrack stops at the path of an alignment already found
+            backtracked = engine.backtrack(matrix, max_row, max_col, stop=used)
+            if backtracked is None:
+                continue
+            row, col, aln, path = backtracked
+            if not aln:
+                continue
+            used.update(path)
+            alignments.append(Alignment(orig_query, orig_ref, row, col, _reduce_cigar(aln), score,
+                                        ref_name, query_name, rc, self.wildcard))
+
+        if stats is not None:
+            # the candidates and the backtracks are counted as traceback
+            self._record(start, filled, time.time(), len(ref) * len(query), matrix,
+                         query_name, ref_name)
+
+        return alignments
+
+    ##############################################
+
+    def align_linear(self, ref, query, ref_name='ref', query_name='query', rc=False):
+
+        ''' Align *query* to *ref* in O(len(ref) + len(query)) memory, for long sequences whose
+        matrix doesn't fit in memory, using the Hirschberg / Myers-Miller divide and conquer
+        algorithm of :mod:`swalign.hirschberg`.
+
+        The score is the one of the affine gap model of the 'gotoh' engine, whatever the engine of
+        the aligner, gap_extension_decay is not supported.  Requires NumPy.
+        '''
+
+        from .hirschberg import LinearSpaceAligner
+
+        row, col, aln, max_value = LinearSpaceAligner(self).align(_upper(ref), _upper(query))
+
+        return Alignment(query, ref, row, col, _reduce_cigar(aln), max_value,
+                         ref_name, query_name, rc, self.wildcard)
+
+    ##############################################
+
+    def _record(self, start, filled, backtracked, cells, matrix, query_name, ref_name):
+
+        # the phases of an alignment started at *start*, the matrix being filled at *filled* and
+        # backtracked at *backtracked*, the Alignment being built until now
+
+        end = time.time()
+        stats = self.stats
+        stats.add('fill', filled - start)
+        stats.add('traceback', backtracked - filled)
+        stats.add('alignment', end - backtracked)
+        stats.add_alignment(query_name, ref_name, end - start, cells, matrix_nbytes(matrix))
+
+    ##############################################
+
+    def _backtrack(self, engine, ref, query, matrix, max_value, max_row, max_col, mode='local'):
+
+        row, col, aln, path = engine.backtrack(matrix, max_row, max_col, mode)
+
         if self.verbose:
             print '-'*80
             self.dump_matrix(ref, query, matrix, path)
@@ -226,10 +1209,7 @@ class LocalAlignment(object):
             print 'max:', (max_row, max_col), max_value
             print '-'*80
 
-        cigar = _reduce_cigar(aln)
-
-        return Alignment(orig_query, orig_ref, row, col, cigar, max_value,
-                         ref_name, query_name, rc, self.wildcard)
+        return row, col, aln, path
 
     ##############################################
 
@@ -284,15 +1264,39 @@ def _cigar_str(cigar):
 
 ####################################################################################################
 
+def _mismatch_positions(query, ref, chunk=64):
+
+    ''' Return the positions where *query* and *ref*, of the same length, differ '''
+
+    if query == ref:
+        return []
+
+    # compare by chunks, only the chunks which differ are compared base by base
+    positions = []
+    for start in xrange(0, len(query), chunk):
+        query_chunk = query[start:start + chunk]
+        ref_chunk = ref[start:start + chunk]
+        if query_chunk != ref_chunk:
+            positions.extend(start + i
+                             for i, (one, two) in enumerate(itertools.izip(query_chunk, ref_chunk))
+                             if one != two)
+    return positions
+
+####################################################################################################
+
 class Alignment(object):
 
+    ''' Local alignment of a query against a reference.
+
+    The upper-case sequences, the statistics (matches, mismatches, identity) and the extended cigar
+    are computed on first access.
+    '''
+
     ##############################################
 
     def __init__(self, query, ref, q_pos, r_pos, cigar, score, ref_name='', query_name='',
                  rc=False, wildcard=None):
 
-        self.query = query
-        self.ref = ref
         self.q_pos = q_pos
         self.r_pos = r_pos
         self.cigar = cigar
@@ -305,48 +1309,91 @@ class Alignment(object):
         self.r_offset = 0
         self.r_region = None
 
-        self.orig_query = query
-        self.query = query.upper()
+        # set by LocalAlignment.align_xdrop
+        self.early_termination = False
+        self.cells_skipped = 0
 
+        self.orig_query = query
         self.orig_ref = ref
-        self.ref = ref.upper()
+        self._query = None
+        self._ref = None
 
         q_len = 0
         r_len = 0
-
-        self.matches = 0
-        self.mismatches = 0
-
-        i = self.r_pos
-        j = self.q_pos
-
         for count, op in self.cigar:
             if op == 'M':
                 q_len += count
                 r_len += count
-                for k in xrange(count):
-                    if self.query[j] == self.ref[i]:
-                        self.matches += 1
-                    else:
-                        self.mismatches += 1
-                    i += 1
-                    j += 1
-
             elif op == 'I':
                 q_len += count
-                j += count
-                self.mismatches += count
             elif op == 'D':
                 r_len += count
-                i += count
-                self.mismatches += count
 
         self.q_end = q_pos + q_len
         self.r_end = r_pos + r_len
-        if self.mismatches + self.matches > 0:
-            self.identity = float(self.matches) / (self.mismatches + self.matches)
+
+        self._mismatches = None
+        self._extended_cigar_str = None
+
+    ##############################################
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = self.orig_query.upper()
+        return self._query
+
+    @property
+    def ref(self):
+        if self._ref is None:
+            self._ref = self.orig_ref.upper()
+        return self._ref
+
+    ##############################################
+
+    def _blocks(self):
+
+        ''' Return the operations of the cigar as a list of ``(count, op, q_pos, r_pos,
+        mismatch_positions)``, the mismatch positions of the M operations being relative to the
+        start of the operation.
+        '''
+
+        if self._mismatches is None:
+            blocks = []
+            i = self.r_pos
+            j = self.q_pos
+            for count, op in self.cigar:
+                positions = None
+                if op == 'M':
+                    positions = _mismatch_positions(self.query[j:j + count], self.ref[i:i + count])
+                blocks.append((count, op, j, i, positions))
+                if op in 'MI':
+                    j += count
+                if op in 'MD':
+                    i += count
+            self._mismatches = blocks
+        return self._mismatches
+
+    ##############################################
+
+    @property
+    def matches(self):
+        return sum(count - len(positions)
+                   for count, op, j, i, positions in self._blocks() if op == 'M')
+
+    @property
+    def mismatches(self):
+        return sum(len(positions) if op == 'M' else count
+                   for count, op, j, i, positions in self._blocks() if op in 'MID')
+
+    @property
+    def identity(self):
+        matches = self.matches
+        mismatches = self.mismatches
+        if mismatches + matches > 0:
+            return float(matches) / (mismatches + matches)
         else:
-            self.identity = 0
+            return 0
 
     ##############################################
 
@@ -361,33 +1408,29 @@ class Alignment(object):
     @property
     def extended_cigar_str(self):
 
-        qpos = 0
-        rpos = 0
-        ext_cigar_str = ''
-        working = []
-        for count, op in self.cigar:
-            if op == 'M':
-                for k in xrange(count):
-                    if self.query[self.q_pos + qpos + k] == self.ref[self.r_pos + rpos + k]:
-                        ext_cigar_str += 'M'
-                    else:
-                        ext_cigar_str += 'X'
-                qpos += count
-                rpos += count
+        if self._extended_cigar_str is None:
+            operations = []
 
-            elif op == 'I':
-                qpos += count
-                ext_cigar_str += 'I' * count
-            elif op == 'D':
-                rpos += count
-                ext_cigar_str += 'D' * count
+            def add(count, op):
+                if operations and operations[-1][1] == op:
+                    operations[-1][0] += count
+                elif count:
+                    operations.append([count, op])
+
+            for count, op, j, i, positions in self._blocks():
+                if op == 'M':
+                    last = 0
+                    for position in positions:
+                        add(position - last, 'M')
+                        add(1, 'X')
+                        last = position +1
+                    add(count - last, 'M')
+                elif op in 'ID':
+                    add(count, op)
 
-            working = _reduce_cigar(ext_cigar_str)
+            self._extended_cigar_str = ''.join('%s%s' % (count, op) for count, op in operations)
 
-        out = ''
-        for num, op in working:
-            out += '%s%s' % (num, op)
-        return out
+        return self._extended_cigar_str
 
     ##############################################
 
@@ -399,50 +1442,43 @@ class Alignment(object):
 
     def dump(self, wrap=None, out=sys.stdout):
 
-        i = self.r_pos
-        j = self.q_pos
+        # the display strings are built from slices of the sequences and written by chunks of
+        # wrap columns
+        q = []
+        m = []
+        r = []
+        wildcard = self.wildcard
 
-        q = ''
-        m = ''
-        r = ''
-        qlen = 0
-        rlen = 0
-
-        for count, op in self.cigar:
+        for count, op, j, i, positions in self._blocks():
             if op == 'M':
-                qlen += count
-                rlen += count
-                for k in xrange(count):
-                    q += self.orig_query[j]
-                    r += self.orig_ref[i]
-                    if self.query[j] == self.ref[i] or (self.wildcard and
-                                                        (self.query[j] in self.wildcard or
-                                                         self.ref[i] in self.wildcard)):
-                        m += '|'
+                q.append(self.orig_query[j:j + count])
+                r.append(self.orig_ref[i:i + count])
+                last = 0
+                for position in positions:
+                    m.append('|' * (position - last))
+                    if wildcard and (self.query[j + position] in wildcard or
+                                     self.ref[i + position] in wildcard):
+                        m.append('|')
                     else:
-                        m += '.'
-
-                    i += 1
-                    j += 1
+                        m.append('.')
+                    last = position +1
+                m.append('|' * (count - last))
             elif op == 'D':
-                rlen += count
-                for k in xrange(count):
-                    q += '-'
-                    r += self.orig_ref[i]
-                    m += ' '
-                    i += 1
+                q.append('-' * count)
+                r.append(self.orig_ref[i:i + count])
+                m.append(' ' * count)
             elif op == 'I':
-                qlen += count
-                for k in xrange(count):
-                    q += self.orig_query[j]
-                    r += '-'
-                    m += ' '
-                    j += 1
-
+                q.append(self.orig_query[j:j + count])
+                r.append('-' * count)
+                m.append(' ' * count)
             elif op == 'N':
-                q += '-//-'
-                r += '-//-'
-                m += '    '
+                q.append('-//-')
+                r.append('-//-')
+                m.append('    ')
+
+        q = ''.join(q)
+        m = ''.join(m)
+        r = ''.join(r)
 
         if self.q_name:
             out.write('Query: %s%s (%s nt)\n' % (self.q_name, ' (reverse-compliment)'
@@ -468,42 +1504,23 @@ class Alignment(object):
         else:
             qpos = self.q_end
 
-        while q and r and m:
+        width = wrap or len(q)
+        for start in xrange(0, len(q), width or 1):
+            qfragment = q[start:start + width]
+            mfragment = m[start:start + width]
+            rfragment = r[start:start + width]
+
             if not self.rc:
                 out.write(q_pre % (qpos +1))  # pos is displayed as 1-based
             else:
                 out.write(q_pre % (qpos))  # revcomp is 1-based on the 3' end
 
-            if wrap:
-                qfragment = q[:wrap]
-                mfragment = m[:wrap]
-                rfragment = r[:wrap]
-
-                q = q[wrap:]
-                m = m[wrap:]
-                r = r[wrap:]
-            else:
-                qfragment = q
-                mfragment = m
-                rfragment = r
-
-                q = ''
-                m = ''
-                r = ''
-
             out.write(qfragment)
             if not self.rc:
-                for base in qfragment:
-                    if base != '-':
-                        qpos += 1
-            else:
-                for base in qfragment:
-                    if base != '-':
-                        qpos -= 1
-
-            if not self.rc:
+                qpos += len(qfragment) - qfragment.count('-')
                 out.write(' %s\n' % qpos)
             else:
+                qpos -= len(qfragment) - qfragment.count('-')
                 out.write(' %s\n' % (qpos +1))
 
             out.write(m_pre)
@@ -511,9 +1528,7 @@ class Alignment(object):
             out.write('\n')
             out.write(r_pre % (rpos + self.r_offset +1))
             out.write(rfragment)
-            for base in rfragment:
-                if base != '-':
-                    rpos += 1
+            rpos += len(rfragment) - rfragment.count('-')
             out.write(' %s\n\n' % (rpos + self.r_offset))
 
         out.write("Score: %s\n" % self.score)
@@ -0,0 +1,199 @@
+####################################################################################################
+
+''' Align a set of queries against a set of references using a pool of processes
+
+Each (query, reference, strand) alignment is a job, jobs are dispatched to the worker processes by
+chunks and the results are collected in the input order.  The queries are read once, by the main
+process, and only a few chunks are in flight at a time.  The workers send back the query with the
+coordinates, the cigar and the score, the :class:`swalign.Alignment` of the best hit of a query is
+rebuilt in the main process.
+
+'''
+
+####################################################################################################
+
+import collections
+import itertools
+import multiprocessing
+
+from . import Alignment
+from .removed import revcomp
+from .stats import AlignmentStats
+
+####################################################################################################
+
+# state of a worker, set by _init_worker
+_aligner = None
+_refs = None
+
+def _init_worker(aligner, refs):
+
+    global _aligner, _refs
+    _aligner = aligner
+    _refs = refs
+
+####################################################################################################
+
+def _align_job(job):
+
+    q_index, q_name, q_seq, r_index, strand = job
+    r_name, r_seq, r_comments = _refs[r_index]
+
+    if strand == '-':
+        aln = _aligner.align(r_seq, revcomp(q_seq), ref_name=r_name, query_name=q_name, rc=True)
+    else:
+        aln = _aligner.align(r_seq, q_seq, ref_name=r_name, query_name=q_name)
+
+    return q_index, q_name, q_seq, r_index, strand, aln.q_pos, aln.r_pos, aln.cigar, aln.score
+
+####################################################################################################
+
+def _align_top_job(job):
+
+    q_index, q_name, q_seq, r_index, strand, number_of_hits = job
+    r_name, r_seq, r_comments = _refs[r_index]
+
+    rc = strand == '-'
+    hits = _aligner.align_top(r_seq, revcomp(q_seq) if rc else q_seq, number_of_hits,
+                              ref_name=r_name, query_name=q_name, rc=rc)
+
+    return q_index, q_name, q_seq, [(r_index, strand, aln.q_pos, aln.r_pos, aln.cigar, aln.score)
+                                    for aln in hits]
+
+####################################################################################################
+
+def _run_chunk(func, jobs, measured):
+
+    # run a chunk of jobs in a worker, with new stats sent back with the results if *measured*
+
+    if not measured:
+        return [func(job) for job in jobs], None
+    _aligner.stats = AlignmentStats()
+    return [func(job) for job in jobs], _aligner.stats
+
+####################################################################################################
+
+def _map_jobs(func, aligner, refs, jobs, processes, chunksize):
+
+    ''' Yield the results of *func* over *jobs*, in order, in the current process if *processes* is
+    1.  The stats of the workers are merged in the ones of *aligner*, if any.
+
+    *jobs* is only read by the calling thread, by chunks of *chunksize* jobs, and at most two chunks
+    per worker are pending, so the queries are streamed rather than read ahead.
+    '''
+
+    stats = aligner.stats
+    if processes == 1:
+        _init_worker(aligner, refs)
+        for result in itertools.imap(func, jobs):
+            yield result
+        return
+
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker, (aligner, refs))
+    pending = collections.deque()
+    jobs = iter(jobs)
+    try:
+        while True:
+            while len(pending) < 2 * processes:
+                chunk = list(itertools.islice(jobs, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(_run_chunk, (func, chunk, stats is not None)))
+            if not pending:
+                break
+            results, job_stats = pending.popleft().get()
+            if job_stats is not None:
+                stats.merge(job_stats)
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+####################################################################################################
+
+def _alignment(aligner, refs, q_name, q_seq, r_index, strand, q_pos, r_pos, cigar, score):
+
+    r_name, r_seq, r_comments = refs[r_index]
+    rc = strand == '-'
+    if rc:
+        q_seq = revcomp(q_seq)
+    aln = Alignment(q_seq, r_seq, q_pos, r_pos, cigar, score, r_name, q_name, rc,
+                    aligner.wildcard)
+    return aln, r_comments
+
+####################################################################################################
+
+def align_batch(aligner, queries, refs, processes=None, chunksize=1, strands='+-'):
+
+    ''' Align each query against each reference on each strand and yield the best hit of each query,
+    in input order, as a tuple ``(alignment, ref_comments)``.
+
+    *queries* and *refs* are iterables of ``(name, seq, comments)`` tuples, like the generators
+    returned by :func:`fasta_gen`.  *queries* is read once, as the jobs are dispatched.  *processes*
+    is the number of worker processes, the number of CPUs if None, the alignments are done in the
+    current process if it is 1.  *chunksize* is the number of jobs sent at once to a worker.
+
+    Like the command-line tool, the best hit is the first alignment with the highest score in the
+    order of the references and of the strands.  If there is no reference, the alignment is None.
+    '''
+
+    refs = list(refs)
+    if not refs:
+        for query in queries:
+            yield None, None
+        return
+
+    def jobs():
+        for q_index, (q_name, q_seq, q_comments) in enumerate(queries):
+            for r_index in xrange(len(refs)):
+                for strand in strands:
+                    yield q_index, q_name, q_seq, r_index, strand
+
+    results = _map_jobs(_align_job, aligner, refs, jobs(), processes, chunksize)
+    try:
+        for q_index, query_results in itertools.groupby(results, lambda result: result[0]):
+            best = None
+            for result in query_results:
+                if not best or result[-1] > best[-1]:
+                    best = result
+            yield _alignment(aligner, refs, *best[1:])
+    finally:
+        results.close()
+
+####################################################################################################
+
+def align_batch_top(aligner, queries, refs, number_of_hits, processes=None, chunksize=1,
+                    strands='+-'):
+
+    ''' Like :func:`align_batch`, but yield for each query the list of its *number_of_hits* best
+    hits across the references and the strands, as ``(alignment, ref_comments)`` tuples by
+    decreasing score.  The hits against a reference on a strand are the non-overlapping
+    alignments of :meth:`LocalAlignment.align_top`, ties are kept in the order of the references
+    and of the strands.
+    '''
+
+    refs = list(refs)
+    if not refs:
+        for query in queries:
+            yield []
+        return
+
+    def jobs():
+        for q_index, (q_name, q_seq, q_comments) in enumerate(queries):
+            for r_index in xrange(len(refs)):
+                for strand in strands:
+                    yield q_index, q_name, q_seq, r_index, strand, number_of_hits
+
+    results = _map_jobs(_align_top_job, aligner, refs, jobs(), processes, chunksize)
+    try:
+        for q_index, query_results in itertools.groupby(results, lambda result: result[0]):
+            hits = []
+            for q_index, q_name, q_seq, query_hits in query_results:
+                hits.extend(query_hits)
+            hits.sort(key=lambda hit: -hit[-1])
+
+            yield [_alignment(aligner, refs, q_name, q_seq, *hit) for hit in hits[:number_of_hits]]
+    finally:
+        results.close()
@@ -0,0 +1,337 @@
+####################################################################################################
+
+''' Benchmark of the alignment engines on synthetic sequences
+
+The queries are mutated copies of a region of random references, generated for a grid of query and
+reference lengths, mutation rates, with or without wildcards in the reference and on both strands.
+Each engine is run in its own process, so that its peak memory can be measured, and reports for
+each case the wall time of :meth:`LocalAlignment.align` and of :meth:`LocalAlignment.score_only`
+(the difference being the cost of the backtrack and of building the :class:`Alignment`) and the
+number of matrix cells computed per second.
+
+The 'python' engine is run without its bit-parallel fast path, the 'bitparallel' engine being
+benchmarked on its own: it only differs from 'python' with ``-match 1 -mismatch -1``.
+
+The results are saved as JSON, two result files can be compared to flag the regressions::
+
+    python -m swalign.benchmark -o before.json
+    python -m swalign.benchmark -o after.json -compare before.json
+    python -m swalign.benchmark -engines python,bitparallel -match 1 -mismatch -1
+
+'''
+
+####################################################################################################
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+from . import LocalAlignment, NucleotideScoringMatrix
+from .removed import revcomp
+
+####################################################################################################
+
+ENGINES = ('python', 'numpy', 'profile', 'gotoh')
+
+QUERY_LENGTHS = (50, 200)
+REF_LENGTHS = (200, 500)
+MUTATION_RATES = (0.02, 0.1, 0.25)
+WILDCARDS = (None, 'N')
+STRANDS = '+-'
+
+# fraction of the reference bases replaced by the wildcard
+WILDCARD_RATE = 0.02
+
+####################################################################################################
+
+def mutate(seq, rate, rng, bases='ACGT'):
+
+    ''' Return a copy of *seq* with substitutions, insertions and deletions, each one at a third of
+    *rate*.
+    '''
+
+    out = []
+    for base in seq:
+        x = rng.random()
+        if x >= rate:
+            out.append(base)
+        elif x < rate / 3:
+            continue
+        elif x < 2 * rate / 3:
+            out.append(rng.choice(bases))
+            out.append(base)
+        else:
+            out.append(rng.choice(bases.replace(base, '')))
+    return ''.join(out)
+
+####################################################################################################
+
+def synthetic_cases(query_lengths=QUERY_LENGTHS, ref_lengths=REF_LENGTHS,
+                    mutation_rates=MUTATION_RATES, wildcards=WILDCARDS, strands=STRANDS, seed=0):
+
+    ''' Return the list of benchmark cases as dicts, the sequences only depend on *seed* '''
+
+    rng = random.Random(seed)
+    cases = []
+    for ref_length in ref_lengths:
+        for query_length in query_lengths:
+            for mutation_rate in mutation_rates:
+                for wildcard in wildcards:
+                    for strand in strands:
+                        ref = [rng.choice('ACGT') for i in xrange(ref_length)]
+                        if wildcard:
+                            for i in xrange(ref_length):
+                                if rng.random() < WILDCARD_RATE:
+                                    ref[i] = wildcard
+                        ref = ''.join(ref)
+                        start = rng.randint(0, max(0, ref_length - query_length))
+                        query = mutate(ref[start:start + query_length], mutation_rate, rng)
+                        if strand == '-':
+                            query = revcomp(query)
+                        cases.append(dict(ref=ref, query=query,
+                                          query_length=query_length, ref_length=ref_length,
+                                          mutation_rate=mutation_rate, wildcard=wildcard,
+                                          strand=strand))
+    return cases
+
+####################################################################################################
+
+def _case_key(result):
+    return (result['engine'], result['query_length'], result['ref_length'],
+            result['mutation_rate'], result['wildcard'], result['strand'])
+
+####################################################################################################
+
+def _timed(func, repeat):
+
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        value = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return value, best
+
+####################################################################################################
+
+def run_engine(engine, cases, repeat=1, match=2, mismatch=-1, gap_penalty=-1,
+               gap_extension_penalty=-1):
+
+    ''' Run the benchmark *cases* with *engine* in the current process and return a dict with the
+    results of each case and a summary.
+    '''
+
+    scoring = NucleotideScoringMatrix(match, mismatch)
+    aligners = {}
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = []
+    for case in cases:
+        wildcard = case['wildcard']
+        if wildcard not in aligners:
+            aligners[wildcard] = LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                                wildcard=wildcard, engine=engine,
+                                                bit_parallel=False)
+        aligner = aligners[wildcard]
+
+        ref = case['ref']
+        query = case['query']
+        if case['strand'] == '-':
+            query = revcomp(query)
+
+        aln, align_seconds = _timed(lambda: aligner.align(ref, query), repeat)
+        score, score_seconds = _timed(lambda: aligner.score_only(ref, query), repeat)
+
+        cells = len(ref) * len(query)
+        result = dict((name, case[name]) for name in ('query_length', 'ref_length',
+                                                      'mutation_rate', 'wildcard', 'strand'))
+        result.update(engine=engine, cells=cells, score=aln.score, cigar=aln.cigar_str,
+                      align_seconds=align_seconds, score_seconds=score_seconds,
+                      cells_per_second=cells / align_seconds if align_seconds else None)
+        results.append(result)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on Mac OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+        start_rss //= 1024
+
+    cells = sum(result['cells'] for result in results)
+    seconds = sum(result['align_seconds'] for result in results)
+    summary = dict(engine=engine, cells=cells, align_seconds=seconds,
+                   score_seconds=sum(result['score_seconds'] for result in results),
+                   cells_per_second=cells / seconds if seconds else None,
+                   peak_rss_kb=peak_rss, rss_increase_kb=peak_rss - start_rss)
+
+    return dict(results=results, summary=summary)
+
+####################################################################################################
+
+def _run_engine_job(args):
+
+    engine, cases, kwargs = args
+    try:
+        return run_engine(engine, cases, **kwargs)
+    except ImportError as e:
+        return dict(error=str(e))
+
+####################################################################################################
+
+def run(engines=ENGINES, cases=None, repeat=1, **kwargs):
+
+    ''' Run the benchmark for each engine, each one in a new process, and return the results as a
+    dict ready to be saved as JSON.  Engines which cannot be imported are reported in ``skipped``.
+    '''
+
+    if cases is None:
+        cases = synthetic_cases()
+
+    benchmark = dict(created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     python=platform.python_version(),
+                     platform=platform.platform(),
+                     repeat=repeat,
+                     parameters=kwargs,
+                     results=[],
+                     summary={},
+                     skipped={})
+    try:
+        import numpy
+        benchmark['numpy'] = numpy.__version__
+    except ImportError:
+        benchmark['numpy'] = None
+
+    for engine in engines:
+        pool = multiprocessing.Pool(1)
+        try:
+            output = pool.apply(_run_engine_job, ((engine, cases, dict(kwargs, repeat=repeat)),))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if 'error' in output:
+            benchmark['skipped'][engine] = output['error']
+            continue
+        benchmark['results'].extend(output['results'])
+        benchmark['summary'][engine] = output['summary']
+
+    return benchmark
+
+####################################################################################################
+
+def compare(old, new, threshold=0.1):
+
+    ''' Compare two benchmark results and return a list of messages for the regressions: a case
+    slower by more than *threshold* (a fraction), a summary peak memory higher by more than
+    *threshold* or an alignment with a different score or cigar.
+    '''
+
+    regressions = []
+
+    old_results = dict((_case_key(result), result) for result in old['results'])
+    for result in new['results']:
+        key = _case_key(result)
+        old_result = old_results.get(key)
+        if old_result is None:
+            continue
+        name = '%s q=%s r=%s rate=%s wildcard=%s strand=%s' % key
+        if (old_result['score'], old_result['cigar']) != (result['score'], result['cigar']):
+            regressions.append('%s: alignment changed, score %s -> %s, cigar %s -> %s' %
+                               (name, old_result['score'], result['score'],
+                                old_result['cigar'], result['cigar']))
+        old_speed = old_result['cells_per_second']
+        speed = result['cells_per_second']
+        if old_speed and speed and speed < old_speed * (1 - threshold):
+            regressions.append('%s: %.0f -> %.0f cells/s (%+.1f%%)' %
+                               (name, old_speed, speed, 100. * (speed - old_speed) / old_speed))
+
+    for engine, summary in sorted(new['summary'].items()):
+        old_summary = old['summary'].get(engine)
+        if old_summary is None:
+            continue
+        old_speed = old_summary['cells_per_second']
+        speed = summary['cells_per_second']
+        if old_speed and speed and speed < old_speed * (1 - threshold):
+            regressions.append('%s: total %.0f -> %.0f cells/s (%+.1f%%)' %
+                               (engine, old_speed, speed, 100. * (speed - old_speed) / old_speed))
+        old_memory = old_summary['rss_increase_kb']
+        memory = summary['rss_increase_kb']
+        if memory > max(old_memory * (1 + threshold), old_memory + 1024):
+            regressions.append('%s: memory %s -> %s kB' % (engine, old_memory, memory))
+
+    return regressions
+
+####################################################################################################
+
+def report(benchmark, out=sys.stdout):
+
+    out.write('%-8s %12s %10s %10s %14s %10s\n' % ('engine', 'cells', 'align (s)', 'score (s)',
+                                                  'cells/s', 'peak (kB)'))
+    for engine, summary in sorted(benchmark['summary'].items()):
+        out.write('%-8s %12d %10.3f %10.3f %14.0f %10d\n' %
+                  (engine, summary['cells'], summary['align_seconds'], summary['score_seconds'],
+                   summary['cells_per_second'] or 0, summary['peak_rss_kb']))
+    for engine, error in sorted(benchmark['skipped'].items()):
+        out.write('%-8s skipped: %s\n' % (engine, error))
+
+####################################################################################################
+
+def _int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def _float_list(text):
+    return [float(x) for x in text.split(',')]
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark of the swalign engines')
+    parser.add_argument('-o', dest='output', metavar='FILE',
+                        help='Write the results to FILE (JSON)')
+    parser.add_argument('-compare', metavar='FILE',
+                        help='Compare the results to a previous run and exit with status 1 if '
+                        'there are regressions')
+    parser.add_argument('-threshold', type=float, default=0.1,
+                        help='Slowdown tolerated by -compare, as a fraction (default: 0.1)')
+    parser.add_argument('-engines', default=','.join(ENGINES),
+                        help='Comma-separated engines (default: %(default)s)')
+    parser.add_argument('-qlen', type=_int_list, default=QUERY_LENGTHS,
+                        help='Comma-separated query lengths')
+    parser.add_argument('-rlen', type=_int_list, default=REF_LENGTHS,
+                        help='Comma-separated reference lengths')
+    parser.add_argument('-rates', type=_float_list, default=MUTATION_RATES,
+                        help='Comma-separated mutation rates')
+    parser.add_argument('-repeat', type=int, default=1,
+                        help='Keep the best time of N runs of each case (default: 1)')
+    parser.add_argument('-seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('-match', type=int, default=2, help='Match score (default: 2)')
+    parser.add_argument('-mismatch', type=int, default=-1, help='Mismatch score (default: -1)')
+    args = parser.parse_args(argv)
+
+    cases = synthetic_cases(args.qlen, args.rlen, args.rates, seed=args.seed)
+    benchmark = run(args.engines.split(','), cases, args.repeat,
+                    match=args.match, mismatch=args.mismatch)
+    benchmark['seed'] = args.seed
+    report(benchmark)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, benchmark, args.threshold)
+        for message in regressions:
+            sys.stdout.write('REGRESSION %s\n' % message)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+####################################################################################################
+
+''' Bit-parallel engine for unit scores
+
+With an :class:`IdentityScoringMatrix` scoring a match 1 and a mismatch -1 and gap penalties of -1,
+the scores of a column of the local alignment matrix are small integers which are computed all at
+once with bitwise operations, in the spirit of the bit-vector algorithms of Myers and Hyyro.  The
+differences between adjacent cells range from -1 to 2, so instead of Myers' difference vectors the
+scores are bit-sliced: the integer *k* of a column holds the bit *k* of the score of each row, row
+*i* being the bit *i - 1*.  Python integers hold a whole column, not only 64 rows.
+
+A column is computed from the previous one as the maximum of the diagonal (incremented on the rows
+matching the reference residue, decremented on the other ones) and of the cell on the left minus
+one, then the gaps along the column are resolved by shifting the column down until no cell is
+improved, like the lazy loop of the striped Smith-Waterman.  Only as many integers as the bits of
+the best score so far plus one are used.
+
+The scores are the ones of :class:`PythonEngine`, which it falls back to for any other parameters,
+alignment mode, or in verbose mode.  The operations of the traceback and the gap run lengths are
+computed on demand from the scores, reproducing the choices of :meth:`PythonEngine._cell` between
+equal scores.  :meth:`LocalAlignment.align_top`, which reads every cell, uses the Python fill.
+
+'''
+
+####################################################################################################
+
+from . import IdentityScoringMatrix, MatrixCell, PythonEngine
+
+####################################################################################################
+
+def _decrement(planes):
+
+    ''' Return the bit-sliced scores *planes* minus one, floored to 0 '''
+
+    borrow = 0
+    for plane in planes:
+        borrow |= plane
+    result = []
+    for plane in planes:
+        result.append(plane ^ borrow)
+        borrow &= ~plane
+    return result
+
+####################################################################################################
+
+def _greater(one, two, rows):
+
+    ''' Return the mask of the *rows* where the scores *two* are greater than *one* '''
+
+    greater = 0
+    equal = rows
+    for k in xrange(len(one) -1, -1, -1):
+        differ = one[k] ^ two[k]
+        greater |= equal & differ & two[k]
+        equal &= ~differ
+        if not equal:
+            break
+    return greater
+
+####################################################################################################
+
+def _select(one, two, rows):
+
+    ''' Return the scores *two* on *rows* and *one* elsewhere '''
+
+    return [x ^ ((x ^ y) & rows) for x, y in zip(one, two)]
+
+####################################################################################################
+
+class BitMatrix(object):
+
+    ''' Matrix of :class:`BitParallelEngine`: the bit-sliced scores of each column.  The
+    operations and the gap run lengths are only computed for the cells with a positive score, the
+    ones of a traceback, each cell being rebuilt from the bits of its column.
+    '''
+
+    ##############################################
+
+    def __init__(self, aligner, ref, query, columns):
+
+        self.number_of_rows = len(query) +1
+        self.number_of_cols = len(ref) +1
+        self._aligner = aligner
+        self._ref = ref
+        self._query = query
+        self._columns = columns
+        self._scores = {}
+        self._operations = {}
+        self._run_lengths = {}
+
+    ##############################################
+
+    @property
+    def nbytes(self):
+        return sum(len(column) for column in self._columns) * ((len(self._query) +7) // 8)
+
+    ##############################################
+
+    def score(self, row, col):
+
+        if not row or not col:
+            return 0
+        value = self._scores.get((row, col))
+        if value is None:
+            value = 0
+            shift = row -1
+            for k, plane in enumerate(self._columns[col -1]):
+                value |= ((plane >> shift) & 1) << k
+            # the planes are long integers
+            value = self._scores[row, col] = int(value)
+        return value
+
+    ##############################################
+
+    def _operation(self, row, col):
+
+        ''' Return the operation of the cell of positive score at (*row*, *col*), the one of a gap
+        depending on the operation of the previous cell of the gap if it scores one more, and its
+        run length, like :meth:`PythonEngine._cell`.
+        '''
+
+        aligner = self._aligner
+        operations = self._operations
+        run_lengths = self._run_lengths
+        prefer_gap_runs = aligner.prefer_gap_runs
+
+        # resolve the cells the operation depends on first
+        stack = [(row, col)]
+        while stack:
+            row, col = stack[-1]
+            if (row, col) in operations:
+                stack.pop()
+                continue
+
+            value = self.score(row, col)
+            deletion = self.score(row, col -1) -1 == value
+            insertion = self.score(row -1, col) -1 == value
+
+            if prefer_gap_runs and deletion:
+                left = operations.get((row, col -1))
+                if left is None:
+                    stack.append((row, col -1))
+                    continue
+                if left == 'd':
+                    operations[row, col] = 'd'
+                    run_lengths[row, col] = run_lengths[row, col -1] +1
+                    stack.pop()
+                    continue
+            if prefer_gap_runs and insertion:
+                up = operations.get((row -1, col))
+                if up is None:
+                    stack.append((row -1, col))
+                    continue
+                if up == 'i':
+                    operations[row, col] = 'i'
+                    run_lengths[row, col] = run_lengths[row -1, col] +1
+                    stack.pop()
+                    continue
+
+            match = aligner.scoring_matrix.score(self._query[row -1], self._ref[col -1],
+                                                 aligner.wildcard)
+            if self.score(row -1, col -1) + match == value:
+                op = 'm'
+            elif deletion:
+                op = 'd'
+            elif insertion:
+                op = 'i'
+            else:
+                op = 'x'
+            operations[row, col] = op
+            run_lengths[row, col] = 1 if op in 'di' else 0
+            stack.pop()
+
+        return operations[row, col], run_lengths[row, col]
+
+    ##############################################
+
+    def get(self, row, col):
+
+        if not row:
+            return MatrixCell(0, 'd', 0)
+        elif not col:
+            return MatrixCell(0, 'i', 0)
+        value = self.score(row, col)
+        if value <= 0:
+            return MatrixCell(0, 'x', 0)
+        op, run_length = self._operation(row, col)
+        return MatrixCell(value, op, run_length)
+
+####################################################################################################
+
+class BitParallelEngine(PythonEngine):
+
+    ''' Bit-parallel engine for match 1, mismatch -1 and gap penalties of -1, see the module '''
+
+    ##############################################
+
+    def supports(self, mode='local'):
+
+        ''' Return whether the parameters of the aligner allow the bit-parallel fill '''
+
+        aligner = self._aligner
+        scoring_matrix = aligner.scoring_matrix
+        return (mode == 'local' and not aligner.verbose
+                and type(scoring_matrix) is IdentityScoringMatrix
+                and scoring_matrix._match == 1 and scoring_matrix._mismatch == -1
+                and aligner.gap_penalty == -1 and aligner.gap_extension_penalty == -1)
+
+    ##############################################
+
+    def _match_masks(self, ref, query):
+
+        ''' Return the mask of the rows matching each residue of *ref* '''
+
+        aligner = self._aligner
+
+        rows = {}
+        for i, residue in enumerate(query):
+            rows[residue] = rows.get(residue, 0) | (1 << i)
+
+        masks = {}
+        for residue in set(ref):
+            mask = 0
+            for query_residue, query_rows in rows.iteritems():
+                if aligner.scoring_matrix.score(query_residue, residue, aligner.wildcard) > 0:
+                    mask |= query_rows
+            masks[residue] = mask
+        return masks
+
+    ##############################################
+
+    def _fill_columns(self, ref, query, columns=None):
+
+        ''' Compute the columns of scores, appended to *columns* if given, and return the best
+        score and its cell, the last one in row-major order like :meth:`PythonEngine._fill`.
+        '''
+
+        if not query or not ref:
+            return 0, 0, 0
+
+        rows = (1 << len(query)) -1
+        masks = self._match_masks(ref, query)
+
+        max_value = 0
+        max_row = 0
+        max_col = 0
+
+        planes = []
+        for col, residue in enumerate(ref):
+            # a score is at most the best one so far plus one
+            width = (max_value +1).bit_length()
+            if len(planes) < width:
+                planes = planes + [0] * (width - len(planes))
+
+            # diagonal, the row 0 scoring 0
+            diagonal = [(plane << 1) & rows for plane in planes]
+            matches = masks[residue]
+            carry = matches
+            borrow = 0
+            for plane in diagonal:
+                borrow |= plane
+            borrow &= ~matches
+            scores = []
+            for plane in diagonal:
+                scores.append(plane ^ carry ^ borrow)
+                carry &= plane
+                borrow &= ~plane
+
+            # deletion, from the left
+            left = _decrement(planes)
+            scores = _select(scores, left, _greater(scores, left, rows))
+
+            # insertions, from above, until no cell is improved
+            while True:
+                up = _decrement([(plane << 1) & rows for plane in scores])
+                greater = _greater(scores, up, rows)
+                if not greater:
+                    break
+                scores = _select(scores, up, greater)
+
+            # best score of the column and its last row
+            best_rows = rows
+            value = 0
+            for k in xrange(len(scores) -1, -1, -1):
+                candidates = best_rows & scores[k]
+                if candidates:
+                    best_rows = candidates
+                    value |= 1 << k
+            row = best_rows.bit_length()
+            if value > max_value or (value == max_value and row >= max_row):
+                max_value = value
+                max_row = row
+                max_col = col +1
+
+            if columns is not None:
+                columns.append(scores)
+            planes = scores
+
+        return max_value, max_row, max_col
+
+    ##############################################
+
+    def fill(self, ref, query, mode='local'):
+
+        if not self.supports(mode):
+            return PythonEngine.fill(self, ref, query, mode)
+
+        columns = []
+        max_value, max_row, max_col = self._fill_columns(ref, query, columns)
+        return BitMatrix(self._aligner, ref, query, columns), max_value, max_row, max_col
+
+    ##############################################
+
+    def fill_scores(self, ref, query):
+
+        # the cells of a BitMatrix are rebuilt bit by bit, too slow to read them all
+        return PythonEngine.fill(self, ref, query)
+
+    ##############################################
+
+    def score(self, ref, query, mode='local'):
+
+        if not self.supports(mode):
+            return PythonEngine.score(self, ref, query, mode)
+        return self._fill_columns(ref, query)
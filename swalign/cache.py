@@ -0,0 +1,104 @@
+####################################################################################################
+
+''' Least recently used cache bounded by its number of entries and by its size in bytes '''
+
+####################################################################################################
+
+import collections
+
+####################################################################################################
+
+def _sizeof(key, value):
+    return len(key) + len(value)
+
+####################################################################################################
+
+class LRUCache(object):
+
+    ''' Cache keeping at most *max_entries* entries and *max_bytes* bytes, as measured by
+    ``sizeof(key, value)``, the least recently used entries being evicted first.  A value larger
+    than *max_bytes* is not cached.
+    '''
+
+    ##############################################
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 2**20, sizeof=_sizeof):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._items = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    ##############################################
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    ##############################################
+
+    @property
+    def stats(self):
+
+        return dict(entries=len(self._items), bytes=self.bytes, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+    ##############################################
+
+    def get(self, key, default=None):
+
+        value = self._items.pop(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._items[key] = value
+        return value
+
+    ##############################################
+
+    def put(self, key, value):
+
+        if key in self._items:
+            self.bytes -= self._sizeof(key, self._items.pop(key))
+
+        size = self._sizeof(key, value)
+        if size > self.max_bytes or not self.max_entries:
+            return
+
+        self._items[key] = value
+        self.bytes += size
+        self._evict()
+
+    ##############################################
+
+    def resize(self, max_entries=None, max_bytes=None):
+
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._evict()
+
+    ##############################################
+
+    def clear(self):
+
+        self._items.clear()
+        self.bytes = 0
+
+    ##############################################
+
+    def _evict(self):
+
+        while self._items and (len(self._items) > self.max_entries or self.bytes > self.max_bytes):
+            key, value = self._items.popitem(last=False)
+            self.bytes -= self._sizeof(key, value)
+            self.evictions += 1
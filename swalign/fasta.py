@@ -0,0 +1,260 @@
+####################################################################################################
+
+''' Memory-mapped FASTA reader with samtools-style index (.fai)
+
+The file is memory-mapped and indexed once, either by reading ``filename.fai`` or by scanning the
+file, then sequences and regions are read by slicing the map: a sequence is copied once, without
+the newlines, instead of being concatenated line by line.
+
+'''
+
+####################################################################################################
+
+import mmap
+import os
+
+from .cache import LRUCache
+from .sequence import EncodedSequence
+
+####################################################################################################
+
+class FastaRecord(object):
+
+    ''' Entry of a FASTA index: the fields of a samtools .fai line.
+
+    *offset* is the position of the first base in the file, *line_bases* the number of bases per
+    line and *line_width* the number of bytes per line including the newline.  *line_bases* is 0 if
+    the lines of the record don't have the same length, the record can then only be read as a
+    whole.
+    '''
+
+    ##############################################
+
+    def __init__(self, name, length, offset, line_bases, line_width, comments=None):
+
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+        self.comments = comments
+
+    ##############################################
+
+    def position(self, pos):
+
+        ''' Return the offset in the file of the base at *pos* '''
+
+        return self.offset + (pos // self.line_bases) * self.line_width + pos % self.line_bases
+
+####################################################################################################
+
+class FastaFile(object):
+
+    ''' Random access to the sequences of a FASTA file.
+
+    If ``filename.fai`` exists and is not older than the file, it is used as index, else the file
+    is scanned and the index is written if *write_index* is set.  If *encoded* is set, the
+    sequences are returned as :class:`EncodedSequence`, the last whole sequences fetched, up to
+    about *cache_bytes* bases, being kept so that they are encoded only once.
+    '''
+
+    ##############################################
+
+    def __init__(self, filename, write_index=False, encoded=False, cache_bytes=64 * 2**20):
+
+        self.filename = filename
+        self.index_filename = filename + '.fai'
+        self.encoded = encoded
+        self._encoded_sequences = LRUCache(max_bytes=cache_bytes)
+
+        self._file = open(filename, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+        if (os.path.exists(self.index_filename) and
+            os.path.getmtime(self.index_filename) >= os.path.getmtime(filename)):
+            self.records = self._read_index()
+        else:
+            self.records = self._build_index()
+            if write_index:
+                self.write_index()
+
+        self._records = dict((record.name, record) for record in self.records)
+
+    ##############################################
+
+    def close(self):
+
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    ##############################################
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ##############################################
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    @property
+    def names(self):
+        return [record.name for record in self.records]
+
+    ##############################################
+
+    def _build_index(self):
+
+        records = []
+        record = None
+        line_lengths = []
+        data = self._map
+        pos = 0
+        size = len(data)
+
+        while pos < size:
+            end = data.find('\n', pos)
+            if end < 0:
+                end = size
+            next_pos = end +1
+
+            if data[pos] == '>':
+                if record is not None:
+                    self._set_lines(record, line_lengths)
+                spl = data[pos +1:end].strip().split(' ', 1)
+                record = FastaRecord(spl[0], 0, next_pos, 0, 0, spl[1] if len(spl) > 1 else '')
+                records.append(record)
+                line_lengths = []
+            elif record is not None:
+                line = data[pos:end].rstrip('\r')
+                record.length += len(line)
+                line_lengths.append((len(line), next_pos - pos))
+
+            pos = next_pos
+
+        if record is not None:
+            self._set_lines(record, line_lengths)
+
+        return records
+
+    ##############################################
+
+    @staticmethod
+    def _set_lines(record, line_lengths):
+
+        # all lines but the last must have the same length to compute positions, blank lines at the
+        # end of the record are ignored
+        while line_lengths and not line_lengths[-1][0]:
+            line_lengths.pop()
+        if line_lengths:
+            record.line_bases, record.line_width = line_lengths[0]
+            for line_bases, line_width in line_lengths[1:-1]:
+                if line_bases != record.line_bases:
+                    record.line_bases = 0
+                    break
+            if len(line_lengths) > 1 and line_lengths[-1][0] > record.line_bases:
+                record.line_bases = 0
+
+    ##############################################
+
+    def _read_index(self):
+
+        records = []
+        with open(self.index_filename) as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                records.append(FastaRecord(cols[0], *[int(x) for x in cols[1:5]]))
+        return records
+
+    ##############################################
+
+    def write_index(self):
+
+        with open(self.index_filename, 'w') as f:
+            for record in self.records:
+                f.write('%s\t%s\t%s\t%s\t%s\n' % (record.name, record.length, record.offset,
+                                                  record.line_bases, record.line_width))
+
+    ##############################################
+
+    def comments(self, name):
+
+        ''' Return the comments of the header line of a sequence '''
+
+        record = self._records[name]
+        if record.comments is None:
+            # read the header line preceding the sequence
+            start = self._map.rfind('\n', 0, max(0, record.offset -1)) +1
+            spl = self._map[start +1:record.offset].strip().split(' ', 1)
+            record.comments = spl[1] if len(spl) > 1 else ''
+        return record.comments
+
+    ##############################################
+
+    def fetch(self, name, start=None, end=None):
+
+        ''' Return the sequence *name* or its region [*start*, *end*[ (0-based) '''
+
+        if self.encoded:
+            if start is None and end is None:
+                sequence = self._encoded_sequences.get(name)
+                if sequence is None:
+                    sequence = EncodedSequence(self._fetch(name))
+                    self._encoded_sequences.put(name, sequence)
+                return sequence
+            return EncodedSequence(self._fetch(name, start, end))
+
+        return self._fetch(name, start, end)
+
+    ##############################################
+
+    def _fetch(self, name, start=None, end=None):
+
+        record = self._records[name]
+        start = 0 if start is None else max(0, start)
+        end = record.length if end is None else min(end, record.length)
+        if start >= end:
+            return ''
+
+        if not record.line_bases:
+            # lines of different lengths, read the whole sequence
+            end_offset = self._map.find('>', record.offset)
+            if end_offset < 0:
+                end_offset = len(self._map)
+            return self._map[record.offset:end_offset].translate(None, '\r\n')[start:end]
+
+        return self._map[record.position(start):record.position(end -1) +1].translate(None, '\r\n')
+
+    ##############################################
+
+    def __iter__(self):
+
+        # like fasta_gen, empty sequences are skipped
+        for record in self.records:
+            if record.length:
+                yield record.name, self.fetch(record.name), self.comments(record.name)
+
+    ##############################################
+
+    def generator(self):
+
+        ''' Return a generator function like :func:`fasta_gen` '''
+
+        def gen():
+            return iter(self)
+
+        return gen
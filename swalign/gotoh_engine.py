@@ -0,0 +1,437 @@
+####################################################################################################
+
+''' Affine gap Smith-Waterman engine using the Gotoh recurrences
+
+Three layers are computed: *E* for the deletions (gaps in the query), *F* for the insertions (gaps
+in the reference) and *H* for the best score::
+
+    E[i,j] = max(H[i,j-1] + gap_penalty, E[i,j-1] + extension(E run))
+    F[i,j] = max(H[i-1,j] + gap_penalty, F[i-1,j] + extension(F run))
+    H[i,j] = max(0, H[i-1,j-1] + score(query[i-1], ref[j-1]), E[i,j], F[i,j])
+
+A gap of length L thus costs ``gap_penalty + (L-1) * gap_extension_penalty``.  If
+``gap_extension_decay`` is set, extending a gap of length L costs
+``min(0, gap_extension_penalty + L * gap_extension_decay)``, the length being the one of the best
+gap reaching the cell.
+
+Outside of the local mode, H isn't floored to 0 and the borders of H hold the cost of the gaps
+before the alignment, unless the mode lets it skip them freely.
+
+The layers are computed by anti-diagonal wavefronts and only three diagonals of each one are kept.
+The traceback is stored as one byte per cell: the origin of H on two bits and whether E and F
+extend a gap.
+
+'''
+
+####################################################################################################
+
+import numpy as np
+
+from . import Engine, MatrixCell, MODES
+from .numpy_engine import EncodedReference, sorted_ends, substitution_table, score_dtype, zeros
+
+####################################################################################################
+
+# origin of H
+FROM_ZERO, FROM_DIAGONAL, FROM_E, FROM_F = range(4)
+E_EXTENDED = 4
+F_EXTENDED = 8
+
+OPERATIONS = 'xmdi'
+
+####################################################################################################
+
+class GotohMatrix(object):
+
+    ''' Traceback matrix of :class:`GotohEngine`, the H scores are only kept in verbose mode '''
+
+    ##############################################
+
+    def __init__(self, traceback, scores=None):
+
+        self.number_of_rows, self.number_of_cols = traceback.shape
+        self.traceback = traceback
+        self.scores = scores
+
+    ##############################################
+
+    @property
+    def nbytes(self):
+        return self.traceback.nbytes + (0 if self.scores is None else self.scores.nbytes)
+
+    ##############################################
+
+    def get(self, row, col):
+
+        score = 0 if self.scores is None else self.scores[row, col].item()
+        if not row or not col:
+            return MatrixCell(score, ' ', 0)
+        return MatrixCell(score, OPERATIONS[self.traceback[row, col] & 3], 0)
+
+    ##############################################
+
+    def ends(self, min_score=None):
+
+        ''' Yield the end cells of the local alignments, see :func:`sorted_ends`, the scores
+        must be kept.
+        '''
+
+        return sorted_ends(self.scores, self.traceback & 3 == FROM_DIAGONAL, min_score)
+
+####################################################################################################
+
+class GotohEngine(Engine):
+
+    modes = MODES
+
+    ##############################################
+
+    def prepare_reference(self, ref):
+        return EncodedReference(self._aligner.scoring_matrix, ref, self._aligner.wildcard)
+
+    ##############################################
+
+    def _prepare(self, ref, query):
+
+        aligner = self._aligner
+
+        table, ref_codes, query_codes = substitution_table(aligner.scoring_matrix, ref, query,
+                                                           aligner.wildcard, self.reference(ref))
+        penalties = [aligner.gap_penalty, aligner.gap_extension_penalty]
+        if aligner.gap_extension_decay:
+            penalties.append(aligner.gap_extension_decay)
+
+        return table.astype(score_dtype(table, *penalties)), ref_codes, query_codes
+
+    ##############################################
+
+    def _border(self, length, free, dtype):
+
+        ''' Return the H scores of a border of *length* cells after the corner: a gap, unless it
+        is *free*.
+        '''
+
+        aligner = self._aligner
+
+        border = np.zeros(length +1, dtype=dtype)
+        if free or not length:
+            return border
+
+        extensions = np.empty(length, dtype=dtype)
+        extensions[0] = aligner.gap_penalty
+        if aligner.gap_extension_decay:
+            # the extension of a gap of length L
+            runs = np.arange(1, length, dtype=dtype)
+            extensions[1:] = np.minimum(0, aligner.gap_extension_penalty +
+                                        runs * aligner.gap_extension_decay)
+        else:
+            extensions[1:] = aligner.gap_extension_penalty
+        border[1:] = np.cumsum(extensions)
+        return border
+
+    ##############################################
+
+    def _borders(self, number_of_rows, number_of_cols, mode, dtype):
+
+        # the first row skips the reference unless global, the first column skips the query in a
+        # local or overlap alignment
+        return (self._border(number_of_cols, mode != 'global', dtype),
+                self._border(number_of_rows, mode in ('local', 'overlap'), dtype))
+
+    ##############################################
+
+    def _wavefront(self, table, ref_codes, query_codes, traceback=None, scores=None,
+                   mode='local', borders=None):
+
+        ''' Iterate over the anti-diagonals and yield ``(diagonal, lo, hi, H)``, the diagonal
+        buffers being indexed by row like in :class:`NumpyEngine`.  *borders* are the first row and
+        column of H returned by :meth:`_borders`, zero by default.
+
+        *query_codes* may have leading dimensions to align a batch of queries of the same length
+        against the reference at once, the buffers, *traceback* and *scores* having the same
+        leading dimensions.
+        '''
+
+        aligner = self._aligner
+
+        number_of_rows = query_codes.shape[-1]
+        number_of_cols = len(ref_codes)
+        if not number_of_rows or not number_of_cols:
+            return
+
+        local = mode == 'local'
+
+        decay = aligner.gap_extension_decay
+        dtype = table.dtype.type
+        gap_penalty = dtype(aligner.gap_penalty)
+        gap_extension_penalty = dtype(aligner.gap_extension_penalty)
+        prefer_gap_runs = aligner.prefer_gap_runs
+        if dtype is np.int32:
+            # no gap, low enough to never be chosen but without overflow
+            minus_infinity = np.int32(-2**30)
+        else:
+            minus_infinity = -np.inf
+
+        ref_codes = ref_codes[::-1]
+        shape = query_codes.shape[:-1] + (number_of_rows +1,)
+        h = [np.zeros(shape, dtype=dtype) for i in xrange(3)]
+        e = [np.empty(shape, dtype=dtype) for i in xrange(2)]
+        f = [np.empty(shape, dtype=dtype) for i in xrange(2)]
+        e_run = [np.zeros(shape, dtype=np.int32) for i in xrange(2)]
+        f_run = [np.zeros(shape, dtype=np.int32) for i in xrange(2)]
+        for x in e + f:
+            x.fill(minus_infinity)
+
+        if borders is None:
+            row_border = col_border = None
+        else:
+            row_border, col_border = borders
+            # diagonal 1: (0, 1) and (1, 0)
+            h[1][..., 0] = row_border[1]
+            h[1][..., 1] = col_border[1]
+
+        if traceback is not None:
+            flat_traceback = traceback.reshape(traceback.shape[:-2] + (-1,))
+        if scores is not None:
+            flat_scores = scores.reshape(scores.shape[:-2] + (-1,))
+
+        for diagonal in xrange(2, number_of_rows + number_of_cols +1):
+            previous_h, up_h, cur_h = h
+            up_e, cur_e = e
+            up_f, cur_f = f
+            up_e_run, cur_e_run = e_run
+            up_f_run, cur_f_run = f_run
+
+            lo = max(1, diagonal - number_of_cols)
+            hi = min(number_of_rows, diagonal -1)
+            # up is (row -1, col) and left is (row, col -1), both on the previous diagonal
+            up = slice(lo -1, hi)
+            left = slice(lo, hi +1)
+
+            # E: deletion, from the left
+            e_open = up_h[..., left] + gap_penalty
+            if decay:
+                e_extend = up_e[..., left] + np.minimum(0, gap_extension_penalty +
+                                                      up_e_run[..., left] * decay)
+            else:
+                e_extend = up_e[..., left] + gap_extension_penalty
+            if prefer_gap_runs:
+                e_extended = e_extend >= e_open
+            else:
+                e_extended = e_extend > e_open
+            e_value = np.where(e_extended, e_extend, e_open)
+            cur_e[..., left] = e_value
+            cur_e_run[..., left] = np.where(e_extended, up_e_run[..., left] +1, 1)
+
+            # F: insertion, from above
+            f_open = up_h[..., up] + gap_penalty
+            if decay:
+                f_extend = up_f[..., up] + np.minimum(0, gap_extension_penalty +
+                                                      up_f_run[..., up] * decay)
+            else:
+                f_extend = up_f[..., up] + gap_extension_penalty
+            if prefer_gap_runs:
+                f_extended = f_extend >= f_open
+            else:
+                f_extended = f_extend > f_open
+            f_value = np.where(f_extended, f_extend, f_open)
+            cur_f[..., left] = f_value
+            cur_f_run[..., left] = np.where(f_extended, up_f_run[..., up] +1, 1)
+
+            # H
+            offset = number_of_cols - diagonal
+            mm_value = previous_h[..., up] + table[query_codes[..., lo -1:hi],
+                                                   ref_codes[offset + lo:offset + hi +1]]
+            if local:
+                cell_value = np.maximum(np.maximum(mm_value, e_value), np.maximum(f_value, 0))
+            else:
+                cell_value = np.maximum(np.maximum(mm_value, e_value), f_value)
+            cur_h[..., left] = cell_value
+
+            if traceback is not None:
+                if local:
+                    origin = np.select((cell_value <= 0, cell_value == mm_value,
+                                        cell_value == e_value),
+                                       (FROM_ZERO, FROM_DIAGONAL, FROM_E), FROM_F)
+                else:
+                    origin = np.select((cell_value == mm_value, cell_value == e_value),
+                                       (FROM_DIAGONAL, FROM_E), FROM_F)
+                origin = origin.astype(np.uint8)
+                origin |= np.where(e_extended, E_EXTENDED, 0).astype(np.uint8)
+                origin |= np.where(f_extended, F_EXTENDED, 0).astype(np.uint8)
+                # (row, diagonal - row) is at row * number_of_cols + diagonal in the flat matrix
+                cells = slice(lo * number_of_cols + diagonal, hi * number_of_cols + diagonal +1,
+                              number_of_cols)
+                flat_traceback[..., cells] = origin
+                if scores is not None:
+                    flat_scores[..., cells] = cell_value
+
+            # borders of the diagonal: no gap in progress
+            if diagonal <= number_of_cols:
+                cur_h[..., 0] = 0 if row_border is None else row_border[diagonal]
+                cur_e[..., 0] = cur_f[..., 0] = minus_infinity
+            if diagonal <= number_of_rows:
+                cur_h[..., diagonal] = 0 if col_border is None else col_border[diagonal]
+                cur_e[..., diagonal] = cur_f[..., diagonal] = minus_infinity
+
+            yield diagonal, lo, hi, cur_h
+
+            h.append(h.pop(0))
+            e.reverse()
+            f.reverse()
+            e_run.reverse()
+            f_run.reverse()
+
+    ##############################################
+
+    def _max(self, wavefront):
+
+        # keep the last cell in row-major order reaching the maximum, like the other engines
+
+        max_value, max_row, max_col = None, 0, 0
+        for diagonal, lo, hi, scores in wavefront:
+            cells = scores[lo:hi +1]
+            value = cells.max()
+            if max_value is None or value >= max_value:
+                row = lo + len(cells) -1 - int(np.argmax(cells[::-1] == value))
+                if max_value is None or value > max_value or row >= max_row:
+                    max_value, max_row, max_col = value, row, diagonal - row
+
+        if max_value is None:
+            return 0, 0, 0
+        return max_value.item(), max_row, max_col
+
+    ##############################################
+
+    def _end(self, wavefront, mode, number_of_rows, number_of_cols, borders):
+
+        ''' Return the end cell of an alignment other than local, like :class:`PythonEngine`: the
+        last cell in global mode, the best one of the last row in semiglobal mode, and of the last
+        column then the last row in overlap mode, the last one in this order reaching the maximum.
+        '''
+
+        row_border, col_border = borders
+        # H of the last row and of the last column
+        if number_of_rows:
+            last_row = np.empty(number_of_cols +1, dtype=row_border.dtype)
+            last_row[0] = col_border[number_of_rows]
+        else:
+            last_row = row_border.copy()
+        if number_of_cols:
+            last_col = np.empty(number_of_rows +1, dtype=col_border.dtype)
+            last_col[0] = row_border[number_of_cols]
+        else:
+            last_col = col_border.copy()
+
+        for diagonal, lo, hi, scores in wavefront:
+            if hi == number_of_rows:
+                last_row[diagonal - number_of_rows] = scores[number_of_rows]
+            if diagonal - lo == number_of_cols:
+                last_col[lo] = scores[lo]
+
+        if mode == 'global':
+            return last_row[-1].item(), number_of_rows, number_of_cols
+
+        cells = []
+        if mode == 'overlap':
+            cells = [(row, number_of_cols) for row in xrange(number_of_rows)]
+        values = np.concatenate((last_col[:-1], last_row)) if cells else last_row
+        cells += [(number_of_rows, col) for col in xrange(number_of_cols +1)]
+        i = len(values) -1 - int(np.argmax(values[::-1]))
+        return (values[i].item(),) + cells[i]
+
+    ##############################################
+
+    def _align(self, table, ref_codes, query_codes, mode, traceback=None, scores=None):
+
+        if mode == 'local':
+            return self._max(self._wavefront(table, ref_codes, query_codes, traceback, scores))
+
+        borders = self._borders(len(query_codes), len(ref_codes), mode, table.dtype)
+        wavefront = self._wavefront(table, ref_codes, query_codes, traceback, scores,
+                                    mode, borders)
+        return self._end(wavefront, mode, len(query_codes), len(ref_codes), borders)
+
+    ##############################################
+
+    def fill(self, ref, query, mode='local', keep_scores=None):
+
+        table, ref_codes, query_codes = self._prepare(ref, query)
+
+        if keep_scores is None:
+            keep_scores = self._aligner.verbose
+
+        shape = (len(query) +1, len(ref) +1)
+        workspace = self._aligner.workspace
+        traceback = zeros(workspace, 'matrix traceback', shape, np.uint8)
+        scores = None
+        if keep_scores:
+            scores = zeros(workspace, 'matrix scores', shape, table.dtype)
+
+        max_value, max_row, max_col = self._align(table, ref_codes, query_codes, mode,
+                                                  traceback, scores)
+
+        return GotohMatrix(traceback, scores), max_value, max_row, max_col
+
+    ##############################################
+
+    def fill_scores(self, ref, query):
+        return self.fill(ref, query, keep_scores=True)
+
+    ##############################################
+
+    def score(self, ref, query, mode='local'):
+        return self._align(*self._prepare(ref, query), mode=mode)
+
+    ##############################################
+
+    def backtrack(self, matrix, max_row, max_col, mode='local', stop=None):
+
+        traceback = matrix.traceback
+        row = max_row
+        col = max_col
+        layer = FROM_DIAGONAL
+
+        aln = []
+        path = []
+        while row > 0 and col > 0:
+            flags = traceback[row, col]
+            if layer == FROM_DIAGONAL:
+                layer = flags & 3
+                if layer == FROM_ZERO:
+                    break
+            if stop is not None and (row, col) in stop:
+                return None
+            if layer == FROM_DIAGONAL:
+                path.append((row, col))
+                aln.append('m')
+                row -= 1
+                col -= 1
+            elif layer == FROM_E:
+                path.append((row, col))
+                aln.append('d')
+                col -= 1
+                if not flags & E_EXTENDED:
+                    layer = FROM_DIAGONAL
+            else:
+                path.append((row, col))
+                aln.append('i')
+                row -= 1
+                if not flags & F_EXTENDED:
+                    layer = FROM_DIAGONAL
+
+        # gaps along the borders before a global or semiglobal alignment
+        if mode in ('global', 'semiglobal'):
+            while row > 0:
+                path.append((row, col))
+                aln.append('i')
+                row -= 1
+        if mode == 'global':
+            while col > 0:
+                path.append((row, col))
+                aln.append('d')
+                col -= 1
+
+        aln.reverse()
+
+        return row, col, aln, path
@@ -0,0 +1,294 @@
+####################################################################################################
+
+''' Linear space local alignment (Hirschberg / Myers-Miller)
+
+The alignment is found in three steps, each one in O(len(ref)) memory:
+
+* a score-only forward pass finds the best score and the end of the alignment,
+* a score-only pass over the reversed sequences, starting from the end, finds its start,
+* the cigar of the global alignment between the start and the end is recovered by divide and
+  conquer: the middle row of the query is crossed at the column maximising the sum of the forward
+  and backward scores, either on a cell or by a gap spanning the middle row (Myers and Miller), and
+  both halves are aligned recursively.  Small sub-problems are aligned with a full matrix.
+
+The scores are the ones of the affine gap model of :class:`GotohEngine`: a gap of length L costs
+``gap_penalty + (L-1) * gap_extension_penalty``.  The rows are computed with NumPy, the deletions
+along a row being resolved with a running maximum.
+
+'''
+
+####################################################################################################
+
+import numpy as np
+
+from .numpy_engine import substitution_table, score_dtype
+
+####################################################################################################
+
+# sub-problems with at most this number of cells are aligned with a full matrix
+FULL_MATRIX_CELLS = 4096
+
+####################################################################################################
+
+class LinearSpaceAligner(object):
+
+    ''' Align with the penalties and scoring matrix of a :class:`LocalAlignment` in linear space '''
+
+    ##############################################
+
+    def __init__(self, aligner):
+
+        if aligner.gap_extension_decay:
+            raise ValueError('gap_extension_decay is not supported by the linear space alignment')
+
+        self._aligner = aligner
+        self._gap = float(aligner.gap_penalty)
+        self._ext = float(aligner.gap_extension_penalty)
+
+    ##############################################
+
+    def align(self, ref, query):
+
+        ''' Return the alignment of *query* against *ref* as a tuple ``(row, col, operations,
+        score)``, *row* and *col* being the start of the alignment in *query* and *ref*.
+        '''
+
+        if not ref or not query:
+            return 0, 0, [], 0
+
+        aligner = self._aligner
+        table, ref_codes, query_codes = substitution_table(aligner.scoring_matrix, ref, query,
+                                                           aligner.wildcard)
+        is_integer = score_dtype(table, aligner.gap_penalty,
+                                 aligner.gap_extension_penalty) is np.int32
+        self._table = table.astype(np.float64)
+        self._table_list = self._table.tolist()
+
+        max_value, end_row, end_col = self._forward(query_codes, ref_codes)
+        if max_value <= 0:
+            return end_row, end_col, [], 0
+
+        start_row, start_col = self._start(query_codes[:end_row], ref_codes[:end_col], max_value)
+        operations = []
+        self._global(query_codes[start_row:end_row], ref_codes[start_col:end_col],
+                     False, False, operations)
+
+        if is_integer:
+            max_value = int(round(max_value))
+        return start_row, start_col, operations, max_value
+
+    ##############################################
+
+    def _rows(self, query_codes, ref_codes, local=False, top_gap=False):
+
+        ''' Yield the rows of H (best score) and F (best score ending by an insertion), starting
+        with row 0.  If *local* is set, the alignments can start anywhere, else they start at the
+        top left corner, by an insertion continuing a gap if *top_gap* is set.
+        '''
+
+        table = self._table
+        gap = self._gap
+        ext = self._ext
+
+        # a run of deletions of length L costs const + L * slope: if opening a gap is cheaper than
+        # extending it, the run is made of new gaps
+        slope = max(gap, ext)
+        const = gap - slope
+        ramp = np.arange(len(ref_codes) +1) * slope
+
+        if local:
+            h = np.zeros(len(ref_codes) +1)
+        else:
+            h = const + ramp
+            h[0] = 0
+        f = np.empty(len(ref_codes) +1)
+        f.fill(-np.inf)
+        if top_gap:
+            f[0] = 0
+        yield h, f
+
+        g = np.empty(len(ref_codes) +1)
+        e = np.empty(len(ref_codes) +1)
+        e[0] = -np.inf
+        for code in query_codes:
+            f = np.maximum(h + gap, f + ext)
+            # g: best score not ending by a deletion
+            np.maximum(h[:-1] + table[code, ref_codes], f[1:], g[1:])
+            if local:
+                g[0] = 0
+                np.maximum(g, 0, g)
+            else:
+                g[0] = f[0]
+            # e[j] = max(g[k] + const + (j - k) * slope for k < j)
+            e[1:] = np.maximum.accumulate(g[:-1] - ramp[:-1]) + const + ramp[1:]
+            h = np.maximum(g, e)
+            yield h, f
+
+    ##############################################
+
+    def _forward(self, query_codes, ref_codes):
+
+        # like the engines, keep the last cell in row-major order reaching the maximum
+
+        max_value, max_row, max_col = 0, 0, 0
+        for row, (h, f) in enumerate(self._rows(query_codes, ref_codes, local=True)):
+            value = h.max()
+            if value >= max_value:
+                max_value = value
+                max_row = row
+                max_col = len(h) -1 - int(np.argmax(h[::-1] == value))
+
+        return max_value, max_row, max_col
+
+    ##############################################
+
+    def _start(self, query_codes, ref_codes, max_value):
+
+        # align the reversed sequences from the end of the alignment, the first cell reaching the
+        # maximum is the start of the alignment
+        tolerance = 1e-9 * abs(max_value)
+        for row, (h, f) in enumerate(self._rows(query_codes[::-1], ref_codes[::-1])):
+            cols = np.flatnonzero(h >= max_value - tolerance)
+            if len(cols):
+                return len(query_codes) - row, len(ref_codes) - int(cols[0])
+
+        raise AssertionError('alignment start not found')
+
+    ##############################################
+
+    def _global(self, query_codes, ref_codes, top_gap, bottom_gap, operations):
+
+        ''' Append to *operations* the global alignment of *query_codes* and *ref_codes*.  If
+        *top_gap* or *bottom_gap* is set, an insertion at the start or the end continues a gap and
+        its first base costs the extension penalty.
+        '''
+
+        number_of_rows = len(query_codes)
+        number_of_cols = len(ref_codes)
+        if number_of_rows < 2 or number_of_rows * number_of_cols <= FULL_MATRIX_CELLS:
+            operations.extend(self._full(query_codes.tolist(), ref_codes.tolist(),
+                                         top_gap, bottom_gap))
+            return
+
+        middle = number_of_rows // 2
+        for h, f in self._rows(query_codes[:middle], ref_codes, top_gap=top_gap):
+            pass
+        for back_h, back_f in self._rows(query_codes[middle:][::-1], ref_codes[::-1],
+                                         top_gap=bottom_gap):
+            pass
+
+        # cross the middle row on a cell, or by an insertion of query[middle -1] and query[middle]
+        # whose second base costs the extension penalty
+        on_cell = h + back_h[::-1]
+        on_gap = f + back_f[::-1] - self._gap + self._ext
+        col = int(np.argmax(on_cell))
+        gap_col = int(np.argmax(on_gap))
+
+        if on_gap[gap_col] > on_cell[col]:
+            self._global(query_codes[:middle -1], ref_codes[:gap_col], top_gap, True, operations)
+            operations.extend('ii')
+            self._global(query_codes[middle +1:], ref_codes[gap_col:], True, bottom_gap, operations)
+        else:
+            self._global(query_codes[:middle], ref_codes[:col], top_gap, False, operations)
+            self._global(query_codes[middle:], ref_codes[col:], False, bottom_gap, operations)
+
+    ##############################################
+
+    def _full(self, query_codes, ref_codes, top_gap, bottom_gap):
+
+        ''' Global alignment with a full matrix, return the operations '''
+
+        table = self._table_list
+        gap = self._gap
+        ext = self._ext
+        minus_infinity = float('-inf')
+
+        number_of_cols = len(ref_codes) +1
+        # E and F: best score ending by a deletion or an insertion, and whether it extends a gap
+        h = [0.]
+        e = [minus_infinity]
+        f = [0. if top_gap else minus_infinity]
+        e_extended = [False]
+        f_extended = [False]
+        origin = [None]
+        for col in xrange(1, number_of_cols):
+            e_open = h[col -1] + gap
+            e_extend = e[col -1] + ext
+            e.append(max(e_open, e_extend))
+            e_extended.append(e_extend >= e_open)
+            f.append(minus_infinity)
+            f_extended.append(False)
+            h.append(e[col])
+            origin.append('d')
+        h_rows = [h]
+        e_rows = [e_extended]
+        f_rows = [f_extended]
+        origin_rows = [origin]
+
+        for query_code in query_codes:
+            scores = table[query_code]
+            up_h, up_f = h, f
+            h = []
+            e = []
+            f = []
+            e_extended = []
+            f_extended = []
+            origin = []
+            for col in xrange(number_of_cols):
+                f_open = up_h[col] + gap
+                f_extend = up_f[col] + ext
+                f.append(max(f_open, f_extend))
+                f_extended.append(f_extend >= f_open)
+                if col:
+                    e_open = h[col -1] + gap
+                    e_extend = e[col -1] + ext
+                    e.append(max(e_open, e_extend))
+                    e_extended.append(e_extend >= e_open)
+                    m_value = up_h[col -1] + scores[ref_codes[col -1]]
+                    if m_value >= e[col] and m_value >= f[col]:
+                        h.append(m_value)
+                        origin.append('m')
+                    elif e[col] >= f[col]:
+                        h.append(e[col])
+                        origin.append('d')
+                    else:
+                        h.append(f[col])
+                        origin.append('i')
+                else:
+                    e.append(minus_infinity)
+                    e_extended.append(False)
+                    h.append(f[col])
+                    origin.append('i')
+            h_rows.append(h)
+            e_rows.append(e_extended)
+            f_rows.append(f_extended)
+            origin_rows.append(origin)
+
+        row = len(query_codes)
+        col = number_of_cols -1
+        state = 'h'
+        if bottom_gap and row and f[col] - gap + ext > h[col]:
+            state = 'i'
+
+        operations = []
+        while row or col:
+            if state == 'h':
+                state = origin_rows[row][col]
+                if state == 'm':
+                    operations.append('m')
+                    row -= 1
+                    col -= 1
+                    state = 'h'
+            elif state == 'd':
+                operations.append('d')
+                if not e_rows[row][col]:
+                    state = 'h'
+                col -= 1
+            else:
+                operations.append('i')
+                if not f_rows[row][col]:
+                    state = 'h'
+                row -= 1
+
+        operations.reverse()
+        return operations
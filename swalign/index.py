@@ -0,0 +1,199 @@
+####################################################################################################
+
+''' k-mer index of reference sequences for seed and extend searches
+
+The k-mers of the references are encoded on 2 bits per base and stored, sorted, in NumPy arrays
+along with their reference and position.  The k-mers of a query are looked up in the index, the hits
+are clustered by reference and diagonal, and the query is only aligned to the regions of the
+references around the best clusters.
+
+'''
+
+####################################################################################################
+
+import numpy as np
+
+from .removed import revcomp
+from .sequence import EncodedSequence
+
+####################################################################################################
+
+_CODES = np.empty(256, dtype=np.uint8)
+_CODES.fill(4)
+for _i, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _base in _bases:
+        _CODES[ord(_base)] = _i
+
+####################################################################################################
+
+def kmers(seq, k):
+
+    ''' Return the k-mers of *seq* encoded on 2 bits per base and their positions, k-mers including
+    a base other than A, C, G or T are skipped.
+    '''
+
+    assert 0 < k <= 31
+
+    number_of_kmers = len(seq) - k +1
+    if number_of_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+    if isinstance(seq, EncodedSequence):
+        codes = np.frombuffer(seq.codes, dtype=np.uint8)
+    else:
+        codes = _CODES[np.frombuffer(str(seq), dtype=np.uint8)]
+    values = np.zeros(number_of_kmers, dtype=np.uint64)
+    for i in xrange(k):
+        values <<= np.uint64(2)
+        values |= (codes[i:i + number_of_kmers] & 3).astype(np.uint64)
+
+    # number of unknown bases in each k-mer
+    unknown = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (unknown[k:] - unknown[:number_of_kmers]) == 0
+    positions = np.flatnonzero(valid)
+
+    return values[positions], positions
+
+####################################################################################################
+
+class ReferenceIndex(object):
+
+    ''' Index of the k-mers of reference sequences.
+
+    *refs* is an iterable of ``(name, seq, comments)`` tuples, like the generators returned by
+    :func:`fasta_gen`.  k-mers occurring more than *max_occurrences* times are ignored by the
+    lookups.
+    '''
+
+    ##############################################
+
+    def __init__(self, refs, k=11, max_occurrences=1000):
+
+        self.k = k
+        self.max_occurrences = max_occurrences
+        self.refs = list(refs)
+
+        values = []
+        ref_indexes = []
+        positions = []
+        for i, (name, seq, comments) in enumerate(self.refs):
+            ref_values, ref_positions = kmers(seq, k)
+            values.append(ref_values)
+            positions.append(ref_positions.astype(np.int32))
+            ref_indexes.append(np.empty(len(ref_values), dtype=np.int32))
+            ref_indexes[-1].fill(i)
+
+        if self.refs:
+            values = np.concatenate(values)
+            order = np.argsort(values, kind='mergesort')
+            self._values = values[order]
+            self._ref_indexes = np.concatenate(ref_indexes)[order]
+            self._positions = np.concatenate(positions)[order]
+        else:
+            self._values = np.zeros(0, dtype=np.uint64)
+            self._ref_indexes = np.zeros(0, dtype=np.int32)
+            self._positions = np.zeros(0, dtype=np.int32)
+
+    ##############################################
+
+    def __len__(self):
+        return len(self._values)
+
+    ##############################################
+
+    def seeds(self, query):
+
+        ''' Return the seed hits of *query* as three arrays: reference index, position in the
+        reference and position in the query.
+        '''
+
+        values, query_positions = kmers(query, self.k)
+        starts = np.searchsorted(self._values, values, side='left')
+        ends = np.searchsorted(self._values, values, side='right')
+        counts = ends - starts
+        keep = (counts > 0) & (counts <= self.max_occurrences)
+        starts, counts, query_positions = starts[keep], counts[keep], query_positions[keep]
+
+        # expand the ranges of the hits of each k-mer
+        number_of_hits = counts.sum()
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        hits = np.repeat(starts, counts) + np.arange(number_of_hits) - offsets
+
+        return self._ref_indexes[hits], self._positions[hits], np.repeat(query_positions, counts)
+
+    ##############################################
+
+    def candidates(self, query, max_diagonal_gap=16, min_seeds=1, max_candidates=10):
+
+        ''' Cluster the seed hits of *query* by reference and diagonal, the diagonal of a hit being
+        the position in the reference minus the position in the query, and return the best
+        clusters as a list of ``(number_of_seeds, ref_index, min_diagonal, max_diagonal)``, sorted
+        by decreasing number of seeds.
+        '''
+
+        ref_indexes, ref_positions, query_positions = self.seeds(query)
+        if not len(ref_indexes):
+            return []
+
+        diagonals = ref_positions.astype(np.int64) - query_positions
+        order = np.lexsort((diagonals, ref_indexes))
+        ref_indexes = ref_indexes[order]
+        diagonals = diagonals[order]
+
+        # a new cluster starts at a new reference or after a gap between the diagonals
+        breaks = np.flatnonzero((ref_indexes[1:] != ref_indexes[:-1]) |
+                                (diagonals[1:] - diagonals[:-1] > max_diagonal_gap)) +1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(diagonals)]))
+
+        clusters = [(int(end - start), int(ref_indexes[start]),
+                     int(diagonals[start]), int(diagonals[end -1]))
+                    for start, end in zip(starts, ends)
+                    if end - start >= min_seeds]
+        clusters.sort(key=lambda cluster: -cluster[0])
+
+        return clusters[:max_candidates]
+
+    ##############################################
+
+    def search(self, aligner, query, query_name='query', strands='+-', padding=None,
+               band_width=None, **kwargs):
+
+        ''' Align *query* with *aligner* to the regions of the references around the best seed
+        clusters and return the alignments sorted by decreasing score.
+
+        A region spans the diagonals of the cluster extended by *padding*, the length of the query
+        by default.  If *band_width* is given, the region is aligned with
+        :meth:`LocalAlignment.align_banded` around the diagonals of the cluster.  The alignments
+        are translated to the coordinates of the whole reference using
+        :meth:`Alignment.set_ref_offset`.  Other keyword arguments are passed to
+        :meth:`candidates`.
+        '''
+
+        if padding is None:
+            padding = len(query)
+
+        alignments = []
+        for strand in strands:
+            rc = strand == '-'
+            seq = revcomp(query) if rc else query
+            candidates = self.candidates(seq, **kwargs)
+            for number_of_seeds, ref_index, min_diagonal, max_diagonal in candidates:
+                ref_name, ref_seq, ref_comments = self.refs[ref_index]
+                start = max(0, min_diagonal - padding)
+                end = min(len(ref_seq), max_diagonal + len(seq) + padding)
+                window = ref_seq[start:end]
+                if band_width is None:
+                    aln = aligner.align(window, seq,
+                                        ref_name=ref_name, query_name=query_name, rc=rc)
+                else:
+                    diagonal = (min_diagonal + max_diagonal) // 2 - start
+                    width = band_width + (max_diagonal - min_diagonal +1) // 2
+                    aln = aligner.align_banded(window, seq, diagonal, width,
+                                               ref_name=ref_name, query_name=query_name, rc=rc)
+                aln.set_ref_offset(ref_name, start, '%s:%s-%s' % (ref_name, start +1, end))
+                alignments.append(aln)
+
+        alignments.sort(key=lambda aln: -aln.score)
+
+        return alignments
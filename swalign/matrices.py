@@ -0,0 +1,59 @@
+####################################################################################################
+
+''' Bundled scoring matrices and process-wide cache of the parsed matrices
+
+The matrices are looked up by name, for the bundled ones, or by file name.  A file is read at each
+call but only parsed the first time its content is seen: the cache is keyed by the path of the file,
+a hash of its content and the wildcard score.
+
+'''
+
+####################################################################################################
+
+import hashlib
+import os
+
+from .removed import ScoringMatrix
+
+####################################################################################################
+
+_DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+BUNDLED_MATRICES = ('BLOSUM62', 'PAM250', 'NUC.4.4')
+
+_cache = {}
+
+####################################################################################################
+
+def matrix_filename(name):
+
+    ''' Return the file of the bundled matrix *name*, case insensitive, else *name* '''
+
+    for bundled in BUNDLED_MATRICES:
+        if name.upper() == bundled:
+            return os.path.join(_DATA_DIRECTORY, bundled)
+    return name
+
+####################################################################################################
+
+def load_scoring_matrix(name, wildcard_score=0):
+
+    ''' Return the :class:`ScoringMatrix` of a bundled matrix or of a file, parsed once per
+    process.
+    '''
+
+    filename = os.path.abspath(matrix_filename(name))
+    with open(filename) as f:
+        text = f.read()
+
+    key = (filename, hashlib.sha1(text).hexdigest(), wildcard_score)
+    matrix = _cache.get(key)
+    if matrix is None:
+        matrix = _cache[key] = ScoringMatrix(text=text, wildcard_score=wildcard_score)
+
+    return matrix
+
+####################################################################################################
+
+def clear_cache():
+    _cache.clear()
@@ -0,0 +1,405 @@
+####################################################################################################
+
+''' Vectorised Smith-Waterman engine
+
+The matrix is computed one anti-diagonal at a time: every cell of an anti-diagonal only depends on
+the two previous anti-diagonals, so a whole wavefront is evaluated with a few NumPy operations while
+reproducing exactly the cell by cell recurrence of :class:`swalign.PythonEngine`.
+
+'''
+
+####################################################################################################
+
+import numpy as np
+
+from . import Engine, MatrixCell
+from .sequence import EncodedSequence
+
+####################################################################################################
+
+OP_NONE, OP_MATCH, OP_INSERTION, OP_DELETION, OP_NULL = range(5)
+OPERATIONS = ' midx'
+
+_BASES = np.array([ord(base) for base in 'ACGT'], dtype=np.intp)
+
+####################################################################################################
+
+def encode_sequence(encoder, seq):
+
+    ''' Return the codes of the residues of *seq* in *encoder*, an array indexed by the residue
+    bytes.  The bases of an :class:`EncodedSequence` are encoded from its base codes, only the
+    residues of its mask, N and wildcards, are looked up one by one.
+    '''
+
+    if not isinstance(seq, EncodedSequence):
+        return encoder[np.fromstring(str(seq), dtype=np.uint8)]
+
+    codes = encoder[_BASES][np.minimum(np.frombuffer(seq.codes, dtype=np.uint8), 3)]
+    unknown = np.flatnonzero(np.frombuffer(seq.mask, dtype=np.uint8))
+    if len(unknown):
+        codes[unknown] = encoder[np.frombuffer(seq.upper(), dtype=np.uint8)[unknown]]
+    return codes
+
+####################################################################################################
+
+class EncodedReference(object):
+
+    ''' Score table of a scoring matrix and reference encoded for this table.
+
+    The lookup table of a :class:`ScoringMatrix` is used as is, the table of other scoring matrices
+    is built over the residues of the reference and of *query*, if given, the scoring matrix being
+    only called once per pair of residues.  ``table[q, r]`` is the score of the query residue
+    *q* against the reference residue *r*.
+    '''
+
+    ##############################################
+
+    def __init__(self, scoring_matrix, ref, wildcard=None, query=''):
+
+        if hasattr(scoring_matrix, 'lookup'):
+            codes, table = scoring_matrix.lookup(wildcard)
+            self.table = np.array(table)
+            self.complete = True
+        else:
+            alphabet = sorted(set(ref) | set(query))
+            codes = dict((residue, i) for i, residue in enumerate(alphabet))
+            table = np.array([[scoring_matrix.score(one, two, wildcard) for two in alphabet]
+                              for one in alphabet])
+            if not alphabet:
+                table = table.reshape(0, 0).astype(np.int32)
+            self.table = table
+            # queries with other residues need a new table
+            self.complete = False
+
+        self.residues = frozenset(codes)
+        self._encoder = np.empty(256, dtype=np.intp)
+        self._encoder.fill(-1)
+        for residue, code in codes.iteritems():
+            self._encoder[ord(residue)] = code
+        # the codes of an EncodedSequence are kept in it for the encoders of the same codes
+        self._key = ('codes', tuple(sorted(codes.iteritems())))
+
+        self.ref_codes = self.encode(ref)
+
+    ##############################################
+
+    def covers(self, seq):
+
+        ''' Return whether the residues of *seq* are in the table '''
+
+        if self.complete:
+            return True
+        if isinstance(seq, EncodedSequence):
+            return self.residues.issuperset(seq.state('residues', lambda: frozenset(seq.upper())))
+        return self.residues.issuperset(seq)
+
+    ##############################################
+
+    def encode(self, seq):
+
+        if isinstance(seq, EncodedSequence):
+            return seq.state(self._key, lambda: self._encode(seq))
+        return self._encode(seq)
+
+    ##############################################
+
+    def _encode(self, seq):
+
+        codes = encode_sequence(self._encoder, seq)
+        unknown = np.flatnonzero(codes < 0)
+        if len(unknown):
+            raise ValueError("Unknown residue '%s' for the scoring matrix" % seq[unknown[0]])
+        # the codes may be shared by the alignments of the sequence
+        codes.flags.writeable = False
+        return codes
+
+####################################################################################################
+
+def substitution_table(scoring_matrix, ref, query, wildcard=None, reference=None):
+
+    ''' Return the score table over the residues of *ref* and *query* and the encoded sequences.
+
+    *reference* is an :class:`EncodedReference` of *ref* to reuse, a new one is built if it
+    doesn't cover the residues of *query*.
+    '''
+
+    if reference is None or not reference.covers(query):
+        reference = EncodedReference(scoring_matrix, ref, wildcard, query)
+    return reference.table, reference.ref_codes, reference.encode(query)
+
+####################################################################################################
+
+def zeros(workspace, name, shape, dtype):
+
+    ''' Return ``np.zeros(shape, dtype)``, the array being a view of a buffer of *workspace* if
+    given.
+    '''
+
+    if workspace is None:
+        return np.zeros(shape, dtype=dtype)
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffer = workspace.buffer((name, dtype.str), size,
+                              lambda capacity: np.empty(capacity, dtype=dtype), dtype.itemsize)
+    array = buffer[:size].reshape(shape)
+    array.fill(0)
+    return array
+
+####################################################################################################
+
+def score_dtype(table, *penalties):
+
+    dtype = np.result_type(table, *[np.asarray(x) for x in penalties])
+    if np.issubdtype(dtype, np.integer):
+        return np.int32
+    else:
+        return np.float64
+
+####################################################################################################
+
+def sorted_ends(scores, is_match, min_score=None):
+
+    ''' Yield the end cells of the local alignments of a matrix of *scores* as ``(score, row,
+    col)`` tuples by decreasing order: the cells scoring more than 0, and at least *min_score*,
+    which are not extended by a match, *is_match* being true for the cells set by a match, on
+    their diagonal scoring more.  The cells are converted to tuples by chunks, as they are
+    consumed.
+    '''
+
+    interior = scores[1:, 1:]
+    ends = interior > 0
+    if min_score is not None:
+        ends &= interior >= min_score
+    ends[:-1, :-1] &= ~(is_match[2:, 2:] & (scores[2:, 2:] > scores[1:-1, 1:-1]))
+
+    rows, cols = np.nonzero(ends)
+    values = interior[rows, cols]
+    order = np.lexsort((cols, rows, values))[::-1]
+    for start in xrange(0, len(order), 256):
+        chunk = order[start:start + 256]
+        for end in zip(values[chunk].tolist(), (rows[chunk] +1).tolist(),
+                       (cols[chunk] +1).tolist()):
+            yield end
+
+####################################################################################################
+
+class ArrayMatrix(object):
+
+    ''' Matrix view over the score, operation and run length arrays computed by
+    :class:`NumpyEngine`
+    '''
+
+    ##############################################
+
+    def __init__(self, scores, operations, run_lengths):
+
+        self.number_of_rows, self.number_of_cols = scores.shape
+        self.scores = scores
+        self.operations = operations
+        self.run_lengths = run_lengths
+
+    ##############################################
+
+    @property
+    def nbytes(self):
+        return self.scores.nbytes + self.operations.nbytes + self.run_lengths.nbytes
+
+    ##############################################
+
+    def get(self, row, col):
+        return MatrixCell(self.scores[row, col].item(),
+                          OPERATIONS[self.operations[row, col]],
+                          int(self.run_lengths[row, col]))
+
+    ##############################################
+
+    def ends(self, min_score=None):
+        return sorted_ends(self.scores, self.operations == OP_MATCH, min_score)
+
+####################################################################################################
+
+class NumpyEngine(Engine):
+
+    ##############################################
+
+    def prepare_reference(self, ref):
+        return EncodedReference(self._aligner.scoring_matrix, ref, self._aligner.wildcard)
+
+    ##############################################
+
+    def _prepare(self, ref, query):
+
+        aligner = self._aligner
+
+        table, ref_codes, query_codes = substitution_table(aligner.scoring_matrix, ref, query,
+                                                           aligner.wildcard, self.reference(ref))
+        dtype = score_dtype(table, aligner.gap_penalty, aligner.gap_extension_penalty)
+
+        return table.astype(dtype), ref_codes, query_codes
+
+    ##############################################
+
+    def _wavefront(self, table, ref_codes, query_codes, matrix=None):
+
+        ''' Iterate over the anti-diagonals and yield ``(diagonal, lo, hi, scores)``
+
+        Diagonal buffers are indexed by row, the interior cells of the diagonal *d* are the rows
+        *lo* to *hi* and the column of a row *r* is ``d - r``.  If *matrix* is given, as a tuple of
+        score, operation and run length arrays, the computed cells are stored in it.
+        '''
+
+        aligner = self._aligner
+
+        dtype = table.dtype.type
+        gap_penalty = dtype(aligner.gap_penalty)
+        gap_extension_penalty = dtype(aligner.gap_extension_penalty)
+        prefer_gap_runs = aligner.prefer_gap_runs
+
+        number_of_rows = len(query_codes)
+        number_of_cols = len(ref_codes)
+        if not number_of_rows or not number_of_cols:
+            return
+        ref_codes = ref_codes[::-1]
+
+        # three rolling diagonals: d-2, d-1 and d
+        scores = [np.zeros(number_of_rows +1, dtype=dtype) for i in xrange(3)]
+        operations = [np.zeros(number_of_rows +1, dtype=np.uint8) for i in xrange(3)]
+        run_lengths = [np.zeros(number_of_rows +1, dtype=np.int32) for i in xrange(3)]
+
+        # diagonal 1 holds only borders
+        if number_of_cols:
+            operations[1][0] = OP_DELETION
+        if number_of_rows:
+            operations[1][1] = OP_INSERTION
+
+        if matrix is not None:
+            flat_scores, flat_operations, flat_run_lengths = [x.ravel() for x in matrix]
+
+        for diagonal in xrange(2, number_of_rows + number_of_cols +1):
+            previous_scores, up_scores, cur_scores = scores
+            previous_operations, up_operations, cur_operations = operations
+            previous_run_lengths, up_run_lengths, cur_run_lengths = run_lengths
+
+            lo = max(1, diagonal - number_of_cols)
+            hi = min(number_of_rows, diagonal -1)
+            # up is (row -1, col) and left is (row, col -1), both on the previous diagonal
+            up = slice(lo -1, hi)
+            left = slice(lo, hi +1)
+
+            # Match/Mismatch
+            offset = number_of_cols - diagonal
+            substitution = table[query_codes[lo -1:hi], ref_codes[offset + lo:offset + hi +1]]
+            mm_value = previous_scores[up] + substitution
+
+            up_value = up_scores[up]
+            up_ins = up_operations[up] == OP_INSERTION
+            # no penalty to start the alignment
+            ins_value = np.where(up_ins,
+                                 np.where(up_value == 0, 0, up_value + gap_extension_penalty),
+                                 up_value + gap_penalty).astype(dtype)
+
+            left_value = up_scores[left]
+            left_del = up_operations[left] == OP_DELETION
+            del_value = np.where(left_del,
+                                 np.where(left_value == 0, 0, left_value + gap_extension_penalty),
+                                 left_value + gap_penalty).astype(dtype)
+
+            cell_value = np.maximum(np.maximum(mm_value, del_value), np.maximum(ins_value, 0))
+
+            is_mm = cell_value == mm_value
+            is_del = cell_value == del_value
+            is_ins = cell_value == ins_value
+            if prefer_gap_runs:
+                ins_run = np.where(up_ins, up_run_lengths[up], 0)
+                del_run = np.where(left_del, up_run_lengths[left], 0)
+                conditions = (is_del & (del_run > 0), is_ins & (ins_run > 0), is_mm, is_del, is_ins)
+                choices = (OP_DELETION, OP_INSERTION, OP_MATCH, OP_DELETION, OP_INSERTION)
+                run_choices = (del_run +1, ins_run +1, 0, 1, 1)
+            else:
+                conditions = (is_mm, is_del, is_ins)
+                choices = (OP_MATCH, OP_DELETION, OP_INSERTION)
+                run_choices = (0, 1, 1)
+
+            cur_scores[left] = cell_value
+            cur_operations[left] = np.select(conditions, choices, OP_NULL)
+            cur_run_lengths[left] = np.select(conditions, run_choices, 0)
+
+            if matrix is not None:
+                # (row, diagonal - row) is at row * number_of_cols + diagonal in the flat matrix
+                cells = slice(lo * number_of_cols + diagonal, hi * number_of_cols + diagonal +1,
+                              number_of_cols)
+                flat_scores[cells] = cur_scores[left]
+                flat_operations[cells] = cur_operations[left]
+                flat_run_lengths[cells] = cur_run_lengths[left]
+
+            # borders of the diagonal
+            if diagonal <= number_of_cols:
+                cur_scores[0] = 0
+                cur_operations[0] = OP_DELETION
+                cur_run_lengths[0] = 0
+            if diagonal <= number_of_rows:
+                cur_scores[diagonal] = 0
+                cur_operations[diagonal] = OP_INSERTION
+                cur_run_lengths[diagonal] = 0
+
+            yield diagonal, lo, hi, cur_scores
+
+            scores.append(scores.pop(0))
+            operations.append(operations.pop(0))
+            run_lengths.append(run_lengths.pop(0))
+
+    ##############################################
+
+    def fill(self, ref, query, mode='local'):
+
+        table, ref_codes, query_codes = self._prepare(ref, query)
+
+        number_of_rows = len(query) +1
+        number_of_cols = len(ref) +1
+        shape = (number_of_rows, number_of_cols)
+        workspace = self._aligner.workspace
+        scores = zeros(workspace, 'matrix scores', shape, table.dtype)
+        operations = zeros(workspace, 'matrix operations', shape, np.uint8)
+        run_lengths = zeros(workspace, 'matrix run lengths', shape, np.int32)
+        operations[0, 1:] = OP_DELETION
+        operations[1:, 0] = OP_INSERTION
+
+        for wavefront in self._wavefront(table, ref_codes, query_codes,
+                                         (scores, operations, run_lengths)):
+            pass
+
+        max_value, max_row, max_col = 0, 0, 0
+        if number_of_rows > 1 and number_of_cols > 1:
+            # the last cell in row-major order reaching the maximum
+            interior = scores[1:, 1:]
+            max_value = interior.max()
+            index = np.flatnonzero(interior.ravel() == max_value)[-1]
+            max_row = int(index // (number_of_cols -1)) +1
+            max_col = int(index % (number_of_cols -1)) +1
+            max_value = max_value.item()
+
+        return ArrayMatrix(scores, operations, run_lengths), max_value, max_row, max_col
+
+    ##############################################
+
+    def score(self, ref, query, mode='local'):
+
+        table, ref_codes, query_codes = self._prepare(ref, query)
+
+        max_value, max_row, max_col = 0, 0, 0
+        if not len(query) or not len(ref):
+            return max_value, max_row, max_col
+
+        max_value = None
+        for diagonal, lo, hi, scores in self._wavefront(table, ref_codes, query_codes):
+            cells = scores[lo:hi +1]
+            value = cells.max()
+            if max_value is None or value >= max_value:
+                # keep the last cell in row-major order: the highest row, then the highest column
+                # which is the one of the later diagonal
+                row = lo + len(cells) -1 - int(np.argmax(cells[::-1] == value))
+                if max_value is None or value > max_value or row >= max_row:
+                    max_value, max_row, max_col = value, row, diagonal - row
+
+        return max_value.item(), max_row, max_col
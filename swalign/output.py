@@ -0,0 +1,263 @@
+####################################################################################################
+
+''' Streaming writers of alignments
+
+Each writer writes one record per :class:`Alignment` as soon as it is given, through a buffered
+file, and flushes the file every *flush_every* records so that the output can be read while the
+run goes on.  The memory used doesn't depend on the number of alignments.
+
+* :class:`SummaryWriter`: the tab-delimited summary of ``bin/swalign``,
+* :class:`SamWriter`: SAM with the query soft-clipped around the alignment and the ``NM`` (edit
+  distance) and ``AS`` (score) tags,
+* :class:`BinaryWriter`: fixed-width binary records, read back by :func:`read_binary`.
+
+'''
+
+####################################################################################################
+
+import struct
+import sys
+
+####################################################################################################
+
+# buffer of the files opened by the writers
+BUFFER_SIZE = 1 << 16
+
+####################################################################################################
+
+class _Writer(object):
+
+    ''' Base class of the writers, *out* is a file object or a filename, '-' for stdout '''
+
+    mode = 'w'
+    _close = False
+
+    ##############################################
+
+    def __init__(self, out, flush_every=1000):
+
+        if isinstance(out, basestring):
+            if out == '-':
+                out = sys.stdout
+            else:
+                out = open(out, self.mode, BUFFER_SIZE)
+                self._close = True
+        self._out = out
+        self._flush_every = flush_every
+        self._pending = 0
+        self.number_of_records = 0
+
+    ##############################################
+
+    def write(self, alignment, secondary=False):
+
+        ''' Write the record of *alignment*, *secondary* is set for the hits of a query after the
+        first one.
+        '''
+
+        self._out.write(self._record(alignment, secondary))
+        self.number_of_records += 1
+        self._pending += 1
+        if self._flush_every and self._pending >= self._flush_every:
+            self.flush()
+
+    ##############################################
+
+    def _record(self, alignment, secondary):
+        raise NotImplementedError
+
+    ##############################################
+
+    def flush(self):
+
+        self._out.flush()
+        self._pending = 0
+
+    ##############################################
+
+    def close(self):
+
+        if self._close:
+            self._out.close()
+            self._close = False
+        else:
+            self.flush()
+
+    ##############################################
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+####################################################################################################
+
+class SummaryWriter(_Writer):
+
+    ''' Tab-delimited summary of the match locations, the coordinates being 0-based '''
+
+    COLUMNS = ('query', 'ref', 'query_start', 'query_end', 'ref_start', 'ref_end', 'strand',
+               'cigar')
+
+    ##############################################
+
+    def __init__(self, out, flush_every=1000):
+
+        super(SummaryWriter, self).__init__(out, flush_every)
+        self._out.write('%s\n' % '\t'.join(self.COLUMNS))
+
+    ##############################################
+
+    def _record(self, aln, secondary):
+
+        return '%s\n' % '\t'.join([str(x) for x in (aln.q_name, aln.r_name, aln.q_pos, aln.q_end,
+                                                    aln.r_pos + aln.r_offset,
+                                                    aln.r_end + aln.r_offset,
+                                                    '-' if aln.rc else '+', aln.cigar_str)])
+
+####################################################################################################
+
+# SAM flags
+SAM_UNMAPPED = 0x4
+SAM_REVERSE = 0x10
+SAM_SECONDARY = 0x100
+
+class SamWriter(_Writer):
+
+    ''' SAM writer.  *refs* is a list of ``(name, length)`` written as the ``@SQ`` header lines.
+
+    The query of a reverse strand alignment is written reverse-complemented, as it was aligned.
+    An alignment without any aligned base is written as unmapped.
+    '''
+
+    ##############################################
+
+    def __init__(self, out, refs=(), program='swalign', command_line=None, flush_every=1000):
+
+        super(SamWriter, self).__init__(out, flush_every)
+
+        header = ['@HD\tVN:1.6\tSO:unsorted\n']
+        for name, length in refs:
+            header.append('@SQ\tSN:%s\tLN:%s\n' % (name, length))
+        program_line = '@PG\tID:%s\tPN:%s' % (program, program)
+        if command_line:
+            program_line += '\tCL:%s' % command_line
+        header.append(program_line + '\n')
+        self._out.write(''.join(header))
+
+    ##############################################
+
+    def _record(self, aln, secondary):
+
+        query = str(aln.orig_query) or '*'
+        if not aln.cigar:
+            return '%s\t%d\t*\t0\t0\t*\t*\t0\t0\t%s\t*\tAS:i:0\n' % (aln.q_name, SAM_UNMAPPED,
+                                                                    query)
+
+        flag = 0
+        if aln.rc:
+            flag |= SAM_REVERSE
+        if secondary:
+            flag |= SAM_SECONDARY
+
+        cigar = aln.cigar_str
+        if aln.q_pos:
+            cigar = '%dS%s' % (aln.q_pos, cigar)
+        if aln.q_end < len(aln.orig_query):
+            cigar = '%s%dS' % (cigar, len(aln.orig_query) - aln.q_end)
+
+        return '%s\t%d\t%s\t%d\t255\t%s\t*\t0\t0\t%s\t*\tNM:i:%d\tAS:i:%d\n' % (
+            aln.q_name, flag, aln.r_name, aln.r_pos + aln.r_offset +1, cigar, query,
+            aln.mismatches, int(round(aln.score)))
+
+####################################################################################################
+
+# header: magic, version, number of references, then each reference name as a length (unsigned
+# short) and the name
+BINARY_MAGIC = 'SWAB'
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('<4sHI')
+_BINARY_NAME_LENGTH = struct.Struct('<H')
+
+# record: query number (order of the queries in the output), reference index, query start and
+# end, reference start and end, score, strand (0: +, 1: -), secondary flag, matches, mismatches
+BINARY_RECORD = struct.Struct('<IIIIQQdBBxxII')
+
+class BinaryWriter(_Writer):
+
+    ''' Compact binary writer: fixed-width little-endian records of :data:`BINARY_RECORD`.
+
+    The reference names are written once in the header, *ref_names* being their list, and the
+    records give their index.  The queries are numbered in the order they are written, a new
+    number being given each time the query name changes.  The cigar is not kept, the records
+    are meant to locate and rank the hits.
+    '''
+
+    mode = 'wb'
+
+    ##############################################
+
+    def __init__(self, out, ref_names, flush_every=1000):
+
+        super(BinaryWriter, self).__init__(out, flush_every)
+
+        self._ref_indexes = dict((name, i) for i, name in enumerate(ref_names))
+        self._query_number = -1
+        self._query_name = None
+
+        header = [_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(ref_names))]
+        for name in ref_names:
+            header.append(_BINARY_NAME_LENGTH.pack(len(name)))
+            header.append(name)
+        self._out.write(''.join(header))
+
+    ##############################################
+
+    def _record(self, aln, secondary):
+
+        if aln.q_name != self._query_name or self._query_number < 0:
+            self._query_number += 1
+            self._query_name = aln.q_name
+
+        return BINARY_RECORD.pack(self._query_number, self._ref_indexes[aln.r_name],
+                                  aln.q_pos, aln.q_end,
+                                  aln.r_pos + aln.r_offset, aln.r_end + aln.r_offset,
+                                  aln.score, 1 if aln.rc else 0, 1 if secondary else 0,
+                                  aln.matches, aln.mismatches)
+
+####################################################################################################
+
+def read_binary(f):
+
+    ''' Read a file written by :class:`BinaryWriter`, return the list of reference names and a
+    generator of the records as tuples ``(query_number, ref_index, q_pos, q_end, r_pos, r_end,
+    score, rc, secondary, matches, mismatches)``.
+    '''
+
+    magic, version, number_of_refs = _BINARY_HEADER.unpack(f.read(_BINARY_HEADER.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError('Not a swalign binary file')
+    if version != BINARY_VERSION:
+        raise ValueError('Unsupported swalign binary version %s' % version)
+
+    ref_names = []
+    for i in xrange(number_of_refs):
+        length, = _BINARY_NAME_LENGTH.unpack(f.read(_BINARY_NAME_LENGTH.size))
+        ref_names.append(f.read(length))
+
+    def records():
+        size = BINARY_RECORD.size
+        while True:
+            data = f.read(size * 1024)
+            if not data:
+                return
+            if len(data) % size:
+                data += f.read(size - len(data) % size)
+                if len(data) % size:
+                    raise ValueError('Truncated swalign binary file')
+            for offset in xrange(0, len(data), size):
+                record = BINARY_RECORD.unpack_from(data, offset)
+                yield record[:7] + (bool(record[7]), bool(record[8])) + record[9:]
+
+    return ref_names, records()
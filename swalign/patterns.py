@@ -0,0 +1,219 @@
+####################################################################################################
+
+''' Search of a fixed set of short patterns, e.g. adapters and primers, in many reads
+
+A :class:`PatternSet` compiles the patterns once: the patterns and their reverse complements are
+encoded with the score table of the scoring matrix and stacked in a matrix padded to the length of
+the longest one.  Each read is then aligned against all of them in a single pass of the
+anti-diagonal wavefront of :class:`swalign.gotoh_engine.GotohEngine`, the patterns being a leading
+dimension of its buffers: the matrices of every pattern on both strands are computed by the NumPy
+operations of one alignment.
+
+The pattern is the query and the read the reference of the alignments.  The best hit of each
+pattern over the strands is the alignment ``LocalAlignment(..., engine='gotoh').align(read,
+pattern)``, or of the reverse complement of the pattern with ``rc`` set.
+
+'''
+
+####################################################################################################
+
+import time
+
+import numpy as np
+
+from . import Alignment, MODES, _reduce_cigar
+from .gotoh_engine import GotohEngine, GotohMatrix
+from .numpy_engine import EncodedReference, score_dtype, zeros
+from .removed import revcomp
+
+####################################################################################################
+
+def _best_cell(scores, mode, number_of_rows, number_of_cols):
+
+    ''' Return the end cell of an alignment in the H matrix *scores* of a pattern, as chosen by
+    :class:`GotohEngine` in *mode*.
+    '''
+
+    if mode == 'local':
+        # the last cell in row-major order reaching the maximum
+        cells = scores[1:number_of_rows +1, 1:number_of_cols +1].ravel()
+        if not len(cells):
+            return 0, 0, 0
+        i = len(cells) -1 - int(np.argmax(cells[::-1]))
+        row, col = divmod(i, number_of_cols)
+        return cells[i].item(), row +1, col +1
+
+    if mode == 'global':
+        return scores[number_of_rows, number_of_cols].item(), number_of_rows, number_of_cols
+
+    values = scores[number_of_rows, :number_of_cols +1]
+    cells = [(number_of_rows, col) for col in xrange(number_of_cols +1)]
+    if mode == 'overlap':
+        values = np.concatenate((scores[:number_of_rows, number_of_cols], values))
+        cells = [(row, number_of_cols) for row in xrange(number_of_rows)] + cells
+    i = len(values) -1 - int(np.argmax(values[::-1]))
+    return (values[i].item(),) + cells[i]
+
+####################################################################################################
+
+class PatternSet(object):
+
+    ''' Patterns searched in reads with the scoring matrix and penalties of *aligner*.
+
+    *patterns* is an iterable of sequences, or of ``(name, seq)`` or ``(name, seq, comments)``
+    tuples like the generators returned by :func:`swalign.fasta_gen`.  The patterns are searched
+    on the *strands* '+' and '-', the reverse complement of the pattern.
+    '''
+
+    ##############################################
+
+    def __init__(self, aligner, patterns, strands='+-'):
+
+        self._aligner = aligner
+        self._engine = GotohEngine(aligner)
+
+        self.names = []
+        self.patterns = []
+        for item in patterns:
+            if isinstance(item, tuple):
+                name, pattern = item[:2]
+            else:
+                name, pattern = 'pattern%d' % (len(self.names) +1), item
+            if not pattern:
+                raise ValueError("Empty pattern '%s'" % name)
+            self.names.append(name)
+            self.patterns.append(str(pattern))
+        self.strands = strands
+
+        # the queries of the batch, (pattern index, rc, sequence), by pattern then strand
+        self._queries = []
+        for i, pattern in enumerate(self.patterns):
+            for strand in strands:
+                rc = strand == '-'
+                self._queries.append((i, rc, revcomp(pattern) if rc else pattern))
+
+        self._residues = set(''.join(query for i, rc, query in self._queries).upper())
+        self._compile()
+
+    ##############################################
+
+    def _compile(self):
+
+        ''' Encode the queries with a table covering the residues seen so far '''
+
+        aligner = self._aligner
+
+        self._reference = EncodedReference(aligner.scoring_matrix, '', aligner.wildcard,
+                                           ''.join(sorted(self._residues)))
+        table = self._reference.table
+        penalties = [aligner.gap_penalty, aligner.gap_extension_penalty]
+        if aligner.gap_extension_decay:
+            penalties.append(aligner.gap_extension_decay)
+        self._table = table.astype(score_dtype(table, *penalties))
+
+        # the queries shorter than the longest one are padded, the rows below them are ignored
+        length = max([len(query) for i, rc, query in self._queries] or [0])
+        self._query_codes = np.zeros((len(self._queries), length), dtype=np.intp)
+        for codes, (i, rc, query) in zip(self._query_codes, self._queries):
+            codes[:len(query)] = self._reference.encode(query.upper())
+
+    ##############################################
+
+    def _encode(self, read):
+
+        if not self._reference.covers(read):
+            # the table is extended once for the residues of the reads not in the patterns
+            self._residues.update(read)
+            self._compile()
+        return self._reference.encode(read)
+
+    ##############################################
+
+    def search(self, read, read_name='read', mode=None, min_score=None):
+
+        ''' Return the best alignment of each pattern against *read* over the strands, the first
+        strand winning ties, as a list in the order of the patterns.  The patterns scoring less
+        than *min_score* are None.  *mode* is the mode of the aligner by default.
+        '''
+
+        aligner = self._aligner
+        engine = self._engine
+
+        if mode is None:
+            mode = aligner.mode
+        if mode not in MODES:
+            raise ValueError("Unknown alignment mode '%s'" % mode)
+
+        stats = aligner.stats
+        if stats is not None:
+            start = time.time()
+
+        orig_read = read
+        read = read.upper()
+        ref_codes = self._encode(read)
+        table = self._table
+        query_codes = self._query_codes
+
+        number_of_queries, number_of_rows = query_codes.shape
+        number_of_cols = len(read)
+        shape = (number_of_queries, number_of_rows +1, number_of_cols +1)
+        workspace = aligner.workspace
+        traceback = zeros(workspace, 'patterns traceback', shape, np.uint8)
+        scores = zeros(workspace, 'patterns scores', shape, table.dtype)
+
+        if mode == 'local':
+            wavefront = engine._wavefront(table, ref_codes, query_codes, traceback, scores)
+        else:
+            borders = engine._borders(number_of_rows, number_of_cols, mode, table.dtype)
+            wavefront = engine._wavefront(table, ref_codes, query_codes, traceback, scores,
+                                          mode, borders)
+            scores[:, 0, :] = borders[0]
+            scores[:, :, 0] = borders[1]
+        for diagonal in wavefront:
+            pass
+        if stats is not None:
+            filled = time.time()
+
+        # best query of each pattern
+        best = [None] * len(self.patterns)
+        for query_index, (i, rc, query) in enumerate(self._queries):
+            cell = _best_cell(scores[query_index], mode, len(query), number_of_cols)
+            if best[i] is None or cell[0] > best[i][1][0]:
+                best[i] = (query_index, cell)
+
+        alignments = []
+        for item in best:
+            if item is None:
+                alignments.append(None)
+                continue
+            query_index, (max_value, max_row, max_col) = item
+            if min_score is not None and max_value < min_score:
+                alignments.append(None)
+                continue
+            i, rc, query = self._queries[query_index]
+            matrix = GotohMatrix(traceback[query_index, :len(query) +1])
+            row, col, aln, path = engine.backtrack(matrix, max_row, max_col, mode)
+            alignments.append(Alignment(query, orig_read, row, col, _reduce_cigar(aln), max_value,
+                                        read_name, self.names[i], rc, aligner.wildcard))
+
+        if stats is not None:
+            # the backtracks and the alignments are counted as traceback
+            cells = sum(len(query) for i, rc, query in self._queries) * number_of_cols
+            aligner._record(start, filled, time.time(), cells, traceback, 'patterns', read_name)
+
+        return alignments
+
+    ##############################################
+
+    def search_many(self, reads, mode=None, min_score=None):
+
+        ''' Search the patterns in each read of *reads*, sequences or ``(name, seq)`` tuples, and
+        yield the read name and the list returned by :meth:`search`.
+        '''
+
+        for item in reads:
+            if isinstance(item, tuple):
+                read_name, read = item[:2]
+            else:
+                read_name, read = 'read', item
+            yield read_name, self.search(read, read_name, mode, min_score)
@@ -0,0 +1,358 @@
+####################################################################################################
+
+''' Query profile Smith-Waterman engine
+
+The scores of the query against each reference residue are precomputed once as a vector, the
+*query profile*, and the matrix is computed one column at a time, i.e. one reference residue at a
+time, with NumPy operations over the whole query.
+
+Within a column a cell depends on the cell above it (insertion).  When the gap open and extension
+penalties are equal, the column is computed in closed form by a prefix maximum.  Otherwise, like the
+lazy-F loop of Farrar's striped algorithm, the column is first computed ignoring this dependency,
+then corrected until it no longer changes.  Since a cell only depends on the cells above it, the
+fixed point is exactly the column computed cell by cell by :class:`swalign.PythonEngine`.
+
+The profile of a query is kept in it if it is an :class:`swalign.EncodedSequence`, else the profile
+of the last query is kept by the engine, aligning one query against many references only computes it
+once.
+
+'''
+
+####################################################################################################
+
+import numpy as np
+
+from . import Engine
+from .numpy_engine import (OP_NONE, OP_MATCH, OP_INSERTION, OP_DELETION, OP_NULL,
+                           ArrayMatrix, encode_sequence, score_dtype, zeros)
+from .sequence import EncodedSequence
+
+####################################################################################################
+
+def _select(cell_value, mm_value, del_value, ins_value, del_run, ins_run, prefer_gap_runs):
+
+    ''' Return the operations and run lengths of cells, *ins_value* can be None if no insertion is
+    possible.  The choice follows the same priorities as :class:`swalign.PythonEngine`.
+    '''
+
+    is_mm = cell_value == mm_value
+    is_del = cell_value == del_value
+    if ins_value is None:
+        is_ins = np.zeros(len(cell_value), dtype=bool)
+    else:
+        is_ins = cell_value == ins_value
+
+    if prefer_gap_runs:
+        conditions = (is_del & (del_run > 0), is_ins & (ins_run > 0), is_mm, is_del, is_ins)
+        choices = (OP_DELETION, OP_INSERTION, OP_MATCH, OP_DELETION, OP_INSERTION)
+        run_choices = (del_run +1, ins_run +1, 0, 1, 1)
+    else:
+        conditions = (is_mm, is_del, is_ins)
+        choices = (OP_MATCH, OP_DELETION, OP_INSERTION)
+        run_choices = (0, 1, 1)
+
+    return np.select(conditions, choices, OP_NULL), np.select(conditions, run_choices, 0)
+
+####################################################################################################
+
+def _column(cell_value, operations, run_lengths):
+
+    # prepend the cell of row 0
+    scores = np.concatenate((np.zeros(1, dtype=cell_value.dtype), cell_value))
+    operations = np.concatenate((np.array([OP_DELETION], dtype=np.uint8), operations))
+    run_lengths = np.concatenate((np.zeros(1, dtype=np.int32), run_lengths))
+
+    return scores, operations, run_lengths
+
+####################################################################################################
+
+def _insertion_value(up_value, up_ins, gap_penalty, gap_extension_penalty):
+
+    # no penalty to start the alignment
+    return np.where(up_ins,
+                    np.where(up_value == 0, 0, up_value + gap_extension_penalty),
+                    up_value + gap_penalty).astype(up_value.dtype)
+
+####################################################################################################
+
+def _linear_column(base_value, mm_value, del_value, del_run, gap_penalty, prefer_gap_runs):
+
+    ''' Compute a column in closed form when the gap open and extension penalties are equal.
+
+    The score is then ``H[r] = max(B[r], H[r-1] + gap)`` (the insertion starting at a null score
+    can't win over *B* which is positive), i.e. a prefix maximum of ``B[k] - k*gap``.  Whether a
+    cell is an insertion depends on whether the cell above is one, but the answer is either
+    constant or the same as for the cell above, it is thus propagated from the last constant row.
+    '''
+
+    dtype = base_value.dtype
+    number_of_rows = len(base_value)
+    rows = np.arange(number_of_rows +1)
+
+    shifted = np.concatenate((np.zeros(1, dtype=dtype), base_value - gap_penalty * rows[1:]))
+    scores = (np.maximum.accumulate(shifted) + gap_penalty * rows).astype(dtype)
+    cell_value = scores[1:]
+    up_value = scores[:-1]
+
+    ins_value = _insertion_value(up_value, False, gap_penalty, gap_penalty)
+    ins_after_ins_value = _insertion_value(up_value, True, gap_penalty, gap_penalty)
+    no_run = np.zeros(number_of_rows, dtype=np.int32)
+    operations_after_other, run_lengths = _select(cell_value, mm_value, del_value, ins_value,
+                                                  del_run, no_run, prefer_gap_runs)
+    operations_after_ins, run_lengths = _select(cell_value, mm_value, del_value,
+                                                ins_after_ins_value, del_run, no_run +1,
+                                                prefer_gap_runs)
+
+    # row 0 is a deletion
+    is_ins = np.concatenate(([False], operations_after_other == OP_INSERTION))
+    constant = np.concatenate(([True], is_ins[1:] | (operations_after_ins != OP_INSERTION)))
+    is_ins = is_ins[np.maximum.accumulate(np.where(constant, rows, 0))]
+    up_ins = is_ins[:-1]
+
+    # length of the insertion runs
+    runs = rows - np.maximum.accumulate(np.where(is_ins, 0, rows))
+    ins_run = np.where(up_ins, runs[:-1], 0)
+
+    ins_value = np.where(up_ins, ins_after_ins_value, ins_value)
+    operations, run_lengths = _select(cell_value, mm_value, del_value, ins_value, del_run, ins_run,
+                                      prefer_gap_runs)
+
+    return _column(cell_value, operations, run_lengths)
+
+####################################################################################################
+
+def _lazy_f_column(base_value, mm_value, del_value, del_run,
+                   gap_penalty, gap_extension_penalty, prefer_gap_runs):
+
+    ''' Compute a column ignoring the insertions, then propagate them down the column until
+    nothing changes.
+    '''
+
+    no_run = np.zeros(len(base_value), dtype=np.int32)
+    operations, run_lengths = _select(base_value, mm_value, del_value, None, del_run, no_run,
+                                      prefer_gap_runs)
+    scores, operations, run_lengths = _column(base_value, operations, run_lengths)
+
+    while True:
+        up_ins = operations[:-1] == OP_INSERTION
+        ins_value = _insertion_value(scores[:-1], up_ins, gap_penalty, gap_extension_penalty)
+        ins_run = np.where(up_ins, run_lengths[:-1], 0)
+        cell_value = np.maximum(base_value, ins_value)
+        cell_operations, cell_run_lengths = _select(cell_value, mm_value, del_value, ins_value,
+                                                    del_run, ins_run, prefer_gap_runs)
+
+        if (np.array_equal(cell_value, scores[1:])
+            and np.array_equal(cell_operations, operations[1:])
+            and np.array_equal(cell_run_lengths, run_lengths[1:])):
+            return scores, operations, run_lengths
+
+        scores[1:] = cell_value
+        operations[1:] = cell_operations
+        run_lengths[1:] = cell_run_lengths
+
+####################################################################################################
+
+class QueryProfile(object):
+
+    ''' Score vectors of a query against each reference residue, built on demand. '''
+
+    ##############################################
+
+    def __init__(self, scoring_matrix, query, wildcard=None):
+
+        self.scoring_matrix = scoring_matrix
+        self.query = query
+        self.wildcard = wildcard
+
+        self._alphabet = sorted(set(query))
+        encoder = np.zeros(256, dtype=np.intp)
+        for i, residue in enumerate(self._alphabet):
+            encoder[ord(residue)] = i
+        self._query_codes = encode_sequence(encoder, query)
+        self._vectors = {}
+
+    ##############################################
+
+    def __len__(self):
+        return len(self.query)
+
+    ##############################################
+
+    def __getitem__(self, residue):
+
+        vector = self._vectors.get(residue)
+        if vector is None:
+            scores = np.array([self.scoring_matrix.score(one, residue, self.wildcard)
+                               for one in self._alphabet])
+            vector = scores[self._query_codes]
+            self._vectors[residue] = vector
+        return vector
+
+####################################################################################################
+
+class ProfileEngine(Engine):
+
+    ##############################################
+
+    def __init__(self, aligner):
+
+        Engine.__init__(self, aligner)
+        self._profile = None
+
+    ##############################################
+
+    def profile(self, query):
+
+        ''' Return the profile of *query*, kept in *query* if it is an :class:`EncodedSequence`,
+        else the last one is kept, so aligning the same query against many references builds it
+        once.
+        '''
+
+        aligner = self._aligner
+        if isinstance(query, EncodedSequence):
+            key = (self.__class__, 'profile', aligner.scoring_matrix, aligner.wildcard)
+            return query.state(key, lambda: QueryProfile(aligner.scoring_matrix, query,
+                                                         aligner.wildcard))
+        profile = self._profile
+        if (profile is None or profile.query != query
+            or profile.scoring_matrix is not aligner.scoring_matrix
+            or profile.wildcard != aligner.wildcard):
+            profile = self._profile = QueryProfile(aligner.scoring_matrix, query, aligner.wildcard)
+        return profile
+
+    ##############################################
+
+    def _prepare(self, ref, query):
+
+        ''' Return the profile vectors of the residues of *ref* casted to the score dtype '''
+
+        aligner = self._aligner
+        profile = self.profile(query)
+
+        vectors = dict((residue, profile[residue]) for residue in set(ref))
+        dtype = score_dtype(np.concatenate([np.zeros(1, dtype=np.int32)] + vectors.values()),
+                            aligner.gap_penalty, aligner.gap_extension_penalty)
+        for residue, vector in vectors.items():
+            vectors[residue] = vector.astype(dtype)
+
+        return vectors, dtype
+
+    ##############################################
+
+    def _columns(self, ref, query, vectors, dtype, matrix=None):
+
+        ''' Iterate over the columns and yield ``(col, scores)``, scores being indexed by row.
+
+        If *matrix* is given, as a tuple of score, operation and run length arrays indexed by
+        ``[col, row]``, the computed columns are stored in it.
+        '''
+
+        aligner = self._aligner
+
+        dtype = np.dtype(dtype).type
+        gap_penalty = dtype(aligner.gap_penalty)
+        gap_extension_penalty = dtype(aligner.gap_extension_penalty)
+        prefer_gap_runs = aligner.prefer_gap_runs
+
+        number_of_rows = len(query)
+
+        # column 0
+        scores = np.zeros(number_of_rows +1, dtype=dtype)
+        operations = np.empty(number_of_rows +1, dtype=np.uint8)
+        operations.fill(OP_INSERTION)
+        operations[0] = OP_NONE
+        run_lengths = np.zeros(number_of_rows +1, dtype=np.int32)
+
+        # with a linear gap penalty, the scores of a column are a prefix maximum
+        linear_gap = gap_penalty == gap_extension_penalty and gap_penalty <= 0
+
+        for col in xrange(1, len(ref) +1):
+
+            mm_value = scores[:-1] + vectors[ref[col -1]]
+
+            left_value = scores[1:]
+            left_del = operations[1:] == OP_DELETION
+            # no penalty to start the alignment
+            del_value = np.where(left_del,
+                                 np.where(left_value == 0, 0, left_value + gap_extension_penalty),
+                                 left_value + gap_penalty).astype(dtype)
+            del_run = np.where(left_del, run_lengths[1:], 0)
+
+            # best score without insertion
+            base_value = np.maximum(np.maximum(mm_value, del_value), 0)
+
+            if linear_gap:
+                column = _linear_column(base_value, mm_value, del_value, del_run, gap_penalty,
+                                        prefer_gap_runs)
+            else:
+                column = _lazy_f_column(base_value, mm_value, del_value, del_run,
+                                        gap_penalty, gap_extension_penalty, prefer_gap_runs)
+            column_scores, column_operations, column_run_lengths = column
+
+            scores = column_scores
+            operations = column_operations
+            run_lengths = column_run_lengths
+
+            if matrix is not None:
+                matrix[0][col] = scores
+                matrix[1][col] = operations
+                matrix[2][col] = run_lengths
+
+            yield col, scores
+
+    ##############################################
+
+    def fill(self, ref, query, mode='local'):
+
+        vectors, dtype = self._prepare(ref, query)
+
+        number_of_rows = len(query) +1
+        number_of_cols = len(ref) +1
+
+        # columns are stored contiguously, the matrix is a transposed view
+        shape = (number_of_cols, number_of_rows)
+        workspace = self._aligner.workspace
+        columns = [zeros(workspace, 'matrix scores', shape, dtype),
+                   zeros(workspace, 'matrix operations', shape, np.uint8),
+                   zeros(workspace, 'matrix run lengths', shape, np.int32)]
+        columns[1][1:, 0] = OP_DELETION
+        columns[1][0, 1:] = OP_INSERTION
+
+        for column in self._columns(ref, query, vectors, dtype, columns):
+            pass
+
+        scores, operations, run_lengths = [x.T for x in columns]
+
+        max_value, max_row, max_col = 0, 0, 0
+        if number_of_rows > 1 and number_of_cols > 1:
+            # the last cell in row-major order reaching the maximum
+            interior = scores[1:, 1:]
+            max_value = interior.max()
+            rows, cols = np.nonzero(interior == max_value)
+            max_row = int(rows[-1]) +1
+            max_col = int(cols[-1]) +1
+            max_value = max_value.item()
+
+        return ArrayMatrix(scores, operations, run_lengths), max_value, max_row, max_col
+
+    ##############################################
+
+    def score(self, ref, query, mode='local'):
+
+        max_value, max_row, max_col = 0, 0, 0
+        if not len(query) or not len(ref):
+            return max_value, max_row, max_col
+
+        vectors, dtype = self._prepare(ref, query)
+
+        max_value = None
+        for col, scores in self._columns(ref, query, vectors, dtype):
+            cells = scores[1:]
+            value = cells.max()
+            if max_value is None or value >= max_value:
+                # keep the last cell in row-major order: the highest row, then the highest column
+                row = len(cells) - int(np.argmax(cells[::-1] == value))
+                if max_value is None or value > max_value or row >= max_row:
+                    max_value, max_row, max_col = value, row, col
+
+        return max_value.item(), max_row, max_col
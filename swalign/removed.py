@@ -1,6 +1,10 @@
 ####################################################################################################
 
 import StringIO
+import sys
+
+from .cache import LRUCache
+from .sequence import COMPLEMENT, EncodedSequence
 
 ####################################################################################################
 
@@ -17,7 +21,9 @@ class ScoringMatrix(object):
     G 0 0 1 0
     T 0 0 0 1
 
-    Rows and Columns must be in the same order
+    The matrix is compiled into a 2-D lookup table, ``table[code(one)][code(two)]``, where
+    ``codes`` maps each residue, in upper and lower case, to its row.  A residue missing from the
+    matrix raises a ValueError.
 
     '''
 
@@ -36,6 +42,7 @@ class ScoringMatrix(object):
         self.bases = None
         self.wildcard_score = wildcard_score
 
+        rows = {}
         for line in fs:
             if line[0] == '#':
                 continue
@@ -45,10 +52,69 @@ class ScoringMatrix(object):
                 self.base_count = len(self.bases)
             else:
                 cols = line.split()
-                self.scores.extend([int(x) for x in cols[1:]])
+                if cols:
+                    rows[cols[0]] = [int(x) for x in cols[1:]]
 
         fs.close()
 
+        self.codes = {}
+        for i, base in enumerate(self.bases):
+            self.codes[base] = i
+        for i, base in enumerate(self.bases):
+            self.codes.setdefault(base.lower(), i)
+
+        self.table = []
+        for base in self.bases:
+            row = rows.get(base)
+            if row is None or len(row) != self.base_count:
+                raise ValueError("Invalid scoring matrix row for '%s'" % base)
+            self.table.append(row)
+            self.scores.extend(row)
+
+        self._lookups = {}
+
+    ##############################################
+
+    def lookup(self, wildcard=None):
+
+        ''' Return the lookup table as a tuple ``(codes, table)`` taking into account the residues
+        of *wildcard*: if *wildcard_score* is set, their rows and columns are set to it, residues
+        missing from the matrix being appended.
+        '''
+
+        if not self.wildcard_score or not wildcard:
+            return self.codes, self.table
+
+        if wildcard not in self._lookups:
+            codes = dict(self.codes)
+            table = [list(row) for row in self.table]
+            for base in wildcard:
+                if base not in codes:
+                    codes[base] = len(table)
+                    for row in table:
+                        row.append(0)
+                    table.append([0] * (len(table) +1))
+            wildcard_codes = set(codes[base] for base in wildcard)
+            for i, row in enumerate(table):
+                for j in xrange(len(row)):
+                    if i in wildcard_codes or j in wildcard_codes:
+                        row[j] = self.wildcard_score
+            self._lookups[wildcard] = codes, table
+
+        return self._lookups[wildcard]
+
+    ##############################################
+
+    def encode(self, seq, wildcard=None):
+
+        ''' Return the codes of the residues of *seq* in the table returned by :meth:`lookup` '''
+
+        codes = self.lookup(wildcard)[0]
+        try:
+            return [codes[base] for base in seq]
+        except KeyError as e:
+            raise ValueError("Unknown residue '%s' for the scoring matrix" % e.args[0])
+
     ##############################################
 
     def score(self, one, two, wildcard=None):
@@ -56,22 +122,25 @@ class ScoringMatrix(object):
         if self.wildcard_score and wildcard and (one in wildcard or two in wildcard):
             return self.wildcard_score
 
-        one_idx = 0
-        two_idx = 0
-        for i, b in enumerate(self.bases):
-            if b == one:
-                one_idx = i
-            if b == two:
-                two_idx = i
-
-        return self.scores[(one_idx * self.base_count) + two_idx]
+        try:
+            return self.table[self.codes[one]][self.codes[two]]
+        except KeyError as e:
+            raise ValueError("Unknown residue '%s' for the scoring matrix" % e.args[0])
 
 ####################################################################################################
 
-def fasta_gen(fname):
+def fasta_gen(fname, encoded=False):
+
+    ''' Return a generator function yielding the sequences of a FASTA file as ``(name, seq,
+    comments)`` tuples, the sequences being :class:`EncodedSequence` if *encoded* is set.
+    '''
+
+    def make_seq(seq):
+        seq = ''.join(seq)
+        return EncodedSequence(seq) if encoded else seq
 
     def gen():
-        seq = ''
+        seq = []
         name = ''
         comments = ''
 
@@ -84,7 +153,7 @@ def fasta_gen(fname):
         for line in f:
             if line[0] == '>':
                 if name and seq:
-                    yield (name, seq, comments)
+                    yield (name, make_seq(seq), comments)
 
                 spl = line[1:].strip().split(' ', 1)
                 name = spl[0]
@@ -93,12 +162,12 @@ def fasta_gen(fname):
                 else:
                     comments = ''
 
-                seq = ''
+                seq = []
             else:
-                seq += line.strip()
+                seq.append(line.strip())
 
         if name and seq:
-            yield (name, seq, comments)
+            yield (name, make_seq(seq), comments)
 
         if fname != '-':
             f.close()
@@ -146,25 +215,26 @@ def extract_region(comments):
 
 ####################################################################################################
 
-__revcomp = {}
-for a, b in zip('atcgATCGNn', 'tagcTAGCNn'):
-    __revcomp[a] = b
-__cache = {}
+# reverse complements of the last sequences, for the queries aligned against many references
+revcomp_cache = LRUCache(max_entries=1024, max_bytes=16 * 2**20)
 
 ####################################################################################################
 
 def revcomp(seq):
 
-    if seq in __cache:
-        return __cache[seq]
+    ''' Return the reverse complement of *seq* in upper case, IUPAC codes are complemented and the
+    other residues are kept.  The results are kept in :data:`revcomp_cache`.
+    '''
 
-    ret = []
-    for s in seq.upper()[::-1]:
-        ret.append(__revcomp[s])
+    if isinstance(seq, EncodedSequence):
+        return seq.revcomp()
 
-    __cache[seq] = ''.join(ret)
+    ret = revcomp_cache.get(seq)
+    if ret is None:
+        ret = seq.upper().translate(COMPLEMENT)[::-1]
+        revcomp_cache.put(seq, ret)
 
-    return __cache[seq]
+    return ret
 
 ####################################################################################################
 # 
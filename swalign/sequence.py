@@ -0,0 +1,174 @@
+####################################################################################################
+
+''' Encoded nucleotide sequences
+
+An :class:`EncodedSequence` is built once from a string and keeps everything the aligners compute
+from a sequence: the upper-case sequence and, when first asked, one byte code per base (A, C, G, T
+as 0 to 3, any other residue as 4), the mask of the other residues (N and wildcards), its reverse
+complement and the states the engines derive from it, e.g. its codes in the score table of a
+scoring matrix.  It can be passed instead of a string to :meth:`LocalAlignment.align`,
+:class:`Alignment`, :func:`revcomp` and the readers, so that aligning many queries against the same
+reference doesn't upper-case, encode or reverse it again.
+
+'''
+
+####################################################################################################
+
+import string
+
+####################################################################################################
+
+UNKNOWN = 4
+
+_CODES = ['\x04'] * 256
+for _i, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _base in _bases:
+        _CODES[ord(_base)] = chr(_i)
+_CODES = ''.join(_CODES)
+
+_MASK = string.maketrans('\x00\x01\x02\x03\x04', '\x00\x00\x00\x00\x01')
+
+# complement of the IUPAC codes, other residues are kept
+COMPLEMENT = string.maketrans('ACGTURYKMBVDHSWNacgturykmbvdhswn',
+                             'TGCAAYRMKVBHDSWNTGCAAYRMKVBHDSWN')
+
+####################################################################################################
+
+class EncodedSequence(object):
+
+    ''' Sequence with its upper-case copy, base codes, unknown base mask, reverse complement and
+    engine states.
+
+    It behaves as the original string for ``len``, indexing, iteration and ``str``, and
+    :meth:`upper` returns the cached upper-case sequence.  Only the sequence is pickled.
+    '''
+
+    ##############################################
+
+    def __init__(self, seq):
+
+        if isinstance(seq, EncodedSequence):
+            seq = seq.seq
+        self.seq = seq
+        self._upper = seq if seq.isupper() else seq.upper()
+        self._upper_sequence = None
+        self._codes = None
+        self._mask = None
+        self._revcomp = None
+        self._states = {}
+
+    ##############################################
+
+    def __getstate__(self):
+        return dict(seq=self.seq)
+
+    def __setstate__(self, state):
+        self.__init__(state['seq'])
+
+    ##############################################
+
+    @property
+    def codes(self):
+
+        ''' String of the base codes, :data:`UNKNOWN` for the residues other than A, C, G and T '''
+
+        if self._codes is None:
+            self._codes = self._upper.translate(_CODES)
+        return self._codes
+
+    ##############################################
+
+    @property
+    def mask(self):
+
+        ''' String of bytes set to 1 for the bases other than A, C, G and T '''
+
+        if self._mask is None:
+            self._mask = self.codes.translate(_MASK)
+        return self._mask
+
+    ##############################################
+
+    @property
+    def number_of_unknown_bases(self):
+        return self.codes.count(chr(UNKNOWN))
+
+    ##############################################
+
+    def upper(self):
+        return self._upper
+
+    ##############################################
+
+    def upper_sequence(self):
+
+        ''' Return the upper-case sequence as an :class:`EncodedSequence`, itself if it is in upper
+        case.  The aligners pass it to the engines, which keep their states in it.
+        '''
+
+        if self._upper is self.seq:
+            return self
+        if self._upper_sequence is None:
+            self._upper_sequence = EncodedSequence(self._upper)
+        return self._upper_sequence
+
+    ##############################################
+
+    def state(self, key, build):
+
+        ''' Return the state of *key*, computed by ``build()`` the first time: the engines keep
+        what they derive from the sequence for the lifetime of the sequence.
+        '''
+
+        try:
+            return self._states[key]
+        except KeyError:
+            state = self._states[key] = build()
+            return state
+
+    ##############################################
+
+    def revcomp(self):
+
+        ''' Return the reverse complement, in upper case, as an :class:`EncodedSequence` '''
+
+        if self._revcomp is None:
+            self._revcomp = EncodedSequence(self._upper.translate(COMPLEMENT)[::-1])
+            self._revcomp._revcomp = self
+        return self._revcomp
+
+    ##############################################
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self, index):
+        return self.seq[index]
+
+    def __iter__(self):
+        return iter(self.seq)
+
+    def __str__(self):
+        return self.seq
+
+    def __repr__(self):
+        return 'EncodedSequence(%r)' % self.seq
+
+    def __eq__(self, other):
+        return self.seq == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.seq)
+
+####################################################################################################
+
+def upper(seq):
+
+    ''' Return *seq* in upper case, an :class:`EncodedSequence` staying encoded '''
+
+    if isinstance(seq, EncodedSequence):
+        return seq.upper_sequence()
+    return seq.upper()
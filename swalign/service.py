@@ -0,0 +1,526 @@
+####################################################################################################
+
+''' Alignment service: queued, batched alignments in a pool of processes
+
+:class:`AlignmentService` accepts alignment requests from any thread and returns a future at once.
+A dispatcher thread drains the queue, groups the requests sharing the same aligner and reference and
+sends each group as one job to a pool of processes, so the reference and the aligner are only sent
+once per batch and the alignments never hold the caller's GIL.  The number of pending requests is
+bounded: when the limit is reached, :meth:`AlignmentService.submit` waits for a slot, up to a
+timeout, and raises :class:`ServiceBusy`.
+
+:class:`AlignmentServer` exposes a service on a local TCP or Unix socket with a protocol of one JSON
+object per line, answers being sent as soon as they are ready, tagged with the ``id`` of the
+request.  An asyncio backend can thus await alignments without blocking its event loop::
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', 8765)
+    writer.write(json.dumps({'id': 1, 'ref': ref, 'query': query}).encode() + b'\\n')
+    answer = json.loads(await reader.readline())
+
+Requests may give ``ref`` or the ``ref_name`` of a reference loaded by the server, the scoring
+parameters (``match``, ``mismatch``, ``matrix``, the name of a bundled matrix, ``gap_penalty``,
+``gap_extension_penalty``, ``gap_extension_decay``, ``wildcard``, ``engine``) and a ``timeout`` in
+seconds.
+
+'''
+
+####################################################################################################
+
+import Queue
+import SocketServer
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
+
+from . import Alignment, LocalAlignment, NucleotideScoringMatrix
+from .cache import LRUCache
+from .matrices import BUNDLED_MATRICES, load_scoring_matrix
+from .removed import fasta_gen
+
+####################################################################################################
+
+class ServiceBusy(Exception):
+    pass
+
+####################################################################################################
+
+class AlignmentFuture(object):
+
+    ''' Result of a request to an :class:`AlignmentService` '''
+
+    ##############################################
+
+    def __init__(self):
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    ##############################################
+
+    def done(self):
+        return self._event.is_set()
+
+    ##############################################
+
+    def result(self, timeout=None):
+
+        ''' Return the :class:`Alignment`, waiting at most *timeout* seconds, else raise
+        :class:`multiprocessing.TimeoutError`.  An error of the alignment is raised again.
+        '''
+
+        if not self._event.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    ##############################################
+
+    def add_done_callback(self, callback):
+
+        ''' Call ``callback(future)`` when the result is ready, from the thread setting it, e.g.
+        ``loop.call_soon_threadsafe`` to wake up an event loop.
+        '''
+
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    ##############################################
+
+    def _set(self, result=None, error=None):
+
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                # don't break the thread of the pool delivering the results
+                sys.stderr.write('Error in alignment callback: %s\n' % e)
+
+####################################################################################################
+
+def _picklable_error(error):
+
+    # the errors are sent back by the pool, which doesn't call the callback of a job whose result
+    # can't be pickled, and raised again by AlignmentFuture.result
+
+    if isinstance(error, Exception):
+        try:
+            pickle.dumps(error)
+            return error
+        except Exception:
+            pass
+    return RuntimeError('%s: %s' % (error.__class__.__name__, error))
+
+####################################################################################################
+
+def _align_batch_job(aligner, ref, queries):
+
+    # never raise: the pool of Python 2 has no error callback, the futures of a failed job would
+    # never complete
+
+    try:
+        results = []
+        for query in queries:
+            try:
+                aln = aligner.align(ref, query)
+                results.append((aln.q_pos, aln.r_pos, aln.cigar, aln.score))
+            except Exception as e:
+                results.append(_picklable_error(e))
+        return results
+    except BaseException as e:
+        return [_picklable_error(e)] * len(queries)
+
+####################################################################################################
+
+class AlignmentService(object):
+
+    ''' Align requests in *processes* worker processes (the number of CPUs if None, the dispatcher
+    thread if 1).  At most *max_pending* requests are queued or running, and a batch holds at most
+    *max_batch* requests.
+    '''
+
+    ##############################################
+
+    def __init__(self, processes=None, max_pending=1024, max_batch=64):
+
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+
+        self._pool = None if processes == 1 else multiprocessing.Pool(processes)
+        self._requests = Queue.Queue()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._closed = False
+
+        self.number_of_requests = 0
+        self.number_of_batches = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    ##############################################
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ##############################################
+
+    @property
+    def pending(self):
+        return self._pending
+
+    ##############################################
+
+    def submit(self, aligner, ref, query, ref_name='ref', query_name='query', rc=False,
+               timeout=None):
+
+        ''' Queue the alignment of *query* against *ref* with the :class:`LocalAlignment`
+        *aligner* and return an :class:`AlignmentFuture`.  If *max_pending* requests are pending,
+        wait at most *timeout* seconds for one to complete, then raise :class:`ServiceBusy`.
+        '''
+
+        if self._closed:
+            raise ValueError('The alignment service is closed')
+
+        with self._condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while self._pending >= self.max_pending:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ServiceBusy('%s alignments pending' % self._pending)
+                    self._condition.wait(remaining)
+            self._pending += 1
+            self.number_of_requests += 1
+
+        future = AlignmentFuture()
+        self._requests.put((aligner, ref, query, ref_name, query_name, rc, future))
+        return future
+
+    ##############################################
+
+    def align(self, aligner, ref, query, ref_name='ref', query_name='query', rc=False,
+              timeout=None):
+
+        ''' Submit a request and wait at most *timeout* seconds for its :class:`Alignment` '''
+
+        return self.submit(aligner, ref, query, ref_name, query_name, rc, timeout).result(timeout)
+
+    ##############################################
+
+    def close(self):
+
+        ''' Align the queued requests and stop the service '''
+
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._dispatcher.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    ##############################################
+
+    def _dispatch(self):
+
+        stop = False
+        while not stop:
+            requests = [self._requests.get()]
+            # take the requests queued meanwhile, to batch them
+            while True:
+                try:
+                    requests.append(self._requests.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in requests:
+                stop = True
+                requests = [request for request in requests if request is not None]
+
+            groups = collections.OrderedDict()
+            for request in requests:
+                groups.setdefault((id(request[0]), request[1]), []).append(request)
+            for group in groups.itervalues():
+                for start in xrange(0, len(group), self.max_batch):
+                    self._submit_batch(group[start:start + self.max_batch])
+
+    ##############################################
+
+    def _submit_batch(self, batch):
+
+        aligner, ref = batch[0][:2]
+        queries = [request[2] for request in batch]
+        self.number_of_batches += 1
+
+        def callback(results):
+            # called by the result thread of the pool, which must not raise
+            for job, result in zip(batch, results):
+                aligner, ref, query, ref_name, query_name, rc, future = job
+                if isinstance(result, BaseException):
+                    future._set(error=result)
+                    continue
+                try:
+                    q_pos, r_pos, cigar, score = result
+                    aln = Alignment(query, ref, q_pos, r_pos, cigar, score,
+                                    ref_name, query_name, rc, aligner.wildcard)
+                except Exception as e:
+                    future._set(error=e)
+                else:
+                    future._set(aln)
+            with self._condition:
+                self._pending -= len(batch)
+                self._condition.notify_all()
+
+        if self._pool is None:
+            callback(_align_batch_job(aligner, ref, queries))
+        else:
+            self._pool.apply_async(_align_batch_job, (aligner, ref, queries), callback=callback)
+
+####################################################################################################
+
+class _AlignmentHandler(SocketServer.StreamRequestHandler):
+
+    ##############################################
+
+    def handle(self):
+
+        self._write_lock = threading.Lock()
+        self._outstanding = 0
+        self._done = threading.Condition()
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                future = self.server.submit(request)
+            except Exception as e:
+                self._respond(request_id, error=e)
+                continue
+            self._wait_for(request_id, future, request.get('timeout'))
+
+        with self._done:
+            while self._outstanding:
+                self._done.wait()
+
+    ##############################################
+
+    def _wait_for(self, request_id, future, timeout):
+
+        answered = []
+
+        def answer(result=None, error=None):
+            with self._write_lock:
+                if answered:
+                    return
+                answered.append(True)
+            self._respond(request_id, result, error)
+            with self._done:
+                self._outstanding -= 1
+                self._done.notify_all()
+
+        timer = None
+
+        def on_done(future):
+            if timer is not None:
+                timer.cancel()
+            try:
+                answer(future.result())
+            except Exception as e:
+                answer(error=e)
+
+        with self._done:
+            self._outstanding += 1
+        if timeout is not None:
+            timer = threading.Timer(timeout, answer,
+                                    kwargs=dict(error=multiprocessing.TimeoutError('timeout')))
+            timer.daemon = True
+            timer.start()
+        future.add_done_callback(on_done)
+
+    ##############################################
+
+    def _respond(self, request_id, aln=None, error=None):
+
+        if error is not None:
+            answer = dict(id=request_id, error='%s: %s' % (error.__class__.__name__, error))
+        else:
+            answer = dict(id=request_id, score=aln.score, cigar=aln.cigar_str,
+                          q_pos=aln.q_pos, q_end=aln.q_end, r_pos=aln.r_pos, r_end=aln.r_end,
+                          matches=aln.matches, mismatches=aln.mismatches, identity=aln.identity,
+                          ref_name=aln.r_name, query_name=aln.q_name, rc=aln.rc)
+        try:
+            with self._write_lock:
+                self.wfile.write(json.dumps(answer) + '\n')
+                self.wfile.flush()
+        except IOError:
+            # the client is gone
+            pass
+
+####################################################################################################
+
+class _ServerMixIn(SocketServer.ThreadingMixIn):
+
+    daemon_threads = True
+
+    ##############################################
+
+    def _setup(self, service, refs=None, submit_timeout=0, max_aligners=64):
+
+        self.service = service
+        self.refs = dict((name, seq) for name, seq, comments in refs or ())
+        self.submit_timeout = submit_timeout
+        # the parameters come from the clients, only the last used aligners are kept
+        self._aligners = LRUCache(max_aligners, sizeof=lambda key, value: 0)
+        self._aligners_lock = threading.Lock()
+
+    ##############################################
+
+    def aligner(self, match=2, mismatch=-1, matrix=None, gap_penalty=-1, gap_extension_penalty=-1,
+                gap_extension_decay=0.0, wildcard=None, engine='python'):
+
+        ''' Return the aligner of the parameters, requests with the same parameters share it and are
+        thus batched together.  *matrix* is the name of a bundled matrix, the clients can't read
+        the files of the server.
+        '''
+
+        if matrix and matrix.upper() not in BUNDLED_MATRICES:
+            raise ValueError('Unknown matrix %s, expected one of %s'
+                             % (matrix, ', '.join(BUNDLED_MATRICES)))
+
+        key = (match, mismatch, matrix and matrix.upper(), gap_penalty, gap_extension_penalty,
+               gap_extension_decay, wildcard, engine)
+        with self._aligners_lock:
+            aligner = self._aligners.get(key)
+            if aligner is None:
+                if matrix:
+                    scoring = load_scoring_matrix(matrix)
+                else:
+                    scoring = NucleotideScoringMatrix(match, mismatch)
+                aligner = LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                         gap_extension_decay, wildcard=wildcard, engine=engine)
+                self._aligners.put(key, aligner)
+            return aligner
+
+    ##############################################
+
+    def submit(self, request):
+
+        parameters = dict((str(name), request[name])
+                          for name in ('match', 'mismatch', 'matrix', 'gap_penalty',
+                                       'gap_extension_penalty', 'gap_extension_decay', 'wildcard',
+                                       'engine')
+                          if request.get(name) is not None)
+        for name in ('matrix', 'wildcard', 'engine'):
+            if name in parameters:
+                parameters[name] = str(parameters[name])
+        aligner = self.aligner(**parameters)
+
+        ref_name = str(request.get('ref_name', 'ref'))
+        if 'ref' in request:
+            ref = str(request['ref'])
+        elif ref_name in self.refs:
+            ref = self.refs[ref_name]
+        else:
+            raise KeyError('Unknown reference %s' % ref_name)
+
+        return self.service.submit(aligner, ref, str(request['query']), ref_name,
+                                   str(request.get('query_name', 'query')),
+                                   bool(request.get('rc', False)), self.submit_timeout)
+
+####################################################################################################
+
+class AlignmentServer(_ServerMixIn, SocketServer.TCPServer):
+
+    ''' Serve *service* on the TCP *address*, a ``(host, port)`` tuple.  *refs* are ``(name, seq,
+    comments)`` tuples which can be referred to by name.  When the service is busy, a request
+    waits at most *submit_timeout* seconds before being answered by an error.  The aligners of
+    the *max_aligners* last used sets of parameters are kept.
+    '''
+
+    allow_reuse_address = True
+
+    def __init__(self, address, service, refs=None, submit_timeout=0, max_aligners=64):
+
+        SocketServer.TCPServer.__init__(self, address, _AlignmentHandler)
+        self._setup(service, refs, submit_timeout, max_aligners)
+
+####################################################################################################
+
+class UnixAlignmentServer(_ServerMixIn, SocketServer.UnixStreamServer):
+
+    ''' Serve *service* on the Unix socket *path*, see :class:`AlignmentServer` '''
+
+    def __init__(self, path, service, refs=None, submit_timeout=0, max_aligners=64):
+
+        SocketServer.UnixStreamServer.__init__(self, path, _AlignmentHandler)
+        self._setup(service, refs, submit_timeout, max_aligners)
+
+####################################################################################################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Alignment server (one JSON request per line)')
+    parser.add_argument('-host', default='127.0.0.1',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('-port', type=int, default=8765, help='TCP port (default: %(default)s)')
+    parser.add_argument('-unix', metavar='PATH', help='Listen on a Unix socket instead')
+    parser.add_argument('-refs', metavar='FASTA', help='References which can be requested by name')
+    parser.add_argument('-p', dest='processes', type=int, default=0,
+                        help='Number of processes (default: the number of CPUs)')
+    parser.add_argument('-max-pending', dest='max_pending', type=int, default=1024,
+                        help='Maximum number of pending alignments (default: %(default)s)')
+    parser.add_argument('-max-batch', dest='max_batch', type=int, default=64,
+                        help='Maximum number of alignments per batch (default: %(default)s)')
+    parser.add_argument('-submit-timeout', dest='submit_timeout', type=float, default=0,
+                        help='Seconds a request waits when the server is busy (default: 0)')
+    args = parser.parse_args(argv)
+
+    refs = list(fasta_gen(args.refs)()) if args.refs else None
+    service = AlignmentService(args.processes or None, args.max_pending, args.max_batch)
+    if args.unix:
+        server = UnixAlignmentServer(args.unix, service, refs, args.submit_timeout)
+    else:
+        server = AlignmentServer((args.host, args.port), service, refs, args.submit_timeout)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix:
+            os.unlink(args.unix)
+        service.close()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
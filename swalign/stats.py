@@ -0,0 +1,168 @@
+####################################################################################################
+
+''' Opt-in instrumentation of the aligner
+
+An :class:`AlignmentStats` given to :class:`LocalAlignment` as ``stats`` collects:
+
+* the time spent in each phase: ``fill`` (matrix), ``traceback``, ``alignment`` (building the
+  :class:`Alignment`) and the phases timed by the caller, e.g. ``parse`` and ``dump`` in
+  ``bin/swalign``,
+* the number of alignments and of matrix cells computed,
+* the time spent aligning each query and against each reference,
+* the peak size of a matrix in bytes.
+
+When ``stats`` is None, the default, the aligner only tests it once per alignment.  The stats
+collected by the worker processes of :mod:`swalign.batch` are merged in the ones of the aligner.
+
+'''
+
+####################################################################################################
+
+import json
+import time
+
+####################################################################################################
+
+def matrix_nbytes(matrix):
+
+    ''' Return the size in bytes of a matrix returned by an engine, 0 if unknown '''
+
+    return getattr(matrix, 'nbytes', 0)
+
+####################################################################################################
+
+class _Timer(object):
+
+    ##############################################
+
+    def __init__(self, stats, phase):
+
+        self._stats = stats
+        self._phase = phase
+
+    ##############################################
+
+    def __enter__(self):
+
+        self._start = time.time()
+        return self
+
+    ##############################################
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._stats.add(self._phase, time.time() - self._start)
+
+####################################################################################################
+
+class AlignmentStats(object):
+
+    ##############################################
+
+    def __init__(self):
+
+        self.started = time.time()
+        # phase -> [count, seconds]
+        self.phases = {}
+        self.alignments = 0
+        self.cells = 0
+        self.peak_matrix_bytes = 0
+        # name -> [count, seconds]
+        self.queries = {}
+        self.refs = {}
+
+    ##############################################
+
+    def add(self, phase, seconds, count=1):
+
+        value = self.phases.get(phase)
+        if value is None:
+            value = self.phases[phase] = [0, 0.]
+        value[0] += count
+        value[1] += seconds
+
+    ##############################################
+
+    def add_alignment(self, query_name, ref_name, seconds, cells, matrix_bytes=0):
+
+        ''' Record an alignment of *query_name* against *ref_name* '''
+
+        self.alignments += 1
+        self.cells += cells
+        if matrix_bytes > self.peak_matrix_bytes:
+            self.peak_matrix_bytes = matrix_bytes
+        for names, name in ((self.queries, query_name), (self.refs, ref_name)):
+            value = names.get(name)
+            if value is None:
+                value = names[name] = [0, 0.]
+            value[0] += 1
+            value[1] += seconds
+
+    ##############################################
+
+    def timer(self, phase):
+
+        ''' Return a context manager adding the time spent in its block to *phase* '''
+
+        return _Timer(self, phase)
+
+    ##############################################
+
+    def timed(self, phase, iterable):
+
+        ''' Iterate over *iterable*, adding the time spent to get each item to *phase* '''
+
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time.time() - start, 0)
+                return
+            self.add(phase, time.time() - start)
+            yield item
+
+    ##############################################
+
+    def merge(self, other):
+
+        ''' Add the counters of *other*, e.g. collected by a worker process '''
+
+        for phase, (count, seconds) in other.phases.items():
+            self.add(phase, seconds, count)
+        self.alignments += other.alignments
+        self.cells += other.cells
+        self.peak_matrix_bytes = max(self.peak_matrix_bytes, other.peak_matrix_bytes)
+        for names, other_names in ((self.queries, other.queries), (self.refs, other.refs)):
+            for name, (count, seconds) in other_names.items():
+                value = names.get(name)
+                if value is None:
+                    value = names[name] = [0, 0.]
+                value[0] += count
+                value[1] += seconds
+
+    ##############################################
+
+    def as_dict(self):
+
+        def timings(names):
+            return dict((name, dict(count=count, seconds=seconds))
+                        for name, (count, seconds) in names.items())
+
+        fill_seconds = self.phases.get('fill', (0, 0.))[1]
+        return dict(wall_seconds=time.time() - self.started,
+                    phases=timings(self.phases),
+                    alignments=self.alignments,
+                    cells=self.cells,
+                    cells_per_second=self.cells / fill_seconds if fill_seconds else None,
+                    peak_matrix_bytes=self.peak_matrix_bytes,
+                    queries=timings(self.queries),
+                    refs=timings(self.refs))
+
+    ##############################################
+
+    def write_json(self, filename):
+
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
@@ -0,0 +1,112 @@
+####################################################################################################
+
+''' Buffers kept between alignments
+
+A :class:`Workspace` keeps the matrices and rows allocated by the engines, so that aligning
+sequences of similar sizes again reuses them instead of allocating new ones.  A buffer grows
+geometrically, at least doubling its capacity, and the buffers are released when keeping them
+would exceed the memory cap of the workspace.
+
+Each :class:`LocalAlignment` has one workspace per thread, see :attr:`LocalAlignment.workspace`.
+A buffer returned by a workspace is only valid until it is asked again, i.e. a matrix returned by
+an engine is overwritten by the next alignment of the same aligner in the same thread.
+
+'''
+
+####################################################################################################
+
+import array
+import ctypes
+
+####################################################################################################
+
+# default memory cap of a workspace
+MAX_BYTES = 64 * 2**20
+
+####################################################################################################
+
+class Workspace(object):
+
+    ''' Named buffers totalling at most *max_bytes*, 0 keeps no buffer '''
+
+    ##############################################
+
+    def __init__(self, max_bytes=MAX_BYTES):
+
+        self.max_bytes = max_bytes
+        # name -> (capacity, nbytes, buffer)
+        self._buffers = {}
+        self.bytes = 0
+        self.allocations = 0
+        self.releases = 0
+
+    ##############################################
+
+    @property
+    def stats(self):
+
+        return dict(buffers=len(self._buffers), bytes=self.bytes, allocations=self.allocations,
+                    releases=self.releases)
+
+    ##############################################
+
+    def buffer(self, name, size, allocate, itemsize):
+
+        ''' Return the buffer *name* holding at least *size* items of *itemsize* bytes, its content
+        being undefined.  ``allocate(capacity)`` returns a new buffer of *capacity* items.
+        '''
+
+        entry = self._buffers.get(name)
+        if entry is not None and entry[0] >= size:
+            return entry[2]
+
+        if entry is not None:
+            capacity = max(size, 2 * entry[0])
+            self._release(name)
+        else:
+            capacity = size
+
+        self.allocations += 1
+        nbytes = capacity * itemsize
+        if nbytes > self.max_bytes:
+            # too large to be kept, the exact size is enough
+            return allocate(size)
+
+        if self.bytes + nbytes > self.max_bytes:
+            self.release()
+        buffer = allocate(capacity)
+        self._buffers[name] = (capacity, nbytes, buffer)
+        self.bytes += nbytes
+        return buffer
+
+    ##############################################
+
+    def _release(self, name):
+
+        capacity, nbytes, buffer = self._buffers.pop(name)
+        self.bytes -= nbytes
+        self.releases += 1
+
+    ##############################################
+
+    def release(self):
+
+        ''' Release all the buffers '''
+
+        for name in self._buffers.keys():
+            self._release(name)
+
+    ##############################################
+
+    def array(self, name, typecode, size, fill_byte=0):
+
+        ''' Return an :class:`array.array` of at least *size* items whose *size* first items are
+        set to bytes *fill_byte*, e.g. 0 for zeros and 255 for -1.
+        '''
+
+        itemsize = array.array(typecode).itemsize
+        buffer = self.buffer((name, typecode), size,
+                             lambda capacity: array.array(typecode, [0]) * capacity, itemsize)
+        if size:
+            ctypes.memset(buffer.buffer_info()[0], fill_byte, size * itemsize)
+        return buffer
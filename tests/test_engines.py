@@ -0,0 +1,303 @@
+####################################################################################################
+
+''' Randomised equivalence tests of the alignment engines
+
+The engines must give the same alignments as :class:`swalign.PythonEngine`, the reference
+implementation.  The sequences are drawn with a fixed seed, over small alphabets and from repeats so
+that many alignments have equal scores.
+
+    python -m unittest discover tests
+
+'''
+
+####################################################################################################
+
+import random
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import swalign
+from swalign.bitparallel import BitParallelEngine
+
+####################################################################################################
+
+def _random_sequences(seed, number_of_pairs, max_length=40):
+
+    ''' Return *number_of_pairs* pairs of reference and query, random or made of repeats '''
+
+    rand = random.Random(seed)
+    pairs = []
+    for i in xrange(number_of_pairs):
+        alphabet = rand.choice(('ACGT', 'AC', 'A', 'ACGTN'))
+        if rand.random() < .25:
+            unit = ''.join(rand.choice(alphabet) for j in xrange(rand.randint(1, 3)))
+            ref = unit * rand.randint(1, max_length // len(unit))
+            query = unit * rand.randint(1, max_length // len(unit))
+        else:
+            ref = ''.join(rand.choice(alphabet) for j in xrange(rand.randint(1, max_length)))
+            query = ''.join(rand.choice(alphabet) for j in xrange(rand.randint(1, max_length)))
+        if rand.random() < .25:
+            # a query taken from the reference with a few edits
+            start = rand.randint(0, len(ref) -1)
+            query = list(ref[start:start + rand.randint(1, max_length)])
+            for j in xrange(rand.randint(0, 3)):
+                position = rand.randint(0, len(query))
+                query[position:position +rand.randint(0, 1)] = rand.choice(('', 'G', 'TT'))
+            query = ''.join(query) or 'A'
+        pairs.append((ref, query))
+    return pairs
+
+####################################################################################################
+
+class EngineTestCase(unittest.TestCase):
+
+    ##############################################
+
+    def assert_same_alignment(self, expected, aligner, ref, query):
+
+        alignment = aligner.align(ref, query)
+        message = '%s / %s' % (ref, query)
+        self.assertEqual(alignment.score, expected.score, message)
+        self.assertEqual(type(alignment.score), type(expected.score), message)
+        self.assertEqual(alignment.cigar, expected.cigar, message)
+        self.assertEqual((alignment.q_pos, alignment.r_pos), (expected.q_pos, expected.r_pos),
+                         message)
+
+####################################################################################################
+
+class TestBitParallelEngine(EngineTestCase):
+
+    ##############################################
+
+    def aligners(self, prefer_gap_runs):
+
+        scoring = swalign.IdentityScoringMatrix(1, -1)
+        reference = swalign.LocalAlignment(scoring, -1, -1, prefer_gap_runs=prefer_gap_runs,
+                                           bit_parallel=False)
+        aligner = swalign.LocalAlignment(scoring, -1, -1, prefer_gap_runs=prefer_gap_runs)
+        self.assertTrue(isinstance(aligner._engine, BitParallelEngine))
+        self.assertTrue(aligner._engine.supports())
+        return reference, aligner
+
+    ##############################################
+
+    def test_alignments(self):
+
+        for prefer_gap_runs in (True, False):
+            reference, aligner = self.aligners(prefer_gap_runs)
+            for ref, query in _random_sequences(25, 300, max_length=70):
+                expected = reference.align(ref, query)
+                self.assert_same_alignment(expected, aligner, ref, query)
+                self.assertEqual(aligner.score_only(ref, query),
+                                 reference.score_only(ref, query))
+
+    ##############################################
+
+    def test_cells(self):
+
+        ''' The cells of a traceback: score, operation and run length '''
+
+        for prefer_gap_runs in (True, False):
+            reference, aligner = self.aligners(prefer_gap_runs)
+            for ref, query in _random_sequences(2500, 100):
+                matrix = aligner._engine.fill(ref, query)[0]
+                expected_matrix = reference._engine.fill(ref, query)[0]
+                for row in xrange(1, len(query) +1):
+                    for col in xrange(1, len(ref) +1):
+                        expected = expected_matrix.get(row, col)
+                        if expected.score <= 0:
+                            continue
+                        cell = matrix.get(row, col)
+                        self.assertEqual((cell.score, cell.op, cell.run_length),
+                                         (expected.score, expected.op, expected.run_length),
+                                         '%s / %s at %s' % (ref, query, (row, col)))
+
+    ##############################################
+
+    def test_ties(self):
+
+        ''' Repeats have many alignments of the best score, the same one must be chosen '''
+
+        reference, aligner = self.aligners(True)
+        for ref, query in (('ACACACAC', 'CACA'), ('AAAAAAAA', 'AAAA'), ('ACGTACGT', 'ACGACG'),
+                           ('AACCAACC', 'ACAC'), ('ATATAT', 'TATTA')):
+            self.assert_same_alignment(reference.align(ref, query), aligner, ref, query)
+            self.assert_same_alignment(reference.align(query, ref), aligner, query, ref)
+
+    ##############################################
+
+    def test_align_top(self):
+
+        for prefer_gap_runs in (True, False):
+            reference, aligner = self.aligners(prefer_gap_runs)
+            for ref, query in _random_sequences(18, 50):
+                expected = [(alignment.score, alignment.cigar, alignment.q_pos, alignment.r_pos)
+                            for alignment in reference.align_top(ref, query, 5)]
+                hits = [(alignment.score, alignment.cigar, alignment.q_pos, alignment.r_pos)
+                        for alignment in aligner.align_top(ref, query, 5)]
+                self.assertEqual(hits, expected, '%s / %s' % (ref, query))
+
+####################################################################################################
+
+@unittest.skipIf(numpy is None, 'requires NumPy')
+class TestNumpyEngine(EngineTestCase):
+
+    engine = 'numpy'
+
+    ##############################################
+
+    def aligners(self, seed):
+
+        ''' Yield aligners with random scores and gap penalties, the reference one first '''
+
+        rand = random.Random(seed)
+        for i in xrange(12):
+            scoring = swalign.NucleotideScoringMatrix(*rand.choice(((1, -1), (2, -1), (2, -3),
+                                                                    (5, -4))))
+            gap_penalty, gap_extension_penalty = rand.choice(((-1, -1), (-3, -1), (-2, -2),
+                                                              (-5, -2)))
+            kwargs = dict(prefer_gap_runs=rand.random() < .5, wildcard=rand.choice((None, 'N')))
+            yield (swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                          bit_parallel=False, **kwargs),
+                   swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                          engine=self.engine, **kwargs),
+                   rand.randint(0, 2**30))
+
+    ##############################################
+
+    def test_alignments(self):
+
+        for reference, aligner, seed in self.aligners(1):
+            for ref, query in _random_sequences(seed, 20, max_length=60):
+                self.assert_same_alignment(reference.align(ref, query), aligner, ref, query)
+                self.assertEqual(aligner.score_only(ref, query), reference.score_only(ref, query))
+
+    ##############################################
+
+    def test_cells(self):
+
+        for reference, aligner, seed in self.aligners(2):
+            for ref, query in _random_sequences(seed, 10):
+                matrix = aligner._engine.fill(ref, query)[0]
+                expected_matrix = reference._engine.fill(ref, query)[0]
+                for row in xrange(1, len(query) +1):
+                    for col in xrange(1, len(ref) +1):
+                        expected = expected_matrix.get(row, col)
+                        if expected.score <= 0:
+                            continue
+                        cell = matrix.get(row, col)
+                        self.assertEqual((cell.score, cell.op, cell.run_length),
+                                         (expected.score, expected.op, expected.run_length),
+                                         '%s / %s at %s' % (ref, query, (row, col)))
+
+    ##############################################
+
+    def test_align_top(self):
+
+        for reference, aligner, seed in self.aligners(3):
+            for ref, query in _random_sequences(seed, 10):
+                expected = [(alignment.score, alignment.cigar, alignment.q_pos, alignment.r_pos)
+                            for alignment in reference.align_top(ref, query, 5)]
+                hits = [(alignment.score, alignment.cigar, alignment.q_pos, alignment.r_pos)
+                        for alignment in aligner.align_top(ref, query, 5)]
+                self.assertEqual(hits, expected, '%s / %s' % (ref, query))
+
+####################################################################################################
+
+@unittest.skipIf(numpy is None, 'requires NumPy')
+class TestProfileEngine(TestNumpyEngine):
+
+    engine = 'profile'
+
+####################################################################################################
+
+def _cigar_score(aligner, alignment):
+
+    ''' Return the score of the cigar of *alignment* in the affine gap model: a run of L gaps costs
+    ``gap_penalty + (L-1) * max(gap_penalty, gap_extension_penalty)``
+    '''
+
+    scoring = aligner.scoring_matrix
+    slope = max(aligner.gap_penalty, aligner.gap_extension_penalty)
+    ref = alignment.orig_ref.upper()
+    query = alignment.orig_query.upper()
+    row, col = alignment.q_pos, alignment.r_pos
+    score = 0
+    for count, op in alignment.cigar:
+        if op == 'M':
+            for i in xrange(count):
+                score += scoring.score(ref[col +i], query[row +i], aligner.wildcard)
+            row += count
+            col += count
+        else:
+            score += aligner.gap_penalty + (count -1) * slope
+            if op == 'I':
+                row += count
+            else:
+                col += count
+    return score
+
+####################################################################################################
+
+@unittest.skipIf(numpy is None, 'requires NumPy')
+class TestLinearSpaceAlignment(unittest.TestCase):
+
+    ''' :meth:`LocalAlignment.align_linear` against the full matrix of the 'gotoh' engine '''
+
+    ##############################################
+
+    def test_scores(self):
+
+        rand = random.Random(11)
+        for gap_penalty, gap_extension_penalty in ((-1, -1), (-5, -1), (-3, -1), (-4, -2),
+                                                   (-2, -3), (-6, -1)):
+            scoring = swalign.NucleotideScoringMatrix(*rand.choice(((1, -1), (2, -1), (2, -3),
+                                                                    (5, -4))))
+            wildcard = rand.choice((None, 'N'))
+            full = swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                          wildcard=wildcard, engine='gotoh')
+            linear = swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                            wildcard=wildcard)
+            for ref, query in _random_sequences(rand.randint(0, 2**30), 30, max_length=80):
+                expected = full.align(ref, query)
+                alignment = linear.align_linear(ref, query)
+                message = '%s / %s gap %s/%s' % (ref, query, gap_penalty, gap_extension_penalty)
+                self.assertEqual(alignment.score, expected.score, message)
+                self.assertEqual(_cigar_score(linear, alignment), alignment.score, message)
+                self.assertEqual(_cigar_score(full, expected), expected.score, message)
+
+    ##############################################
+
+    def test_long_sequences(self):
+
+        ''' Queries taken from the reference with edits, their alignments are split by the divide
+        and conquer
+        '''
+
+        rand = random.Random(12)
+        scoring = swalign.NucleotideScoringMatrix(2, -3)
+        for gap_penalty, gap_extension_penalty in ((-5, -2), (-3, -1), (-2, -2), (-2, -4)):
+            full = swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty,
+                                          engine='gotoh')
+            linear = swalign.LocalAlignment(scoring, gap_penalty, gap_extension_penalty)
+            for i in xrange(3):
+                ref = ''.join(rand.choice('ACGT') for j in xrange(rand.randint(200, 400)))
+                query = list(ref[rand.randint(0, 50):-rand.randint(1, 50)])
+                for j in xrange(rand.randint(5, 20)):
+                    position = rand.randint(0, len(query))
+                    query[position:position +rand.randint(0, 4)] = rand.choice(('', 'G', 'TTT'))
+                query = ''.join(query)
+                alignment = linear.align_linear(ref, query)
+                message = '%s / %s gap %s/%s' % (ref, query, gap_penalty, gap_extension_penalty)
+                self.assertTrue(alignment.q_end - alignment.q_pos > 100, message)
+                self.assertEqual(alignment.score, full.align(ref, query).score, message)
+                self.assertEqual(_cigar_score(linear, alignment), alignment.score, message)
+
+####################################################################################################
+
+if __name__ == '__main__':
+    unittest.main()